@@ -1,11 +1,27 @@
 import argparse
+import calendar
+import concurrent.futures
+import json
 import logging
+import re
+import signal
+import sys
 import time
-from datetime import datetime
 
 from config import settings
-from controller.round_trip import RoundTrip
-from controller.statuslog import StatusLog
+from config.mail import ConnectionPool, MailPopServer
+from controller.engine import RoundEngine
+from controller.latearrival import SentMailIndex
+from controller.mailbox import delete_messages, delete_pop_messages, find_mailround_messages, \
+    find_pop_mailround_messages
+from controller.metrics import MetricsServer
+from controller.notifier import Notifier
+from controller.report import SlaReport, write_csv, write_json
+from controller.sharding import FileLease, ShardCoordinator, worker_statuslog_path
+from controller.statusindex import StatusQuery
+from controller.statuslog import StatusLog, StatusVerifier
+from controller.statusmerge import StatusMerger
+from controller.supervisor import ShardSupervisor, shard_directory
 
 logging.basicConfig(level=logging.INFO)
 
@@ -18,12 +34,55 @@ class Command:
         self.arg = argparse.ArgumentParser()
 
     def arguments(self, parser):
+        parser.add_argument("command", nargs="?", default="run", choices=["run", "stats", "report", "merge"],
+                            help="run the mail check (default), show statistics of the Statuslog, "
+                                 "write an SLA report or merge the status logs of the workers")
         parser.add_argument("-v", "--verbose", help="increase output verbosity",
                             action="store_true")
         parser.add_argument("--full-clean", help="Remove all MailRound E-Mails from all Mailboxes", action="store_true")
         parser.add_argument("--no-cleanup", help="Do not Delete testmail", action="store_true")
+        parser.add_argument("--verify", help="Verify signatures and schema of the Statuslog", action="store_true")
+        parser.add_argument("--pair", help="stats: only this server pair <out>:<in>")
+        parser.add_argument("--last", default="7d", help="stats/report: time range eg. 30m, 12h or 7d (default 7d)")
+        parser.add_argument("--month", help="stats/report: calendar month (UTC) eg. 2021-03 instead of --last")
+        parser.add_argument("--json", help="stats/report: print JSON", action="store_true")
+        parser.add_argument("--output", help="report: write to this file instead of stdout")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="run the rounds in this number of worker processes (default SHARD_WORKERS)")
+        parser.add_argument("--worker", help=argparse.SUPPRESS)
 
     def handle(self, options):
+        if options.verify:
+            exit(self.verify_statuslog())
+
+        if options.command == "stats":
+            exit(self.stats(options))
+
+        if options.command == "report":
+            exit(self.report(options))
+
+        if options.command == "merge":
+            exit(self.merge())
+
+        workers = settings.SHARD_WORKERS if options.workers is None else options.workers
+        if workers > 0 and not options.worker and not options.full_clean:
+            exit(self.supervise(options, workers))
+
+        shard = None
+        if options.worker:
+            shard = ShardCoordinator(shard_directory(), options.worker,
+                                     settings.SHARD_REFRESH_INTERVAL.total_seconds())
+            # Every worker writes its own status log, the supervisor merges and compacts them
+            settings.STATUS_LOG_PATH = worker_statuslog_path(settings.STATUS_LOG_PATH, options.worker)
+            settings.SHARD_WORKER = options.worker
+            settings.STATUS_LOG_MAX_AGE = None
+            settings.STATUS_LOG_MAX_ROUNDS = 0
+            settings.STATUS_LOG_SUMMARY_MAX_AGE = None
+            # The supervisor only merges closed segments
+            if not settings.STATUS_LOG_SEGMENT_MAX_AGE or \
+                    settings.STATUS_LOG_SEGMENT_MAX_AGE > settings.SHARD_MERGE_INTERVAL:
+                settings.STATUS_LOG_SEGMENT_MAX_AGE = settings.SHARD_MERGE_INTERVAL
+
         statuslog = StatusLog.get_instance()
 
         log.info("Start Mail-Round")
@@ -40,51 +99,205 @@ class Command:
             setattr(settings, "CLEANUP", False)
 
         if options.full_clean:
-            for server_name, server_config in settings.MAIL_IN_SERVER.items():
-                self.mailbox_cleanup(server_config)
-                statuslog.stop()
+            self.full_clean()
+            statuslog.stop()
+            ConnectionPool.get_instance().close_all()
             exit(0)
 
-        mailround_thread_store = {}
-
-        if len(settings.MAIL_ROUND.items()) <= 0:
+        if len(settings.get_rounds()) <= 0 and not settings.CONFIG_FILE:
             raise EnvironmentError("Nothing todo. No configuration provided")
 
+        if settings.METRICS_PORT is not None:
+            MetricsServer().start()
+
         log.info("Start Mail Check")
-        last_check = datetime.fromtimestamp(0)
-        while True:
-
-            if last_check < datetime.now() - settings.CHECK_INTERVAL:
-                last_check = datetime.now()
-
-                for outname, inname in settings.MAIL_ROUND.items():
-                    rt = self.get_thread(outname, inname, mailround_thread_store)
-                    rt.start()
-            time.sleep(1)
-
-    def get_thread(self, outname, inname, mailround_thread_store):
-        log.debug("Thread for {} {} ".format(outname, inname))
-        if "{}{}".format(outname, inname) in mailround_thread_store:
-            t = mailround_thread_store["{}{}".format(outname, inname)]
-            if not t._is_stopped:
-                log.debug("Stop Thread {}{}".format(outname, inname))
-                t.join(2)
-
-        log.debug("Create new Thread {}{}".format(outname, inname))
-        mailround_thread_store["{}{}".format(outname, inname)] = RoundTrip(settings.MAIL_OUT_SERVER[outname],
-                                                                           settings.MAIL_IN_SERVER[inname],
-                                                                           (outname, inname),
-                                                                           name="rt-{}{}".format(outname, inname))
-        return mailround_thread_store["{}{}".format(outname, inname)]
-
-    def mailbox_cleanup(self, server_config):
-        conn = server_config.get_connection()
-        conn.select_folder("INBOX")
-        messages = conn.search()
-        for message_id, data in conn.fetch(messages, ['RFC822']).items():
-            conn.delete_messages(message_id)
-            conn.expunge(message_id)
-        conn.logout()
+        engine = RoundEngine(shard=shard)
+        if shard is not None:
+            # The supervisor stops its workers with SIGTERM, running rounds are finished
+            signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+        try:
+            engine.run_forever()
+        except KeyboardInterrupt:
+            log.info("Stop Mail-Round")
+        finally:
+            if Notifier.instance:
+                Notifier.instance.stop()
+            if SentMailIndex.instance:
+                SentMailIndex.instance.save()
+            statuslog.stop()
+            if shard is not None:
+                shard.close()
+
+    def supervise(self, options, workers):
+        arguments = []
+        if options.verbose:
+            arguments.append("--verbose")
+        if options.no_cleanup:
+            arguments.append("--no-cleanup")
+
+        if settings.METRICS_PORT is not None:
+            MetricsServer().start()
+
+        ShardSupervisor(workers, arguments).run()
+        return 0
+
+    def merge(self):
+        """
+        Merge the status logs of the workers once (eg. after all workers were stopped)
+        """
+        lease = FileLease("{}/merge.lock".format(shard_directory()))
+        if not lease.acquire():
+            log.error("The status logs are merged by a running supervisor")
+            return 1
+        try:
+            merger = StatusMerger(shard_directory())
+            count = merger.merge()
+        finally:
+            lease.release()
+        print("Merged {} records".format(count))
+        return 0
+
+    def verify_statuslog(self):
+        errors = StatusVerifier().verify()
+        for error in errors:
+            log.error(error)
+
+        if errors:
+            log.error("Statuslog is corrupt")
+            return 1
+        log.info("Statuslog looks fine")
+        return 0
+
+    def time_range(self, options):
+        """
+        :return: (since, until) of --month or --last
+        """
+        if options.month:
+            match = re.match(r"^(\d{4})-(0[1-9]|1[0-2])$", options.month)
+            if match is None:
+                raise ValueError("Invalid month {}".format(options.month))
+            year, month = int(match.group(1)), int(match.group(2))
+            since = calendar.timegm((year, month, 1, 0, 0, 0))
+            until = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+            return since, until
+
+        match = re.match(r"^(\d+(?:\.\d+)?)([smhd])$", options.last)
+        if match is None:
+            raise ValueError("Invalid time range {}".format(options.last))
+        seconds = float(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        now = time.time()
+        return now - seconds, now
+
+    def stats(self, options):
+        try:
+            since, until = self.time_range(options)
+        except ValueError as e:
+            log.error(e)
+            return 1
+
+        query = StatusQuery(settings.STATUS_LOG_PATH, settings.STATUS_LOG_SEGMENT_SIZE)
+        if options.pair:
+            outname, inname = options.pair.split(":")
+            results = [query.pair_stats(outname, inname, since, until)]
+        else:
+            results = query.stats(since, until)
+
+        if options.json:
+            print(json.dumps(results, indent=2))
+            return 0
+
+        print("{:<25} {:>7} {:>8} {:>7} {:>6} {:>9} {:>9} {:>9}".format(
+            "Pair", "Rounds", "Success", "Errors", "Grey", "Rate", "p50", "p95"))
+
+        def seconds_or_dash(value):
+            return "{:.2f}s".format(value) if value is not None else "-"
+
+        for result in results:
+            print("{:<25} {:>7} {:>8} {:>7} {:>6} {:>9} {:>9} {:>9}".format(
+                "{}->{}".format(result["out"], result["in"]), result["rounds"], result["success"], result["error"],
+                result["greylisting"],
+                "{:.1%}".format(result["success_rate"]) if result["success_rate"] is not None else "-",
+                seconds_or_dash(result["delivery_p50"]), seconds_or_dash(result["delivery_p95"])))
+        return 0
+
+    def report(self, options):
+        """
+        Write the SLA report of all server pairs as CSV (default) or JSON
+        """
+        try:
+            since, until = self.time_range(options)
+        except ValueError as e:
+            log.error(e)
+            return 1
+
+        start = time.monotonic()
+        report = SlaReport(settings.STATUS_LOG_PATH, settings.STATUS_LOG_SEGMENT_SIZE, since, until).build()
+        log.info("Report of {} server pairs built in {:.2f}s".format(len(report["pairs"]), time.monotonic() - start))
+
+        write = write_json if options.json else write_csv
+        if options.output:
+            with open(options.output, "w", newline="") as fobj:
+                write(report, fobj)
+        else:
+            write(report, sys.stdout)
+        return 0
+
+    def full_clean(self):
+        """
+        Remove the MailRound E-Mails of all inbox servers at the same time
+        """
+        if not settings.MAIL_IN_SERVER:
+            return
+
+        start = time.monotonic()
+        deleted = 0
+        workers = min(len(settings.MAIL_IN_SERVER), settings.ROUND_EXECUTOR_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="clean") as executor:
+            futures = {executor.submit(self.mailbox_cleanup, server_name, server_config): server_name
+                       for server_name, server_config in settings.MAIL_IN_SERVER.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    deleted += future.result()
+                except Exception as e:
+                    log.exception(e)
+                    log.error("Cleanup of {} failed".format(futures[future]))
+
+        duration = time.monotonic() - start
+        log.info("Removed {} MailRound E-Mails from {} Mailboxes in {:.1f}s".format(
+            deleted, len(futures), duration))
+
+    def mailbox_cleanup(self, server_name, server_config, folder="INBOX"):
+        """
+        Remove all MailRound E-Mails of one mailbox folder
+        :return: number of deleted E-Mails
+        """
+        start = time.monotonic()
+
+        def progress(inspected, candidates):
+            elapsed = time.monotonic() - start
+            log.info("{}: inspected {}/{} candidates ({:.0f} msg/s)".format(
+                server_name, inspected, candidates, inspected / elapsed if elapsed else 0))
+
+        if isinstance(server_config, MailPopServer):
+            # POP3 removes deleted messages at QUIT, the session is not pooled
+            folder = "maildrop"
+            conn = server_config.get_connection()
+            try:
+                messages = find_pop_mailround_messages(conn, progress=progress)
+                delete_pop_messages(conn, messages)
+            except Exception:
+                conn.close()
+                raise
+        else:
+            with server_config.connection() as conn:
+                conn.select_folder(folder)
+                messages = find_mailround_messages(conn, progress=progress)
+                delete_messages(conn, messages)
+
+        elapsed = time.monotonic() - start
+        log.info("{}: removed {} MailRound E-Mails from {} in {:.1f}s ({:.0f} msg/s)".format(
+            server_name, len(messages), folder, elapsed, len(messages) / elapsed if elapsed else 0))
+        return len(messages)
 
 
 if __name__ != "__name__":
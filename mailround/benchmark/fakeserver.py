@@ -0,0 +1,624 @@
+import base64
+import email.parser
+import logging
+import random
+import re
+import select
+import socketserver
+import threading
+from datetime import datetime
+
+log = logging.getLogger("mailround.benchmark.fakeserver")
+
+
+class FakeMessage:
+
+    def __init__(self, uid, data, modseq):
+        self.uid = uid
+        self.data = data
+        self.modseq = modseq
+        self.flags = set()
+        self.internaldate = datetime.now()
+        self.headers = email.parser.BytesHeaderParser().parsebytes(data)
+
+
+class FakeMailbox:
+
+    def __init__(self, address):
+        """
+        In memory INBOX of one address
+        :param address: E-Mail address of this mailbox
+        """
+        self.address = address
+        self.uidvalidity = random.randint(1, 2 ** 31)
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = []
+        self.changed = threading.Condition()
+
+    def deliver(self, data):
+        with self.changed:
+            self.modseq += 1
+            self.messages.append(FakeMessage(self.uidnext, data, self.modseq))
+            self.uidnext += 1
+            self.changed.notify_all()
+
+    def expunge(self, uids=None):
+        """
+        Remove deleted messages
+        :param uids: only remove deleted messages with these uids
+        :return: list of removed sequence numbers
+        """
+        with self.changed:
+            removed = []
+            for position in range(len(self.messages) - 1, -1, -1):
+                message = self.messages[position]
+                if "\\Deleted" in message.flags and (uids is None or message.uid in uids):
+                    del self.messages[position]
+                    removed.append(position + 1)
+            return removed
+
+
+class FakeMailStore:
+
+    def __init__(self, delivery_delay=0.0, fail_rate=0.0, delivery_jitter=0.0):
+        """
+        Shared state of the fake SMTP and IMAP servers
+        :param delivery_delay: seconds between SMTP DATA and arrival in the mailbox
+        :param fail_rate: probability that an accepted mail is silently lost
+        :param delivery_jitter: maximal random seconds added to delivery_delay
+        """
+        self.delivery_delay = delivery_delay
+        self.delivery_jitter = delivery_jitter
+        self.fail_rate = fail_rate
+        self.mailboxes = {}
+        self.lock = threading.Lock()
+        self.counters = {"smtp_sessions": 0, "imap_sessions": 0, "pop_sessions": 0, "logins": 0, "delivered": 0, "lost": 0,
+                         "fetched_bytes": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def mailbox(self, address):
+        with self.lock:
+            address = address.lower()
+            if address not in self.mailboxes:
+                self.mailboxes[address] = FakeMailbox(address)
+            return self.mailboxes[address]
+
+    def fill(self, address, count, size=2048):
+        """
+        Put foreign messages in a mailbox to simulate a production inbox
+        """
+        mailbox = self.mailbox(address)
+        for number in range(count):
+            mailbox.deliver("From: someone@example.com\r\nTo: {}\r\nSubject: filler {}\r\n\r\n{}\r\n".format(
+                address, number, "x" * size).encode())
+
+    def deliver(self, recipients, data):
+        for recipient in recipients:
+            if self.fail_rate and random.random() < self.fail_rate:
+                self.count("lost")
+                continue
+            mailbox = self.mailbox(recipient)
+            delay = self.delivery_delay
+            if self.delivery_jitter:
+                delay += random.uniform(0, self.delivery_jitter)
+            if delay:
+                timer = threading.Timer(delay, mailbox.deliver, args=(data,))
+                timer.daemon = True
+                timer.start()
+            else:
+                mailbox.deliver(data)
+            self.count("delivered")
+
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, handler, host="127.0.0.1", port=0, auth_fail_rate=0.0):
+        super(FakeServer, self).__init__((host, port), handler)
+        self.store = store
+        self.auth_fail_rate = auth_fail_rate
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-{}".format(self.port), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def auth_ok(self):
+        return not (self.auth_fail_rate and random.random() < self.auth_fail_rate)
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    # Responses are written line by line, Nagle would delay them by the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def send(self, line):
+        self.wfile.write("{}\r\n".format(line).encode())
+
+    def handle(self):
+        store = self.server.store
+        store.count("smtp_sessions")
+        self.send("220 fake ESMTP ready")
+        recipients = []
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode(errors="replace").rstrip("\r\n")
+            command = line.split(" ", 1)[0].upper()
+
+            if command in ["EHLO", "HELO"]:
+                self.wfile.write(b"250-fake\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 10485760\r\n")
+            elif command == "AUTH":
+                parts = line.split(" ")
+                if parts[1].upper() == "LOGIN":
+                    self.send("334 VXNlcm5hbWU6")
+                    self.rfile.readline()
+                    self.send("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                elif len(parts) < 3:
+                    self.send("334 ")
+                    self.rfile.readline()
+                store.count("logins")
+                if self.server.auth_ok():
+                    self.send("235 Authentication successful")
+                else:
+                    self.send("535 Authentication failed")
+            elif command == "MAIL":
+                recipients = []
+                self.send("250 OK")
+            elif command == "RCPT":
+                recipients.append(line.split(":", 1)[1].strip("<> ").split(">")[0])
+                self.send("250 OK")
+            elif command == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                store.deliver(recipients, b"".join(data))
+                self.send("250 OK queued")
+            elif command == "RSET":
+                recipients = []
+                self.send("250 OK")
+            elif command == "NOOP":
+                self.send("250 OK")
+            elif command == "QUIT":
+                self.send("221 Bye")
+                return
+            else:
+                self.send("502 Command not implemented")
+
+
+TOKEN = re.compile(rb'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+(?:\[[^\]]*\])?)')
+
+
+def tokenize(data):
+    tokens = []
+    for match in TOKEN.finditer(data):
+        if match.group(1) is not None:
+            tokens.append(match.group(1).replace(b'\\"', b'"').replace(b"\\\\", b"\\"))
+        elif match.group(2):
+            tokens.append(b"(")
+        elif match.group(3):
+            tokens.append(b")")
+        else:
+            tokens.append(match.group(4))
+    return tokens
+
+
+def parse_set(value, highest):
+    result = []
+    for part in value.decode().split(","):
+        if ":" in part:
+            start, end = part.split(":")
+            start = highest if start == "*" else int(start)
+            end = highest if end == "*" else int(end)
+            result.append((min(start, end), max(start, end)))
+        else:
+            number = highest if part == "*" else int(part)
+            result.append((number, number))
+    return result
+
+
+def in_set(number, ranges):
+    return any(start <= number <= end for start, end in ranges)
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    # Responses are written line by line, Nagle would delay them by the delayed ACK of the client
+    disable_nagle_algorithm = True
+    CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS CONDSTORE ENABLE LITERAL+ AUTH=PLAIN"
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        # Resolve literals {n} / {n+}
+        while True:
+            match = re.search(rb"\{(\d+)(\+?)\}\r\n$", line)
+            if not match:
+                break
+            if not match.group(2):
+                self.send("+ go ahead")
+            literal = self.rfile.read(int(match.group(1)))
+            line = line[:match.start()] + b'"' + literal.replace(b'"', b'\\"') + b'"' + self.rfile.readline()
+        return line.rstrip(b"\r\n")
+
+    def handle(self):
+        self.store = self.server.store
+        self.store.count("imap_sessions")
+        self.mailbox = None
+        self.known = 0
+        self.send("* OK [CAPABILITY {}] fake IMAP ready".format(self.CAPABILITIES))
+
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tokens = tokenize(line)
+            if len(tokens) < 2:
+                self.send(b"* BAD invalid command")
+                continue
+            tag = tokens[0].decode()
+            command = tokens[1].decode().upper()
+            args = tokens[2:]
+            use_uid = False
+            if command == "UID":
+                use_uid = True
+                command = args[0].decode().upper()
+                args = args[1:]
+
+            handler = getattr(self, "cmd_{}".format(command.lower()), None)
+            if handler is None:
+                self.send("{} BAD unknown command {}".format(tag, command))
+                continue
+            try:
+                if handler(tag, args, use_uid, line) is False:
+                    return
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                log.exception(e)
+                self.send("{} BAD {}".format(tag, e))
+
+    def cmd_capability(self, tag, args, use_uid, line):
+        self.send("* CAPABILITY {}".format(self.CAPABILITIES))
+        self.send("{} OK CAPABILITY completed".format(tag))
+
+    def cmd_noop(self, tag, args, use_uid, line):
+        self.report_new()
+        self.send("{} OK NOOP completed".format(tag))
+
+    def cmd_enable(self, tag, args, use_uid, line):
+        self.send("* ENABLED {}".format(" ".join(arg.decode() for arg in args)))
+        self.send("{} OK ENABLE completed".format(tag))
+
+    def cmd_id(self, tag, args, use_uid, line):
+        self.send('* ID ("name" "fake")')
+        self.send("{} OK ID completed".format(tag))
+
+    def cmd_login(self, tag, args, use_uid, line):
+        self.store.count("logins")
+        if not self.server.auth_ok():
+            self.send("{} NO [AUTHENTICATIONFAILED] Authentication failed".format(tag))
+            return
+        self.user = args[0].decode()
+        self.send("{} OK [CAPABILITY {}] Logged in".format(tag, self.CAPABILITIES))
+
+    def cmd_authenticate(self, tag, args, use_uid, line):
+        self.send("+ ")
+        response = base64.b64decode(self.rfile.readline().strip())
+        self.user = response.split(b"\0")[1].decode()
+        self.store.count("logins")
+        if not self.server.auth_ok():
+            self.send("{} NO [AUTHENTICATIONFAILED] Authentication failed".format(tag))
+            return
+        self.send("{} OK Logged in".format(tag))
+
+    def cmd_logout(self, tag, args, use_uid, line):
+        self.send("* BYE logging out")
+        self.send("{} OK LOGOUT completed".format(tag))
+        return False
+
+    def cmd_select(self, tag, args, use_uid, line):
+        self.mailbox = self.store.mailbox(self.user)
+        with self.mailbox.changed:
+            self.known = len(self.mailbox.messages)
+            self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+            self.send("* {} EXISTS".format(self.known))
+            self.send("* 0 RECENT")
+            self.send("* OK [UIDVALIDITY {}] UIDs valid".format(self.mailbox.uidvalidity))
+            self.send("* OK [UIDNEXT {}] Predicted next UID".format(self.mailbox.uidnext))
+            self.send("* OK [HIGHESTMODSEQ {}] Highest".format(self.mailbox.modseq))
+        self.send("{} OK [READ-WRITE] SELECT completed".format(tag))
+
+    cmd_examine = cmd_select
+
+    def cmd_close(self, tag, args, use_uid, line):
+        self.mailbox.expunge()
+        self.mailbox = None
+        self.send("{} OK CLOSE completed".format(tag))
+
+    def report_new(self):
+        if self.mailbox is None:
+            return
+        with self.mailbox.changed:
+            count = len(self.mailbox.messages)
+        if count != self.known:
+            self.send("* {} EXISTS".format(count))
+            if count > self.known:
+                self.send("* {} RECENT".format(count - self.known))
+            self.known = count
+
+    def cmd_idle(self, tag, args, use_uid, line):
+        self.send("+ idling")
+        self.wfile.flush()
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                done = self.rfile.readline()
+                if not done:
+                    return False
+                break
+            self.report_new()
+        self.send("{} OK IDLE terminated".format(tag))
+
+    def _messages(self, ranges, use_uid):
+        with self.mailbox.changed:
+            messages = list(enumerate(self.mailbox.messages, 1))
+        if not messages:
+            return []
+        highest = messages[-1][1].uid if use_uid else len(messages)
+        result = []
+        for seq, message in messages:
+            if in_set(message.uid if use_uid else seq, ranges):
+                result.append((seq, message))
+        if use_uid and not result:
+            # "n:*" always contains the message with the highest uid
+            for start, end in ranges:
+                if end == highest:
+                    result.append(messages[-1])
+                    break
+        return result
+
+    def _match(self, message, seq, criteria):
+        position = 0
+        negate = False
+        while position < len(criteria):
+            key = criteria[position].decode().upper()
+            position += 1
+            result = True
+            if key == "ALL":
+                result = True
+            elif key == "NOT":
+                negate = True
+                continue
+            elif key == "HEADER":
+                name = criteria[position].decode()
+                value = criteria[position + 1].decode().lower()
+                position += 2
+                found = message.headers.get_all(name) or []
+                result = any(value in item.lower() for item in found)
+            elif key == "UID":
+                result = in_set(message.uid, parse_set(criteria[position], self.mailbox.uidnext - 1))
+                position += 1
+            elif key == "MODSEQ":
+                result = message.modseq >= int(criteria[position])
+                position += 1
+            elif key == "SINCE":
+                since = datetime.strptime(criteria[position].decode(), "%d-%b-%Y")
+                result = message.internaldate.date() >= since.date()
+                position += 1
+            elif key == "DELETED":
+                result = "\\Deleted" in message.flags
+            elif key == "UNDELETED":
+                result = "\\Deleted" not in message.flags
+            elif key in ["CHARSET"]:
+                position += 1
+                continue
+            elif key in ["(", ")"]:
+                continue
+            elif re.match(r"^[\d:*,]+$", key):
+                result = in_set(seq, parse_set(criteria[position - 1], len(self.mailbox.messages)))
+            else:
+                raise ValueError("Unsupported search key {}".format(key))
+
+            if negate:
+                result = not result
+                negate = False
+            if not result:
+                return False
+        return True
+
+    def cmd_search(self, tag, args, use_uid, line):
+        with self.mailbox.changed:
+            messages = list(enumerate(self.mailbox.messages, 1))
+        found = [str(message.uid if use_uid else seq) for seq, message in messages
+                 if self._match(message, seq, args or [b"ALL"])]
+        self.send("* SEARCH {}".format(" ".join(found)).strip())
+        self.send("{} OK SEARCH completed".format(tag))
+
+    def cmd_fetch(self, tag, args, use_uid, line):
+        ranges = parse_set(args[0], 0)
+        items = b" ".join(args[1:]).upper()
+        highest = self.mailbox.uidnext - 1 if use_uid else len(self.mailbox.messages)
+        ranges = parse_set(args[0], highest)
+        for seq, message in self._messages(ranges, use_uid):
+            parts = [b"UID " + str(message.uid).encode()]
+            if b"FLAGS" in items:
+                parts.append("FLAGS ({})".format(" ".join(message.flags)).encode())
+            if b"MODSEQ" in items:
+                parts.append("MODSEQ ({})".format(message.modseq).encode())
+            if b"HEADER.FIELDS" in items:
+                names = re.search(rb"HEADER\.FIELDS \(([^)]*)\)", items).group(1).decode().split()
+                data = b""
+                for name in names:
+                    for value in message.headers.get_all(name) or []:
+                        data += "{}: {}\r\n".format(name, value).encode()
+                data += b"\r\n"
+                parts.append("BODY[HEADER.FIELDS ({})] {{{}}}\r\n".format(" ".join(names), len(data)).encode()
+                             + data)
+                self.store.count("fetched_bytes", len(data))
+            elif b"RFC822" in items or b"BODY[]" in items or b"BODY.PEEK[]" in items:
+                key = b"RFC822" if b"RFC822" in items else b"BODY[]"
+                parts.append(key + " {{{}}}\r\n".format(len(message.data)).encode() + message.data)
+                self.store.count("fetched_bytes", len(message.data))
+            self.send(b"* " + str(seq).encode() + b" FETCH (" + b" ".join(parts) + b")")
+        self.send("{} OK FETCH completed".format(tag))
+
+    def cmd_store(self, tag, args, use_uid, line):
+        highest = self.mailbox.uidnext - 1 if use_uid else len(self.mailbox.messages)
+        ranges = parse_set(args[0], highest)
+        mode = args[1].decode().upper()
+        flags = {flag.decode() for flag in args[2:] if flag not in [b"(", b")"]}
+        with self.mailbox.changed:
+            for seq, message in self._messages(ranges, use_uid):
+                if mode.startswith("+"):
+                    message.flags |= flags
+                elif mode.startswith("-"):
+                    message.flags -= flags
+                else:
+                    message.flags = set(flags)
+                self.mailbox.modseq += 1
+                message.modseq = self.mailbox.modseq
+                if ".SILENT" not in mode:
+                    self.send("* {} FETCH (UID {} FLAGS ({}))".format(seq, message.uid, " ".join(message.flags)))
+        self.send("{} OK STORE completed".format(tag))
+
+    def cmd_expunge(self, tag, args, use_uid, line):
+        uids = None
+        if use_uid:
+            uids = {message.uid for seq, message in self._messages(parse_set(args[0], self.mailbox.uidnext - 1),
+                                                                   True)}
+        removed = self.mailbox.expunge(uids)
+        for seq in removed:
+            self.send("* {} EXPUNGE".format(seq))
+        self.known -= len(removed)
+        self.send("{} OK EXPUNGE completed".format(tag))
+
+
+class FakePopHandler(socketserver.StreamRequestHandler):
+    # Responses are written line by line, Nagle would delay them by the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def send_lines(self, lines):
+        data = b"".join((b"." + line if line.startswith(b".") else line) + b"\r\n" for line in lines)
+        self.wfile.write(data + b".\r\n")
+
+    def handle(self):
+        store = self.server.store
+        store.count("pop_sessions")
+        self.send("+OK fake POP3 ready")
+        mailbox = None
+        user = None
+        # Like most servers the maildrop is a snapshot of the mailbox at login
+        messages = []
+        deleted = set()
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode(errors="replace").rstrip("\r\n").split(" ")
+            command = parts[0].upper()
+            args = parts[1:]
+
+            if command == "CAPA":
+                self.send("+OK")
+                self.send_lines([b"TOP", b"UIDL", b"USER"])
+            elif command == "USER":
+                user = args[0]
+                self.send("+OK")
+            elif command == "PASS":
+                store.count("logins")
+                if user is None or not self.server.auth_ok():
+                    self.send("-ERR authentication failed")
+                    continue
+                mailbox = store.mailbox(user)
+                with mailbox.changed:
+                    messages = list(mailbox.messages)
+                self.send("+OK {} messages".format(len(messages)))
+            elif command == "QUIT":
+                if mailbox is not None and deleted:
+                    with mailbox.changed:
+                        for message in deleted:
+                            message.flags.add("\\Deleted")
+                    mailbox.expunge([message.uid for message in deleted])
+                self.send("+OK bye")
+                return
+            elif mailbox is None:
+                self.send("-ERR not authenticated")
+            elif command == "NOOP":
+                self.send("+OK")
+            elif command == "STAT":
+                alive = [message for message in messages if message not in deleted]
+                self.send("+OK {} {}".format(len(alive), sum(len(message.data) for message in alive)))
+            elif command in ["UIDL", "LIST"]:
+                self.send("+OK")
+                self.send_lines(["{} {}".format(number, message.uid if command == "UIDL" else len(message.data))
+                                 .encode() for number, message in enumerate(messages, 1)
+                                 if message not in deleted])
+            elif command in ["TOP", "RETR", "DELE"]:
+                number = int(args[0]) if args and args[0].isdigit() else 0
+                if not 0 < number <= len(messages) or messages[number - 1] in deleted:
+                    self.send("-ERR no such message")
+                    continue
+                message = messages[number - 1]
+                if command == "DELE":
+                    deleted.add(message)
+                    self.send("+OK deleted")
+                    continue
+                data = message.data
+                if command == "TOP":
+                    header, separator, body = data.partition(b"\r\n\r\n")
+                    body_lines = body.split(b"\r\n")[:int(args[1])] if len(args) > 1 else []
+                    data = header + b"\r\n\r\n" + b"\r\n".join(body_lines)
+                store.count("fetched_bytes", len(data))
+                self.send("+OK")
+                self.send_lines(data.rstrip(b"\r\n").split(b"\r\n"))
+            elif command == "RSET":
+                deleted = set()
+                self.send("+OK")
+            else:
+                self.send("-ERR unknown command")
+
+
+def start_servers(store=None, host="127.0.0.1", auth_fail_rate=0.0):
+    """
+    Start one fake SMTP and one fake IMAP server on free ports
+    A fake POP3 server on the same store can be started with FakeServer(store, FakePopHandler).start()
+    :return: (store, smtp server, imap server)
+    """
+    store = store or FakeMailStore()
+    smtp = FakeServer(store, FakeSmtpHandler, host=host, auth_fail_rate=auth_fail_rate).start()
+    imap = FakeServer(store, FakeImapHandler, host=host, auth_fail_rate=auth_fail_rate).start()
+    return store, smtp, imap
@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from benchmark.fakeserver import FakeMailStore, FakePopHandler, FakeServer, start_servers
+from config import settings
+from config.mail import ConnectionPool, MailCredentials, MailImapServer, MailPopServer, MailSmtpServer
+from controller.engine import RoundEngine
+from controller.mailbox import MailboxWatcher
+from controller.metrics import Histogram, RoundMetrics
+from controller.segment import pack_record
+from controller.statuslog import StatusLog, StatusReader
+
+log = logging.getLogger("mailround.benchmark")
+
+
+class Benchmark:
+
+    def __init__(self, options):
+        """
+        Run the round engine against the fake SMTP/IMAP servers and measure it
+        :param options: parsed command line arguments
+        """
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix="mailround-benchmark-")
+        self.store = FakeMailStore(delivery_delay=options.delivery_delay, fail_rate=options.fail_rate,
+                                   delivery_jitter=options.delivery_jitter)
+
+    def configure(self, smtp, imap):
+        """
+        Replace the configured servers and rounds with servers on the fake SMTP/IMAP server
+        :param imap: fake IMAP or POP3 server of the inboxes
+        """
+        options = self.options
+        settings.MAIL_IN_SERVER = {}
+        settings.MAIL_OUT_SERVER = {}
+        settings.MAIL_ROUND = {}
+        settings.ROUND_INTERVAL = {}
+
+        for number in range(options.inboxes):
+            address = "in{}@example.com".format(number)
+            server_class = MailPopServer if options.pop else MailImapServer
+            settings.MAIL_IN_SERVER["in{}".format(number)] = server_class(
+                "127.0.0.1", imap.port, False, address, MailCredentials(address, "secret"))
+            if options.mailbox_size:
+                self.store.fill(address, options.mailbox_size)
+
+        for number in range(options.rounds):
+            address = "out{}@example.com".format(number)
+            settings.MAIL_OUT_SERVER["out{}".format(number)] = MailSmtpServer(
+                "127.0.0.1", smtp.port, False, address, MailCredentials(address, "secret"))
+            innames = ["in{}".format((number + offset) % options.inboxes) for offset in range(options.fanout)]
+            settings.MAIL_ROUND["out{}".format(number)] = innames if len(innames) > 1 else innames[0]
+
+        settings.CHECK_INTERVAL = timedelta(seconds=options.interval)
+        settings.MAX_MAIL_RECEIVE_TIME = timedelta(seconds=options.receive_time)
+        settings.STATUS_LOG_PATH = os.path.join(self.directory, "data.mrmp")
+        settings.WEBHOOK_URL = ""
+
+    def run(self):
+        store, smtp, imap = start_servers(self.store, auth_fail_rate=self.options.auth_fail_rate)
+        if self.options.pop:
+            imap.stop()
+            imap = FakeServer(store, FakePopHandler, auth_fail_rate=self.options.auth_fail_rate).start()
+        self.configure(smtp, imap)
+
+        engine = RoundEngine()
+        timer = threading.Timer(self.options.duration, engine.stop)
+        timer.start()
+
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        try:
+            engine.run_forever()
+        finally:
+            timer.cancel()
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+
+        # Write everything which is still queued before the status log is measured
+        StatusLog.get_instance().stop(timeout=None)
+        MailboxWatcher.stop_all()
+        ConnectionPool.get_instance().close_all()
+        smtp.stop()
+        imap.stop()
+
+        return self.report(engine, elapsed, cpu)
+
+    def report(self, engine, elapsed, cpu):
+        metrics = RoundMetrics.get_instance()
+
+        results = {}
+        for (outname, inname, result), count in metrics.results.items():
+            results[result] = results.get(result, 0) + count
+        finished = results.get("success", 0) + results.get("error", 0)
+
+        # Merge the histograms of all server pairs
+        phases = {}
+        for (name, outname, inname), histogram in metrics.histograms.items():
+            merged = phases.setdefault(name, Histogram(histogram.buckets))
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+
+        written, payload, records = self.statuslog_size()
+
+        return {
+            "duration": elapsed,
+            "cpu": cpu,
+            "rounds": finished,
+            "rounds_per_second": finished / elapsed if elapsed else 0,
+            "results": results,
+            "skipped": engine.scheduler.skipped,
+            "phases": {name: {
+                "count": histogram.count,
+                "mean": histogram.sum / histogram.count if histogram.count else None,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+            } for name, histogram in sorted(phases.items())},
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "threads": threading.active_count(),
+            "statuslog": {
+                "records": records,
+                "written_bytes": written,
+                "status_bytes": payload,
+                "write_amplification": written / payload if payload else None,
+                "bytes_per_round": written / finished if finished else None,
+            },
+            "server": dict(self.store.counters),
+        }
+
+    def statuslog_size(self):
+        """
+        Compare the bytes on disk with the bytes of the status messages alone
+        :return: (written bytes, packed size of the status records, number of status records)
+        """
+        reader = StatusReader(settings.STATUS_LOG_PATH)
+        written = sum(os.path.getsize(path) for number, path in reader.store.segments())
+        payload = 0
+        records = 0
+        for number, offset, record in reader.iter_records():
+            if record.get("record") == "status":
+                payload += len(pack_record(record))
+                records += 1
+        return written, payload, records
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def print_report(report):
+    print("Rounds:            {} in {:.1f}s ({:.2f} rounds/s, {:.1f} rounds/min)".format(
+        report["rounds"], report["duration"], report["rounds_per_second"], report["rounds_per_second"] * 60))
+    print("Results:           {}".format(", ".join("{}={}".format(key, value)
+                                                   for key, value in sorted(report["results"].items()))))
+    print("Skipped:           {}".format(report["skipped"]))
+    print("CPU:               {:.2f}s".format(report["cpu"]))
+    print("Max RSS:           {:.1f} MB".format(report["max_rss_kb"] / 1024))
+    print("Threads:           {}".format(report["threads"]))
+    print("")
+    print("{:<17} {:>8} {:>10} {:>10} {:>10} {:>10}".format("Phase", "count", "mean", "p50", "p95", "p99"))
+    for name, phase in report["phases"].items():
+        print("{:<17} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            name, phase["count"], *["{:.4f}".format(phase[key]) if phase[key] is not None else "-"
+                                    for key in ["mean", "p50", "p95", "p99"]]))
+    print("")
+    statuslog = report["statuslog"]
+    print("Status log:        {} records, {} bytes written, {} bytes of status messages".format(
+        statuslog["records"], statuslog["written_bytes"], statuslog["status_bytes"]))
+    if statuslog["write_amplification"] is not None:
+        print("Write amplif.:     {:.2f}".format(statuslog["write_amplification"]))
+    if statuslog["bytes_per_round"] is not None:
+        print("Bytes per round:   {:.0f}".format(statuslog["bytes_per_round"]))
+    print("Server:            {}".format(", ".join("{}={}".format(key, value)
+                                                   for key, value in sorted(report["server"].items()))))
+
+
+def arguments(parser):
+    parser.add_argument("--rounds", type=int, default=50, help="Number of configured rounds (sender servers)")
+    parser.add_argument("--inboxes", type=int, default=10, help="Number of inbox servers")
+    parser.add_argument("--fanout", type=int, default=1, help="Inboxes per round")
+    parser.add_argument("--duration", type=float, default=30, help="Benchmark duration in seconds")
+    parser.add_argument("--interval", type=float, default=5, help="Interval of every round in seconds")
+    parser.add_argument("--receive-time", type=float, default=10, help="MAX_MAIL_RECEIVE_TIME in seconds")
+    parser.add_argument("--delivery-delay", type=float, default=0.2, help="Seconds until a mail arrives")
+    parser.add_argument("--delivery-jitter", type=float, default=0.0, help="Random additional delivery delay")
+    parser.add_argument("--mailbox-size", type=int, default=0, help="Foreign messages in every inbox")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Probability that a mail is lost")
+    parser.add_argument("--auth-fail-rate", type=float, default=0.0, help="Probability that a login fails")
+    parser.add_argument("--pop", help="Use POP3 inboxes instead of IMAP", action="store_true")
+    parser.add_argument("--json", help="Write the report as JSON to this file")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="MailRound throughput benchmark against local fake servers")
+    arguments(parser)
+    options = parser.parse_args()
+
+    benchmark = Benchmark(options)
+    try:
+        report = benchmark.run()
+    finally:
+        benchmark.cleanup()
+
+    print_report(report)
+    if options.json:
+        with open(options.json, "w") as fobj:
+            json.dump(report, fobj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
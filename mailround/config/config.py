@@ -1,6 +1,7 @@
 from datetime import timedelta
 from datetime import timedelta
 import logging
+from config.configfile import ConfigFile
 from config.envload import LoadEnvironment
 
 log = logging.getLogger("mailround.config")
@@ -36,6 +37,10 @@ class Configuration:
         {
             "vps1": "vps2"
         }
+        A list of inbox servers sends one test mail to all of them (fan-out round):
+        {
+            "vps1": ["vps2", "vps3"]
+        }
     """
     MAIL_ROUND = {
     }
@@ -45,16 +50,231 @@ class Configuration:
     """
     CHECK_INTERVAL = timedelta(minutes=15)
 
+    """
+        Interval of single rounds which should not use CHECK_INTERVAL
+        {
+            ("vps2", "vps1"): timedelta(minutes=5)
+        }
+    """
+    ROUND_INTERVAL = {
+    }
+
+    """
+        Spread the first run of rounds with the same interval evenly over the interval
+    """
+    SCHEDULE_SPREAD = True
+
+    """
+        Maximal random delay added to every scheduled run
+    """
+    SCHEDULE_JITTER = timedelta(seconds=0)
+
+    """
+        What happens when a round is due while its previous run is still active
+        "skip": wait for the next regular run
+        "delay": start it as soon as the previous run is finished
+    """
+    SCHEDULE_OVERLAP = "skip"
+
+    """
+        Maximal number of rounds which run at the same time
+    """
+    MAX_CONCURRENT_ROUNDS = 100
+
+    """
+        Number of threads for blocking SMTP and webhook calls of all rounds
+    """
+    ROUND_EXECUTOR_WORKERS = 16
+
     """ 
         Timeout to receive the test mail is to be maintained.
     """
     MAX_MAIL_RECEIVE_TIME = timedelta(seconds=10)
 
+    """
+        Idle SMTP and IMAP sessions are closed after this time
+    """
+    CONNECTION_POOL_MAX_IDLE = timedelta(seconds=60)
+
+    """
+        Idle sessions older than this are checked with NOOP before they are reused
+    """
+    CONNECTION_POOL_CHECK_AFTER = timedelta(seconds=5)
+
+    """
+        Maximal number of pooled connections (in use and idle) per mail server host
+    """
+    CONNECTION_POOL_MAX_PER_HOST = 4
+
+    """
+        Time a round waits for a free pooled connection when all connections of the host are in use,
+        the round fails after it
+    """
+    CONNECTION_POOL_WAIT_TIMEOUT = timedelta(seconds=60)
+
+    """
+        While rounds wait for their test mail, the shared mailbox watcher searches the inbox
+        at least this often, even if the IMAP server sent no IDLE notification (POP3 inboxes are polled this often)
+    """
+    WATCHER_POLL_INTERVAL = timedelta(seconds=5)
+
+    """
+        Restart the IDLE command of the mailbox watcher after this time (servers drop IDLE after 30 minutes)
+    """
+    WATCHER_IDLE_REFRESH = timedelta(minutes=10)
+
+    """
+        Wait time before the mailbox watcher reconnects after a connection error
+    """
+    WATCHER_RECONNECT_DELAY = timedelta(seconds=10)
+
+    """
+        Failed rounds in a row after which the circuit of a mail server opens (0 disables the circuit breaker)
+        Rounds with a server with an open circuit are skipped, only a connect is tried after a backoff delay
+    """
+    CIRCUIT_FAILURE_THRESHOLD = 3
+
+    """
+        First backoff delay of an open circuit, it doubles after every failed probe up to CIRCUIT_MAX_DELAY
+    """
+    CIRCUIT_OPEN_DELAY = timedelta(seconds=60)
+    CIRCUIT_MAX_DELAY = timedelta(minutes=30)
+
+    """
+        Timeout of the connect only probe of a server with an open circuit
+    """
+    CIRCUIT_PROBE_TIMEOUT = timedelta(seconds=10)
+
+    """
+        Check the certificates of the mail servers (also with a TLS connection started by STARTTLS)
+    """
+    TLS_VERIFY = True
+
+    """
+        Time the addresses of a mail server host are cached (0 resolves the host for every connection)
+    """
+    DNS_CACHE_TTL = timedelta(seconds=60)
+
+    """
+        Maximal number of logins which run at the same time per mail server host, shared by the rounds,
+        the mailbox watchers and the full cleanup (0 does not limit them)
+    """
+    HOST_MAX_CONCURRENT_LOGINS = 4
+
+    """
+        Logins per second per mail server host (0 does not limit the rate)
+    """
+    HOST_LOGIN_RATE = 0.0
+
+    """
+        Logins per mail server host which may run without waiting for the rate (eg. at interval start)
+    """
+    HOST_LOGIN_BURST = 5
+
+    """
+        A login which waited this long for its host gives up, the round fails with a throttling error
+    """
+    HOST_LOGIN_MAX_WAIT = timedelta(seconds=60)
+
+    """
+        Test mails which arrive up to this time after sending are attributed to their round when they arrive late
+    """
+    LATE_ARRIVAL_WINDOW = timedelta(days=1)
+
+    """
+        Interval in which the index of sent test mails is written to <STATUS_LOG_PATH>.sent
+    """
+    LATE_ARRIVAL_SNAPSHOT_INTERVAL = timedelta(seconds=60)
+
     """
         Trigger eg. Chat or FaaS if mailcheck is failing
     """
     WEBHOOK_URL = ""
 
+    """
+        Port of the Prometheus metrics endpoint http://<host>:<port>/metrics (None disables the endpoint)
+    """
+    METRICS_PORT = None
+    METRICS_HOST = "0.0.0.0"
+
+    """
+        Fraction of rounds (0.0 - 1.0) which are profiled with cProfile
+    """
+    PROFILE_SAMPLE_RATE = 0.0
+
+    """
+        Directory for the profiles of sampled rounds (None logs the most expensive functions instead)
+    """
+    PROFILE_PATH = None
+
+    """
+        Maximal number of notifications waiting to be sent, further notifications are dropped
+    """
+    NOTIFY_QUEUE_SIZE = 1000
+
+    """
+        Failed rounds which are reported within this time are sent as one message
+    """
+    NOTIFY_COALESCE_WINDOW = timedelta(seconds=10)
+
+    """
+        Timeout of a single webhook request
+    """
+    NOTIFY_TIMEOUT = timedelta(seconds=10)
+
+    """
+        Number of retries of a failed webhook request
+    """
+    NOTIFY_RETRIES = 5
+
+    """
+        Wait time before the first retry, it doubles with every further retry up to NOTIFY_RETRY_MAX_DELAY
+    """
+    NOTIFY_RETRY_DELAY = timedelta(seconds=2)
+    NOTIFY_RETRY_MAX_DELAY = timedelta(seconds=60)
+
+    """
+        Number of worker processes which share the rounds (0 runs all rounds in this process)
+    """
+    SHARD_WORKERS = 0
+
+    """
+        Name of this host in the worker names <SHARD_NAME>-<number> (None uses the hostname)
+    """
+    SHARD_NAME = None
+
+    """
+        Directory with the leases of the workers, supervisors on several hosts share it (None: <STATUS_LOG_PATH>.shards)
+    """
+    SHARD_DIRECTORY = None
+
+    """
+        Interval in which the workers check the living workers and the leases of their rounds
+    """
+    SHARD_REFRESH_INTERVAL = timedelta(seconds=5)
+
+    """
+        Interval in which the status logs of the workers are merged into the status log
+    """
+    SHARD_MERGE_INTERVAL = timedelta(seconds=60)
+
+    """
+        Name of this worker process, set by --worker (None outside of a shard worker)
+        Test mails carry it, so the watchers of a worker leave the test mails of other workers in a shared inbox alone
+    """
+    SHARD_WORKER = None
+
+    """
+        JSON or TOML file with servers, rounds and settings in addition to the environment variables
+        The file is reloaded on SIGHUP and when it changes (None disables the file)
+    """
+    CONFIG_FILE = None
+
+    """
+        Interval in which the config file is checked for changes
+    """
+    CONFIG_RELOAD_INTERVAL = timedelta(seconds=5)
+
     """
         Delete automaticly Mailround test emails    
     """
@@ -65,8 +285,134 @@ class Configuration:
     """
     STATUS_LOG_PATH = "./data.mrmp"
 
+    """
+        Size in bytes after which the Status Log starts a new segment file
+    """
+    STATUS_LOG_SEGMENT_SIZE = 4 * 1024 * 1024
+
+    """
+        Time after which the Status Log starts a new segment file even if it is not full (None waits for the size)
+        Shard workers use SHARD_MERGE_INTERVAL, so their records are merged without waiting for a full segment
+    """
+    STATUS_LOG_SEGMENT_MAX_AGE = None
+
+    """
+        Maximal number of status messages waiting to be written
+    """
+    STATUS_LOG_QUEUE_SIZE = 10000
+
+    """
+        What happens when the status log queue is full
+        "block": the round waits up to STATUS_LOG_QUEUE_TIMEOUT for the writer, then the message is dropped
+        "drop": the message is dropped at once
+    """
+    STATUS_LOG_QUEUE_POLICY = "block"
+    STATUS_LOG_QUEUE_TIMEOUT = timedelta(seconds=5)
+
+    """
+        The writer commits up to STATUS_LOG_BATCH_SIZE status messages at once,
+        it waits at most STATUS_LOG_BATCH_DELAY for further messages after the first one
+    """
+    STATUS_LOG_BATCH_SIZE = 1000
+    STATUS_LOG_BATCH_DELAY = timedelta(seconds=1)
+
+    """
+        Status messages of rounds older than this are replaced by summaries (None keeps everything)
+    """
+    STATUS_LOG_MAX_AGE = timedelta(days=30)
+
+    """
+        Maximal number of rounds per server pair which are kept with all status messages (0 is unlimited)
+    """
+    STATUS_LOG_MAX_ROUNDS = 0
+
+    """
+        Width of the time window in which old rounds of a server pair are summarized
+    """
+    STATUS_LOG_SUMMARY_INTERVAL = timedelta(hours=1)
+
+    """
+        Summaries older than this are removed from the Status Log (None keeps them)
+    """
+    STATUS_LOG_SUMMARY_MAX_AGE = timedelta(days=365)
+
+    """
+        Interval of the background Status Log cleanup
+    """
+    STATUS_LOG_CLEANUP_INTERVAL = timedelta(hours=1)
+
+    def __init__(self):
+        # Every configuration has its own servers and rounds, so a reloaded configuration can be compared
+        self.MAIL_IN_SERVER = {}
+        self.MAIL_OUT_SERVER = {}
+        self.MAIL_ROUND = {}
+        self.ROUND_INTERVAL = {}
+
+    def add_round(self, outname, innames, interval=None):
+        """
+        Add a round, a sender which is added several times sends to all its inbox servers
+        :param innames: list of inbox server names
+        :param interval: own interval of the round (timedelta) instead of CHECK_INTERVAL
+        """
+        if interval is not None:
+            for inname in innames:
+                self.ROUND_INTERVAL[(outname, inname)] = interval
+
+        if outname in self.MAIL_ROUND:
+            existing = self.MAIL_ROUND[outname]
+            if not isinstance(existing, list):
+                existing = [existing]
+            innames = existing + [inname for inname in innames if inname not in existing]
+
+        if len(innames) == 1:
+            self.MAIL_ROUND[outname] = innames[0]
+        else:
+            self.MAIL_ROUND[outname] = list(innames)
+
+    def get_rounds(self):
+        """
+        All configured rounds
+        :return: list of (outname, tuple of innames)
+        """
+        rounds = []
+        for outname, innames in self.MAIL_ROUND.items():
+            if not isinstance(innames, (list, tuple)):
+                innames = [innames]
+            rounds.append((outname, tuple(innames)))
+        return rounds
+
+    def get_round_pairs(self):
+        """
+        All configured server pairs, a fan-out round has one pair per inbox
+        :return: list of (outname, inname)
+        """
+        return [(outname, inname) for outname, innames in self.get_rounds() for inname in innames]
+
+    def get_round_intervals(self):
+        """
+        Interval of every round, a pair uses its ROUND_INTERVAL entry or CHECK_INTERVAL,
+        a fan-out round runs with the shortest interval of its pairs
+        :return: dict of (outname, tuple of innames) -> seconds
+        """
+        intervals = {}
+        for outname, innames in self.get_rounds():
+            interval = min(self.ROUND_INTERVAL.get((outname, inname), self.CHECK_INTERVAL) for inname in innames)
+            intervals[(outname, innames)] = interval.total_seconds()
+        return intervals
+
+
+def load_configuration():
+    """
+    Build the configuration from the environment variables and CONFIG_FILE
+    :return: Configuration
+    """
+    conf = Configuration()
+    env = LoadEnvironment(conf)
+    env.load()
+    if conf.CONFIG_FILE:
+        ConfigFile(conf.CONFIG_FILE).apply(conf)
+    return conf
+
 
-conf = Configuration()
-env = LoadEnvironment(conf)
-env.load()
+conf = load_configuration()
 settings = conf
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+from datetime import timedelta
+
+from config.mail import MailCredentials, MailImapServer, MailPopServer, MailSmtpServer
+
+try:
+    import tomllib as toml
+except ImportError:
+    try:
+        import toml
+    except ImportError:
+        toml = None
+
+log = logging.getLogger("mailround.config")
+
+SERVER_TYPES = {
+    "imap": MailImapServer,
+    "pop": MailPopServer,
+    "smtp": MailSmtpServer,
+}
+
+
+class ConfigFile:
+
+    def __init__(self, path):
+        """
+        Servers, rounds and settings from a JSON or TOML file (chosen by the file extension)
+
+        {
+            "in_server": {"vps1": {"type": "imap", "host": "mailin.example.com", "port": 993, "use_ssl": true,
+                                   "email": "test@example.com", "username": "test@example.com", "password": "secret"}},
+            "out_server": {"vps2": {...}},
+            "round": [{"out": "vps2", "in": ["vps1"], "interval": 300}],
+            "settings": {"CHECK_INTERVAL": 600}
+        }
+        :param path: Path of the file
+        """
+        self.path = path
+
+    def read(self):
+        """
+        :return: dict
+        """
+        with open(self.path, "rb") as fobj:
+            text = fobj.read().decode("utf-8")
+
+        if os.path.splitext(self.path)[1].lower() == ".toml":
+            if toml is None:
+                raise ValueError("Reading {} needs the toml package (or python 3.11)".format(self.path))
+            return toml.loads(text)
+        return json.loads(text)
+
+    def apply(self, conf):
+        """
+        Add the content of the file to a configuration
+        Entries of the file replace environment variables with the same name
+        :param conf: Configuration
+        """
+        data = self.read()
+
+        for server_name, server in data.get("in_server", {}).items():
+            conf.MAIL_IN_SERVER[server_name] = self.build_server(server_name, server, "imap")
+
+        for server_name, server in data.get("out_server", {}).items():
+            conf.MAIL_OUT_SERVER[server_name] = self.build_server(server_name, server, "smtp")
+
+        for entry in data.get("round", []):
+            innames = entry["in"]
+            if not isinstance(innames, list):
+                innames = [innames]
+            interval = entry.get("interval")
+            conf.add_round(entry["out"], innames, timedelta(seconds=interval) if interval is not None else None)
+
+        for name, value in data.get("settings", {}).items():
+            self.apply_setting(conf, name, value)
+
+        for outname, inname in conf.get_round_pairs():
+            if outname not in conf.MAIL_OUT_SERVER or inname not in conf.MAIL_IN_SERVER:
+                raise ValueError("Round {} -> {} uses an unknown server".format(outname, inname))
+
+    def build_server(self, server_name, server, default_type):
+        server_type = SERVER_TYPES.get(str(server.get("type", default_type)).lower())
+        if server_type is None:
+            raise ValueError("Unknown server type {} of {}".format(server.get("type"), server_name))
+        try:
+            return server_type(server["host"], int(server["port"]), bool(server.get("use_ssl", False)),
+                               server["email"], MailCredentials(server["username"], server["password"]))
+        except KeyError as e:
+            raise ValueError("Server {} has no {}".format(server_name, e))
+
+    def apply_setting(self, conf, name, value):
+        """
+        Set a single setting, timedeltas are given in seconds
+        """
+        if not name.isupper() or not hasattr(conf, name) or name in ["MAIL_IN_SERVER", "MAIL_OUT_SERVER",
+                                                                    "MAIL_ROUND", "ROUND_INTERVAL", "CONFIG_FILE"]:
+            raise ValueError("Unknown setting {} in {}".format(name, self.path))
+
+        current = getattr(conf, name)
+        if isinstance(current, timedelta):
+            value = timedelta(seconds=value) if value is not None else None
+        setattr(conf, name, value)
@@ -36,18 +36,188 @@ class LoadEnvironment:
         self.build_mailbox_config(settings)
         self.build_mailround_config(settings)
 
+        if "MAILROUND_CHECK_INTERVAL" in settings:
+            self.conf.CHECK_INTERVAL = timedelta(seconds=int(settings["MAILROUND_CHECK_INTERVAL"]))
+
+        if "MAILROUND_SCHEDULE_SPREAD" in settings:
+            self.conf.SCHEDULE_SPREAD = self.bool_parse(settings["MAILROUND_SCHEDULE_SPREAD"])
+
+        if "MAILROUND_SCHEDULE_JITTER" in settings:
+            self.conf.SCHEDULE_JITTER = timedelta(seconds=int(settings["MAILROUND_SCHEDULE_JITTER"]))
+
+        if "MAILROUND_SCHEDULE_OVERLAP" in settings:
+            self.conf.SCHEDULE_OVERLAP = settings["MAILROUND_SCHEDULE_OVERLAP"].lower()
+
+        if "MAILROUND_MAX_CONCURRENT_ROUNDS" in settings:
+            self.conf.MAX_CONCURRENT_ROUNDS = int(settings["MAILROUND_MAX_CONCURRENT_ROUNDS"])
+
+        if "MAILROUND_ROUND_EXECUTOR_WORKERS" in settings:
+            self.conf.ROUND_EXECUTOR_WORKERS = int(settings["MAILROUND_ROUND_EXECUTOR_WORKERS"])
+
         if "MAILROUND_MAX_MAIL_RECEIVE_TIME" in settings:
             self.conf.MAX_MAIL_RECEIVE_TIME = timedelta(seconds=int(settings["MAILROUND_MAX_MAIL_RECEIVE_TIME"]))
 
+        if "MAILROUND_CONNECTION_POOL_MAX_IDLE" in settings:
+            self.conf.CONNECTION_POOL_MAX_IDLE = timedelta(seconds=int(settings["MAILROUND_CONNECTION_POOL_MAX_IDLE"]))
+
+        if "MAILROUND_CONNECTION_POOL_CHECK_AFTER" in settings:
+            self.conf.CONNECTION_POOL_CHECK_AFTER = timedelta(
+                seconds=int(settings["MAILROUND_CONNECTION_POOL_CHECK_AFTER"]))
+
+        if "MAILROUND_CONNECTION_POOL_MAX_PER_HOST" in settings:
+            self.conf.CONNECTION_POOL_MAX_PER_HOST = int(settings["MAILROUND_CONNECTION_POOL_MAX_PER_HOST"])
+
+        if "MAILROUND_CONNECTION_POOL_WAIT_TIMEOUT" in settings:
+            self.conf.CONNECTION_POOL_WAIT_TIMEOUT = timedelta(
+                seconds=int(settings["MAILROUND_CONNECTION_POOL_WAIT_TIMEOUT"]))
+
+        if "MAILROUND_WATCHER_POLL_INTERVAL" in settings:
+            self.conf.WATCHER_POLL_INTERVAL = timedelta(seconds=int(settings["MAILROUND_WATCHER_POLL_INTERVAL"]))
+
+        if "MAILROUND_WATCHER_IDLE_REFRESH" in settings:
+            self.conf.WATCHER_IDLE_REFRESH = timedelta(seconds=int(settings["MAILROUND_WATCHER_IDLE_REFRESH"]))
+
+        if "MAILROUND_WATCHER_RECONNECT_DELAY" in settings:
+            self.conf.WATCHER_RECONNECT_DELAY = timedelta(
+                seconds=int(settings["MAILROUND_WATCHER_RECONNECT_DELAY"]))
+
+        if "MAILROUND_CIRCUIT_FAILURE_THRESHOLD" in settings:
+            self.conf.CIRCUIT_FAILURE_THRESHOLD = int(settings["MAILROUND_CIRCUIT_FAILURE_THRESHOLD"])
+
+        if "MAILROUND_CIRCUIT_OPEN_DELAY" in settings:
+            self.conf.CIRCUIT_OPEN_DELAY = timedelta(seconds=int(settings["MAILROUND_CIRCUIT_OPEN_DELAY"]))
+
+        if "MAILROUND_CIRCUIT_MAX_DELAY" in settings:
+            self.conf.CIRCUIT_MAX_DELAY = timedelta(seconds=int(settings["MAILROUND_CIRCUIT_MAX_DELAY"]))
+
+        if "MAILROUND_CIRCUIT_PROBE_TIMEOUT" in settings:
+            self.conf.CIRCUIT_PROBE_TIMEOUT = timedelta(seconds=int(settings["MAILROUND_CIRCUIT_PROBE_TIMEOUT"]))
+
+        if "MAILROUND_TLS_VERIFY" in settings:
+            self.conf.TLS_VERIFY = self.bool_parse(settings["MAILROUND_TLS_VERIFY"])
+
+        if "MAILROUND_DNS_CACHE_TTL" in settings:
+            self.conf.DNS_CACHE_TTL = timedelta(seconds=int(settings["MAILROUND_DNS_CACHE_TTL"]))
+
+        if "MAILROUND_HOST_MAX_CONCURRENT_LOGINS" in settings:
+            self.conf.HOST_MAX_CONCURRENT_LOGINS = int(settings["MAILROUND_HOST_MAX_CONCURRENT_LOGINS"])
+
+        if "MAILROUND_HOST_LOGIN_RATE" in settings:
+            self.conf.HOST_LOGIN_RATE = float(settings["MAILROUND_HOST_LOGIN_RATE"])
+
+        if "MAILROUND_HOST_LOGIN_BURST" in settings:
+            self.conf.HOST_LOGIN_BURST = int(settings["MAILROUND_HOST_LOGIN_BURST"])
+
+        if "MAILROUND_HOST_LOGIN_MAX_WAIT" in settings:
+            self.conf.HOST_LOGIN_MAX_WAIT = timedelta(seconds=int(settings["MAILROUND_HOST_LOGIN_MAX_WAIT"]))
+
+        if "MAILROUND_LATE_ARRIVAL_WINDOW" in settings:
+            self.conf.LATE_ARRIVAL_WINDOW = timedelta(seconds=int(settings["MAILROUND_LATE_ARRIVAL_WINDOW"]))
+
+        if "MAILROUND_LATE_ARRIVAL_SNAPSHOT_INTERVAL" in settings:
+            self.conf.LATE_ARRIVAL_SNAPSHOT_INTERVAL = timedelta(
+                seconds=int(settings["MAILROUND_LATE_ARRIVAL_SNAPSHOT_INTERVAL"]))
+
         if "MAILROUND_WEBHOOK_URL" in settings:
             self.conf.WEBHOOK_URL = settings["MAILROUND_WEBHOOK_URL"]
 
+        if "MAILROUND_METRICS_PORT" in settings:
+            self.conf.METRICS_PORT = int(settings["MAILROUND_METRICS_PORT"])
+
+        if "MAILROUND_METRICS_HOST" in settings:
+            self.conf.METRICS_HOST = settings["MAILROUND_METRICS_HOST"]
+
+        if "MAILROUND_PROFILE_SAMPLE_RATE" in settings:
+            self.conf.PROFILE_SAMPLE_RATE = float(settings["MAILROUND_PROFILE_SAMPLE_RATE"])
+
+        if "MAILROUND_PROFILE_PATH" in settings:
+            self.conf.PROFILE_PATH = settings["MAILROUND_PROFILE_PATH"]
+
+        if "MAILROUND_NOTIFY_QUEUE_SIZE" in settings:
+            self.conf.NOTIFY_QUEUE_SIZE = int(settings["MAILROUND_NOTIFY_QUEUE_SIZE"])
+
+        if "MAILROUND_NOTIFY_COALESCE_WINDOW" in settings:
+            self.conf.NOTIFY_COALESCE_WINDOW = timedelta(seconds=int(settings["MAILROUND_NOTIFY_COALESCE_WINDOW"]))
+
+        if "MAILROUND_NOTIFY_TIMEOUT" in settings:
+            self.conf.NOTIFY_TIMEOUT = timedelta(seconds=int(settings["MAILROUND_NOTIFY_TIMEOUT"]))
+
+        if "MAILROUND_NOTIFY_RETRIES" in settings:
+            self.conf.NOTIFY_RETRIES = int(settings["MAILROUND_NOTIFY_RETRIES"])
+
+        if "MAILROUND_NOTIFY_RETRY_DELAY" in settings:
+            self.conf.NOTIFY_RETRY_DELAY = timedelta(seconds=int(settings["MAILROUND_NOTIFY_RETRY_DELAY"]))
+
+        if "MAILROUND_NOTIFY_RETRY_MAX_DELAY" in settings:
+            self.conf.NOTIFY_RETRY_MAX_DELAY = timedelta(seconds=int(settings["MAILROUND_NOTIFY_RETRY_MAX_DELAY"]))
+
         if "MAILROUND_DEBUG" in settings:
             self.conf.DEBUG = self.bool_parse(settings["MAILROUND_DEBUG"])
 
         if "MAILROUND_STATUS_LOG_PATH" in settings:
             self.conf.STATUS_LOG_PATH = settings["MAILROUND_STATUS_LOG_PATH"]
 
+        if "MAILROUND_STATUS_LOG_SEGMENT_SIZE" in settings:
+            self.conf.STATUS_LOG_SEGMENT_SIZE = int(settings["MAILROUND_STATUS_LOG_SEGMENT_SIZE"])
+
+        if "MAILROUND_STATUS_LOG_QUEUE_SIZE" in settings:
+            self.conf.STATUS_LOG_QUEUE_SIZE = int(settings["MAILROUND_STATUS_LOG_QUEUE_SIZE"])
+
+        if "MAILROUND_STATUS_LOG_QUEUE_POLICY" in settings:
+            self.conf.STATUS_LOG_QUEUE_POLICY = settings["MAILROUND_STATUS_LOG_QUEUE_POLICY"]
+
+        if "MAILROUND_STATUS_LOG_QUEUE_TIMEOUT" in settings:
+            self.conf.STATUS_LOG_QUEUE_TIMEOUT = timedelta(seconds=int(settings["MAILROUND_STATUS_LOG_QUEUE_TIMEOUT"]))
+
+        if "MAILROUND_STATUS_LOG_BATCH_SIZE" in settings:
+            self.conf.STATUS_LOG_BATCH_SIZE = int(settings["MAILROUND_STATUS_LOG_BATCH_SIZE"])
+
+        if "MAILROUND_STATUS_LOG_SEGMENT_MAX_AGE" in settings:
+            self.conf.STATUS_LOG_SEGMENT_MAX_AGE = timedelta(
+                seconds=int(settings["MAILROUND_STATUS_LOG_SEGMENT_MAX_AGE"]))
+
+        if "MAILROUND_STATUS_LOG_BATCH_DELAY" in settings:
+            self.conf.STATUS_LOG_BATCH_DELAY = timedelta(seconds=float(settings["MAILROUND_STATUS_LOG_BATCH_DELAY"]))
+
+        if "MAILROUND_STATUS_LOG_MAX_AGE" in settings:
+            self.conf.STATUS_LOG_MAX_AGE = timedelta(seconds=int(settings["MAILROUND_STATUS_LOG_MAX_AGE"]))
+
+        if "MAILROUND_STATUS_LOG_MAX_ROUNDS" in settings:
+            self.conf.STATUS_LOG_MAX_ROUNDS = int(settings["MAILROUND_STATUS_LOG_MAX_ROUNDS"])
+
+        if "MAILROUND_STATUS_LOG_SUMMARY_INTERVAL" in settings:
+            self.conf.STATUS_LOG_SUMMARY_INTERVAL = timedelta(
+                seconds=int(settings["MAILROUND_STATUS_LOG_SUMMARY_INTERVAL"]))
+
+        if "MAILROUND_STATUS_LOG_SUMMARY_MAX_AGE" in settings:
+            self.conf.STATUS_LOG_SUMMARY_MAX_AGE = timedelta(
+                seconds=int(settings["MAILROUND_STATUS_LOG_SUMMARY_MAX_AGE"]))
+
+        if "MAILROUND_STATUS_LOG_CLEANUP_INTERVAL" in settings:
+            self.conf.STATUS_LOG_CLEANUP_INTERVAL = timedelta(
+                seconds=int(settings["MAILROUND_STATUS_LOG_CLEANUP_INTERVAL"]))
+
+        if "MAILROUND_SHARD_WORKERS" in settings:
+            self.conf.SHARD_WORKERS = int(settings["MAILROUND_SHARD_WORKERS"])
+
+        if "MAILROUND_SHARD_NAME" in settings:
+            self.conf.SHARD_NAME = settings["MAILROUND_SHARD_NAME"]
+
+        if "MAILROUND_SHARD_DIRECTORY" in settings:
+            self.conf.SHARD_DIRECTORY = settings["MAILROUND_SHARD_DIRECTORY"]
+
+        if "MAILROUND_SHARD_REFRESH_INTERVAL" in settings:
+            self.conf.SHARD_REFRESH_INTERVAL = timedelta(seconds=int(settings["MAILROUND_SHARD_REFRESH_INTERVAL"]))
+
+        if "MAILROUND_SHARD_MERGE_INTERVAL" in settings:
+            self.conf.SHARD_MERGE_INTERVAL = timedelta(seconds=int(settings["MAILROUND_SHARD_MERGE_INTERVAL"]))
+
+        if "MAILROUND_CONFIG_FILE" in settings:
+            self.conf.CONFIG_FILE = settings["MAILROUND_CONFIG_FILE"]
+
+        if "MAILROUND_CONFIG_RELOAD_INTERVAL" in settings:
+            self.conf.CONFIG_RELOAD_INTERVAL = timedelta(seconds=int(settings["MAILROUND_CONFIG_RELOAD_INTERVAL"]))
+
         if "MAILROUND_CLEANUP" in settings:
             self.conf.CLEANUP = self.bool_parse(settings["MAILROUND_CLEANUP"])
 
@@ -59,7 +229,13 @@ class LoadEnvironment:
 
             for pair in pair_list:
                 send, to = pair.split(":")
-                self.conf.MAIL_ROUND[send] = to
+                # optional own interval in seconds eg. vps2:vps1@300
+                interval = None
+                if "@" in to:
+                    to, interval = to.split("@")
+                    interval = timedelta(seconds=int(interval))
+                # several inbox servers are a fan-out round eg. vps2:vps1,vps3
+                self.conf.add_round(send, to.split(","), interval)
 
     def bool_parse(self, value):
         if str(value).lower() in [1, "true", "yes", "y", "ja", "j", "wahr", "w"]:
@@ -1,12 +1,193 @@
+import contextlib
 import logging
+import poplib
 import smtplib
+import socket
 import ssl
+import threading
+import time
 
+from config.transport import DnsCache, HostLimiter, ServerTlsContext, open_connection
+from controller.spans import span
 from imapclient import IMAPClient
 
 log = logging.getLogger("mailround.config")
 
 
+class PooledConnection:
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.last_used = time.monotonic()
+
+
+class ConnectionPoolTimeout(TimeoutError):
+    """
+    All connections of a host were in use for longer than CONNECTION_POOL_WAIT_TIMEOUT
+    """
+
+
+class ConnectionPool:
+    instance = False
+
+    @staticmethod
+    def get_instance():
+        if not ConnectionPool.instance:
+            from config import settings
+            ConnectionPool.instance = ConnectionPool(settings.CONNECTION_POOL_MAX_IDLE.total_seconds(),
+                                                     settings.CONNECTION_POOL_CHECK_AFTER.total_seconds(),
+                                                     settings.CONNECTION_POOL_MAX_PER_HOST,
+                                                     settings.CONNECTION_POOL_WAIT_TIMEOUT.total_seconds())
+        return ConnectionPool.instance
+
+    def __init__(self, max_idle, check_after, max_per_host, wait_timeout):
+        """
+        Keep authenticated SMTP and IMAP sessions for reuse
+        Connections are closed (QUIT/LOGOUT) outside of the lock, a slow server does not block the other hosts
+        :param max_idle: seconds after which an unused connection is closed
+        :param check_after: seconds after which an unused connection is checked with NOOP before reuse
+        :param max_per_host: maximal number of open connections (in use and idle) per host
+        :param wait_timeout: seconds a lease waits for a free connection of its host before ConnectionPoolTimeout
+        """
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.max_per_host = max_per_host
+        self.wait_timeout = wait_timeout
+        # pool key -> list of idle PooledConnection
+        self._idle = {}
+        # host -> number of open connections
+        self._open = {}
+        self._changed = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self, server):
+        """
+        Lease a logged in connection of the given server
+        A connection which raised an error inside the block is closed instead of returned
+        :param server: MailServer object
+        """
+        pooled = self._acquire(server)
+        try:
+            yield pooled.conn
+        except Exception:
+            self._discard(pooled)
+            raise
+        else:
+            self._release(pooled)
+
+    def _acquire(self, server):
+        key = server.pool_key()
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            expired = []
+            # Idle connection of another account on the host, its slot is taken over by this lease
+            replaced = None
+            try:
+                with self._changed:
+                    # The slots of expired connections are free after they are closed, then try again
+                    expired = self._take_expired()
+
+                    while not expired:
+                        if self._idle.get(key):
+                            pooled = self._idle[key].pop()
+                            break
+                        if self._open.get(server.host, 0) < self.max_per_host:
+                            self._open[server.host] = self._open.get(server.host, 0) + 1
+                            pooled = None
+                            break
+                        replaced = self._take_idle_of_host(server.host)
+                        if replaced is not None:
+                            pooled = None
+                            break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise ConnectionPoolTimeout("All {} connections to {} are in use".format(
+                                self.max_per_host, server.host))
+                        self._changed.wait(remaining)
+            finally:
+                for other in expired:
+                    self._discard(other)
+            if expired:
+                continue
+
+            if pooled is None:
+                if replaced is not None:
+                    replaced.server.close_connection(replaced.conn)
+                try:
+                    return PooledConnection(server, server.get_connection())
+                except Exception:
+                    self._closed(server.host)
+                    raise
+
+            if time.monotonic() - pooled.last_used < self.check_after:
+                return pooled
+            with span("check"):
+                usable = server.check_connection(pooled.conn)
+            if usable:
+                return pooled
+
+            log.debug("Pooled connection to {} is broken. Reconnect".format(server.host))
+            self._discard(pooled)
+
+    def _release(self, pooled):
+        pooled.last_used = time.monotonic()
+        with self._changed:
+            self._idle.setdefault(pooled.server.pool_key(), []).append(pooled)
+            self._changed.notify()
+
+    def _discard(self, pooled):
+        pooled.server.close_connection(pooled.conn)
+        self._closed(pooled.server.host)
+
+    def _closed(self, host):
+        with self._changed:
+            self._open[host] = self._open.get(host, 1) - 1
+            self._changed.notify()
+
+    def _take_idle_of_host(self, host):
+        """
+        Remove the oldest idle connection of another account on the same host to make room
+        The caller holds the lock, closes the connection and keeps its slot
+        :return: PooledConnection or None
+        """
+        for key, idle in self._idle.items():
+            if idle and idle[0].server.host == host:
+                return idle.pop(0)
+        return None
+
+    def _take_expired(self):
+        """
+        Remove the connections which were idle longer than max_idle, the caller discards them without the lock
+        :return: list of PooledConnection
+        """
+        now = time.monotonic()
+        expired = []
+        for key, idle in self._idle.items():
+            for pooled in [pooled for pooled in idle if now - pooled.last_used > self.max_idle]:
+                idle.remove(pooled)
+                expired.append(pooled)
+        return expired
+
+    def close_server(self, server):
+        """
+        Close the idle connections of a server which is removed from the configuration
+        Connections which are in use are returned to the pool and expire after max_idle
+        """
+        with self._changed:
+            idle = self._idle.pop(server.pool_key(), [])
+        for pooled in idle:
+            self._discard(pooled)
+
+    def close_all(self):
+        with self._changed:
+            idle = [pooled for connections in self._idle.values() for pooled in connections]
+            self._idle = {}
+        for pooled in idle:
+            self._discard(pooled)
+
+
 class MailCredentials:
 
     def __init__(self, username, password):
@@ -19,7 +200,15 @@ class MailCredentials:
         self.password = password
 
 
+# How a connection with use_ssl is encrypted
+PLAIN = "plain"
+IMPLICIT_TLS = "tls"
+STARTTLS = "starttls"
+
+
 class MailServer:
+    # Start of the greeting of a ready server
+    GREETING = b""
 
     def __init__(self, host, port, use_ssl, email, credentials):
         """
@@ -39,39 +228,243 @@ class MailServer:
         else:
             raise ValueError("Given credentials arent a MailCredential Object")
 
+        self._tls_context = None
+        # None: not known yet, True: the port speaks plain text and is upgraded with STARTTLS, False: implicit TLS
+        self._starttls = None
 
-class MailPopServer(MailServer):
+    def pool_key(self):
+        return type(self).__name__, self.host, int(self.port), self.credentials.username
 
-    def __init__(self, *args, **kwargs):
-        raise NotImplemented("Pop Servers are currently not supported")
+    def config_key(self):
+        """
+        Two servers with the same key have the same configuration
+        """
+        return (type(self).__name__, self.host, int(self.port), bool(self.use_ssl), self.email,
+                self.credentials.username, self.credentials.password)
 
+    def connection(self):
+        """
+        Lease a pooled connection
+        usage: with server.connection() as conn:
+        """
+        return ConnectionPool.get_instance().connection(self)
 
-class MailImapServer(MailServer):
+    def tls_context(self):
+        """
+        SSLContext of this server, it is kept for all connections so their TLS sessions can be resumed
+        """
+        if self._tls_context is None:
+            from config import settings
+            self._tls_context = ServerTlsContext(self.host, settings.TLS_VERIFY)
+        return self._tls_context
 
     def get_connection(self):
         """
         Establish Connection with settings defined in this object
+        Connect and login hold a login slot of the host (HostLimiter), a wait for it raises LoginThrottled
+        The spans throttle (wait for the host), resolve (DNS), connect (TCP, greeting and TLS),
+        tls (handshake only) and auth are recorded
+        :return conn: logged in connection
+        """
+        with HostLimiter.get_instance().login(self.host):
+            with span("connect"):
+                conn = self._open()
+            try:
+                with span("auth"):
+                    self._login(conn)
+            except Exception:
+                self.close_connection(conn)
+                raise
+        if self.use_ssl:
+            # After the first responses the TLS 1.3 session ticket is there
+            self.tls_context().remember(self._socket(conn))
+        return conn
+
+    def _open(self):
+        """
+        With use_ssl the port is connected with implicit TLS first, if it speaks plain text the connection
+        is upgraded with STARTTLS. What worked is remembered. An unencrypted connection is never used.
+        """
+        if not self.use_ssl:
+            return open_connection(self.host, self.port, lambda address: self._connect(address, PLAIN))
+
+        if self._starttls is not True:
+            try:
+                conn = open_connection(self.host, self.port, lambda address: self._connect(address, IMPLICIT_TLS))
+                self._starttls = False
+                return conn
+            except ssl.SSLCertVerificationError:
+                raise
+            except ssl.SSLError as e:
+                if self._starttls is False:
+                    raise
+                log.info("{}:{} does not speak TLS ({}). Try STARTTLS".format(self.host, self.port, e))
+
+        conn = open_connection(self.host, self.port, lambda address: self._connect(address, STARTTLS))
+        self._starttls = True
+        return conn
+
+    def _connect(self, address, mode):
+        """
+        Open a connection to one address of the server
+        :param mode: PLAIN, IMPLICIT_TLS or STARTTLS
+        """
+        raise NotImplementedError()
+
+    def _login(self, conn):
+        raise NotImplementedError()
+
+    def _socket(self, conn):
+        raise NotImplementedError()
+
+    def probe(self, timeout):
+        """
+        Connect only check without login (TCP connect, TLS handshake and greeting of the server)
+        :param timeout: seconds
+        :return: True if the server is ready
+        """
+        with span("probe"):
+            if self.use_ssl and self._starttls is not True:
+                try:
+                    return self._probe(True, timeout)
+                except ssl.SSLError:
+                    if self._starttls is False:
+                        raise
+            # A STARTTLS port greets in plain text
+            return self._probe(False, timeout)
+
+    def _probe(self, use_ssl, timeout):
+        sock = open_connection(self.host, self.port,
+                               lambda address: socket.create_connection((address, int(self.port)), timeout=timeout))
+        try:
+            if use_ssl:
+                # Nothing secret is sent, the certificate is checked by the real connection
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock, server_hostname=self.host)
+            greeting = sock.recv(512)
+        finally:
+            sock.close()
+        return greeting.startswith(self.GREETING)
+
+    def check_connection(self, conn):
+        """
+        Check if a connection is still usable
+        :return: bool
+        """
+        try:
+            conn.noop()
+            return True
+        except Exception:
+            return False
+
+    def close_connection(self, conn):
+        raise NotImplementedError()
+
+
+class MailPopServer(MailServer):
+    GREETING = b"+OK"
+
+    def _connect(self, address, mode):
+        """
+        A POP3 session only sees the messages which were in the mailbox at login
+        :return conn: poplib POP3 Connection
+        """
+        if mode == IMPLICIT_TLS:
+            return poplib.POP3_SSL(address, int(self.port), context=self.tls_context())
+        conn = poplib.POP3(address, int(self.port))
+        if mode == STARTTLS:
+            try:
+                conn.stls(self.tls_context())
+            except Exception:
+                conn.close()
+                raise
+        return conn
+
+    def _login(self, conn):
+        conn.user(self.credentials.username)
+        conn.pass_(self.credentials.password)
+
+    def _socket(self, conn):
+        return conn.sock
+
+    def close_connection(self, conn):
+        try:
+            conn.quit()
+        except Exception:
+            pass
+
+
+class MailImapServer(MailServer):
+    GREETING = b"* "
+
+    def _connect(self, address, mode):
+        """
         :return conn: ImapClient Connection
         """
-        conn = IMAPClient(self.host, port=self.port, ssl=bool(self.use_ssl))
-        conn.login(self.credentials.username, self.credentials.password)
+        if mode == IMPLICIT_TLS:
+            conn = IMAPClient(address, port=self.port, ssl=True, ssl_context=self.tls_context())
+        else:
+            conn = IMAPClient(address, port=self.port, ssl=False)
+            if mode == STARTTLS:
+                try:
+                    conn.starttls(self.tls_context())
+                except Exception:
+                    conn.shutdown()
+                    raise
+        # imapclient writes a command in several parts, without TCP_NODELAY the last part waits
+        # for the delayed ACK of the server
+        conn.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return conn
 
+    def _login(self, conn):
+        conn.login(self.credentials.username, self.credentials.password)
+
+    def _socket(self, conn):
+        return conn.socket()
+
+    def close_connection(self, conn):
+        try:
+            conn.logout()
+        except Exception:
+            pass
+
 
 class MailSmtpServer(MailServer):
+    GREETING = b"220"
 
-    def get_connection(self):
+    def _connect(self, address, mode):
         """
-        Establish connection with settings defined in this object
         :return conn: SMTP Server connection
         """
-        if self.use_ssl:
+        # getfqdn() of smtplib asks the resolver on every connection
+        local_hostname = DnsCache.get_instance().local_hostname()
+        if mode == IMPLICIT_TLS:
+            return smtplib.SMTP_SSL(address, self.port, local_hostname=local_hostname, context=self.tls_context())
+        conn = smtplib.SMTP(address, self.port, local_hostname=local_hostname)
+        if mode == STARTTLS:
             try:
-                conn = smtplib.SMTP_SSL(self.host, self.port)
-            except ssl.SSLError:
-                conn = smtplib.SMTP(self.host, self.port)
-        else:
-            conn = smtplib.SMTP(self.host, self.port)
+                conn.starttls(context=self.tls_context())
+            except Exception:
+                conn.close()
+                raise
+        return conn
 
+    def _login(self, conn):
         conn.login(self.credentials.username, self.credentials.password)
-        return conn
+
+    def _socket(self, conn):
+        return conn.sock
+
+    def check_connection(self, conn):
+        try:
+            return conn.noop()[0] == 250
+        except Exception:
+            return False
+
+    def close_connection(self, conn):
+        try:
+            conn.quit()
+        except Exception:
+            pass
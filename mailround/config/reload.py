@@ -0,0 +1,155 @@
+import logging
+import os
+import time
+
+from config.config import load_configuration
+
+log = logging.getLogger("mailround.config")
+
+# Settings which are compared by ConfigDiff instead of being copied
+SERVER_SETTINGS = ["MAIL_IN_SERVER", "MAIL_OUT_SERVER", "MAIL_ROUND", "ROUND_INTERVAL"]
+
+
+def setting_names(conf):
+    return {name for name in list(vars(type(conf))) + list(vars(conf)) if name.isupper()}
+
+
+class ConfigDiff:
+
+    def __init__(self, old, new):
+        """
+        Changes between two configurations
+        A server with a changed configuration is removed and added again,
+        a round is removed and added again when its interval or one of its servers changed
+        :param old: Configuration
+        :param new: Configuration
+        """
+        # name -> server object
+        self.removed_in = self._removed(old.MAIL_IN_SERVER, new.MAIL_IN_SERVER)
+        self.removed_out = self._removed(old.MAIL_OUT_SERVER, new.MAIL_OUT_SERVER)
+        self.added_in = self._removed(new.MAIL_IN_SERVER, old.MAIL_IN_SERVER)
+        self.added_out = self._removed(new.MAIL_OUT_SERVER, old.MAIL_OUT_SERVER)
+
+        old_rounds = old.get_round_intervals()
+        new_rounds = new.get_round_intervals()
+        changed = set(self.removed_out) | set(self.removed_in)
+
+        def unchanged(key, rounds):
+            outname, innames = key
+            return key in rounds and old_rounds.get(key) == new_rounds.get(key) and outname not in changed and \
+                not changed.intersection(innames)
+
+        # (outname, tuple of innames) -> interval in seconds
+        self.removed_rounds = {key: interval for key, interval in old_rounds.items()
+                               if not unchanged(key, new_rounds)}
+        self.added_rounds = {key: interval for key, interval in new_rounds.items()
+                             if not unchanged(key, old_rounds)}
+
+        # Other settings which changed: name -> new value
+        self.settings = {}
+        for name in setting_names(old) | setting_names(new):
+            if name not in SERVER_SETTINGS and getattr(old, name, None) != getattr(new, name, None):
+                self.settings[name] = getattr(new, name, None)
+
+    def _removed(self, old, new):
+        return {name: server for name, server in old.items()
+                if name not in new or new[name].config_key() != server.config_key()}
+
+    def __bool__(self):
+        return bool(self.removed_in or self.removed_out or self.added_in or self.added_out or
+                    self.removed_rounds or self.added_rounds or self.settings)
+
+    def describe(self):
+        """
+        :return: list of log lines
+        """
+        lines = []
+        for action, servers in [("Remove", self.removed_in), ("Remove", self.removed_out),
+                                ("Add", self.added_in), ("Add", self.added_out)]:
+            for name in sorted(servers):
+                lines.append("{} server {}".format(action, name))
+        for action, rounds in [("Remove", self.removed_rounds), ("Add", self.added_rounds)]:
+            for outname, innames in sorted(rounds):
+                lines.append("{} round {} -> {}".format(action, outname, ",".join(innames)))
+        for name in sorted(self.settings):
+            lines.append("Change {}".format(name))
+        return lines
+
+
+class ConfigReloader:
+
+    def __init__(self, settings):
+        """
+        Reload the configuration into the running settings object
+        Only what changed between the last loaded and the new configuration is applied to settings,
+        so values which were set at runtime (eg. by command line options) are kept
+        :param settings: Configuration which is used by the application
+        """
+        self.settings = settings
+        self.loaded = load_configuration()
+        self._next_poll = 0
+        self._stat = self._file_stat()
+
+    def _file_stat(self):
+        if not self.settings.CONFIG_FILE:
+            return None
+        try:
+            stat = os.stat(self.settings.CONFIG_FILE)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def time_until_poll(self, now=None):
+        """
+        Seconds until the config file should be checked again (None without config file)
+        """
+        if not self.settings.CONFIG_FILE:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._next_poll - now)
+
+    def changed(self, now=None):
+        """
+        Check at most every CONFIG_RELOAD_INTERVAL if the config file was modified
+        :return: bool
+        """
+        now = time.monotonic() if now is None else now
+        if not self.settings.CONFIG_FILE or now < self._next_poll:
+            return False
+        self._next_poll = now + self.settings.CONFIG_RELOAD_INTERVAL.total_seconds()
+
+        stat = self._file_stat()
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+    def reload(self):
+        """
+        Load the configuration again and apply the changes to settings
+        An invalid configuration raises an exception and nothing is changed
+        :return: ConfigDiff
+        """
+        self._stat = self._file_stat()
+        new = load_configuration()
+        diff = ConfigDiff(self.loaded, new)
+
+        settings = self.settings
+        for name, value in diff.settings.items():
+            setattr(settings, name, value)
+
+        # Unchanged servers keep their object, so running rounds and pooled connections stay valid
+        # Other threads may iterate the old dicts, so they are replaced instead of changed
+        for name, removed, added in [("MAIL_IN_SERVER", diff.removed_in, diff.added_in),
+                                     ("MAIL_OUT_SERVER", diff.removed_out, diff.added_out)]:
+            servers = {server_name: server for server_name, server in getattr(settings, name).items()
+                       if server_name not in removed}
+            servers.update(added)
+            setattr(settings, name, servers)
+        settings.MAIL_ROUND = new.MAIL_ROUND
+        settings.ROUND_INTERVAL = new.ROUND_INTERVAL
+
+        self.loaded = new
+        for line in diff.describe():
+            log.info(line)
+        return diff
@@ -0,0 +1,362 @@
+import contextlib
+import logging
+import socket
+import ssl
+import threading
+import time
+
+from controller.spans import add_span, span
+
+log = logging.getLogger("mailround.config")
+
+
+class DnsCache:
+    instance = False
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with DnsCache._instance_lock:
+            if not DnsCache.instance:
+                from config import settings
+                from controller.metrics import register_collector
+                DnsCache.instance = DnsCache(settings.DNS_CACHE_TTL.total_seconds())
+                register_collector(DnsCache.instance.metrics)
+                register_collector(tls_metrics)
+            return DnsCache.instance
+
+    def __init__(self, ttl):
+        """
+        Keep the addresses of the mail server hosts, so a new connection does not wait for the resolver
+        getaddrinfo does not return the TTL of the records, every entry is kept for ttl seconds
+        :param ttl: seconds (0 disables the cache)
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (host, port) -> (expiry time, list of addresses)
+        self._entries = {}
+
+        self._local_hostname = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def local_hostname(self):
+        """
+        Fully qualified name of this host for EHLO, it is looked up once
+        """
+        if self._local_hostname is None:
+            self._local_hostname = socket.getfqdn()
+        return self._local_hostname
+
+    def resolve(self, host, port):
+        """
+        :return: list of addresses of the host, the address which connected last is first
+        """
+        key = (host, int(port))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+
+        with span("resolve"):
+            infos = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
+        addresses = []
+        for family, kind, proto, canonname, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def prefer(self, host, port, address):
+        """
+        Try the address which connected first next time
+        """
+        with self._lock:
+            entry = self._entries.get((host, int(port)))
+            if entry is not None and entry[1] and entry[1][0] != address and address in entry[1]:
+                self._entries[(host, int(port))] = (entry[0], [address] + [other for other in entry[1]
+                                                                          if other != address])
+
+    def invalidate(self, host, port):
+        """
+        Resolve the host again next time (eg. after no address could be reached)
+        """
+        with self._lock:
+            self._entries.pop((host, int(port)), None)
+
+    def metrics(self):
+        return [
+            "# TYPE mailround_dns_cache_hits_total counter",
+            "mailround_dns_cache_hits_total {}".format(self.hits),
+            "# TYPE mailround_dns_cache_misses_total counter",
+            "mailround_dns_cache_misses_total {}".format(self.misses),
+        ]
+
+
+def open_connection(host, port, connect):
+    """
+    Connect to the cached addresses of a host one after another
+    :param connect: callable(address) which opens the connection, errors of the TLS handshake are not retried
+    :return: result of connect
+    """
+    cache = DnsCache.get_instance()
+    addresses = cache.resolve(host, port)
+    error = OSError("No address for {}".format(host))
+    for address in addresses:
+        try:
+            conn = connect(address)
+        except ssl.SSLError:
+            raise
+        except OSError as e:
+            log.debug("Could not connect to {} ({}): {}".format(host, address, e))
+            error = e
+            continue
+        cache.prefer(host, port, address)
+        return conn
+
+    cache.invalidate(host, port)
+    raise error
+
+
+# Handshakes of all ServerTlsContext objects by "full" and "resumed"
+_handshakes = {"full": 0, "resumed": 0}
+
+
+class ServerTlsContext(ssl.SSLContext):
+    """
+    SSLContext of one mail server
+    The certificate is checked against the configured hostname even though the connection is opened to a cached
+    address, and the TLS session of the last connection is offered for resumption (saves a round trip and the
+    key exchange). The handshake is recorded as "tls" span.
+    """
+
+    def __new__(cls, hostname, verify=True):
+        return super(ServerTlsContext, cls).__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, hostname, verify=True):
+        """
+        :param hostname: configured hostname of the server
+        :param verify: check the certificate of the server
+        """
+        self.hostname = hostname
+        self.session = None
+        if verify:
+            self.load_default_certs()
+        else:
+            self.check_hostname = False
+            self.verify_mode = ssl.CERT_NONE
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        with span("tls"):
+            wrapped = super(ServerTlsContext, self).wrap_socket(
+                sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=self.hostname,
+                session=session or self.session)
+        _handshakes["resumed" if wrapped.session_reused else "full"] += 1
+        return wrapped
+
+    def remember(self, sock):
+        """
+        Keep the session of an established connection for the next one
+        Call it after the first response was read, with TLS 1.3 the session ticket arrives after the handshake
+        :param sock: socket of the connection
+        """
+        if isinstance(sock, ssl.SSLSocket) and sock.session is not None:
+            self.session = sock.session
+
+
+def tls_metrics():
+    return [
+        "# TYPE mailround_tls_handshakes_total counter",
+        'mailround_tls_handshakes_total{{session="full"}} {}'.format(_handshakes["full"]),
+        'mailround_tls_handshakes_total{{session="resumed"}} {}'.format(_handshakes["resumed"]),
+    ]
+
+
+class LoginThrottled(TimeoutError):
+    """
+    A login waited longer than HOST_LOGIN_MAX_WAIT for the limits of its host
+    """
+
+
+class HostLimit:
+
+    def __init__(self, host, concurrency, rate, burst):
+        """
+        Limits of the logins to one mail server host: a semaphore for the logins which run at the same time
+        and a token bucket for the login rate
+        :param host: configured hostname
+        :param concurrency: logins at the same time (0 does not limit them)
+        :param rate: logins per second (0 does not limit the rate)
+        :param burst: size of the token bucket
+        """
+        from controller.metrics import Histogram
+        self.host = host
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = max(1, burst)
+
+        self._changed = threading.Condition()
+        self.running = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+        # Statistics
+        self.logins = 0
+        self.waits = 0
+        self.throttled = 0
+        self.wait_histogram = Histogram()
+
+    def _refill(self, now):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout):
+        """
+        Wait for a token and then for a free login slot of the host
+        The token is reserved before sleeping for it, so waiting logins get their tokens in order.
+        A login which sleeps for its token does not hold a slot, the slots are only used by running logins
+        :param timeout: seconds
+        :return: seconds waited (0 if the login did not have to wait)
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = 0.0
+        if self.rate > 0:
+            with self._changed:
+                self._refill(start)
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = -self._tokens / self.rate
+                    if start + delay > deadline:
+                        self._tokens += 1
+                        self.throttled += 1
+                        raise LoginThrottled("Login rate of {} exceeded for {:.0f}s".format(self.host, timeout))
+            if delay:
+                time.sleep(delay)
+
+        blocked = False
+        with self._changed:
+            while self.concurrency and self.running >= self.concurrency:
+                blocked = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if self.rate > 0:
+                        # The token was not used
+                        self._tokens += 1
+                    self.throttled += 1
+                    raise LoginThrottled("No free login slot for {} after {:.0f}s".format(self.host, timeout))
+                self._changed.wait(remaining)
+            self.running += 1
+
+            waited = time.monotonic() - start if blocked or delay else 0.0
+            self.logins += 1
+            self.wait_histogram.observe(waited)
+            if waited:
+                self.waits += 1
+        return waited
+
+    def release(self):
+        with self._changed:
+            self.running -= 1
+            self._changed.notify()
+
+
+class HostLimiter:
+    instance = False
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with HostLimiter._instance_lock:
+            if not HostLimiter.instance:
+                from config import settings
+                from controller.metrics import register_collector
+                HostLimiter.instance = HostLimiter(settings.HOST_MAX_CONCURRENT_LOGINS, settings.HOST_LOGIN_RATE,
+                                                   settings.HOST_LOGIN_BURST,
+                                                   settings.HOST_LOGIN_MAX_WAIT.total_seconds())
+                register_collector(HostLimiter.instance.metrics)
+            return HostLimiter.instance
+
+    def __init__(self, concurrency, rate, burst, max_wait):
+        """
+        Limit the logins per mail server host, shared by the rounds, the mailbox watchers, the connection pool
+        and the full cleanup. Several mailboxes on one host no longer log in all at once at interval start
+        Waits are exported per host, so throttling can be told apart from a server which is down
+        :param concurrency: logins at the same time per host (0 does not limit them)
+        :param rate: logins per second per host (0 does not limit the rate)
+        :param burst: logins per host which run without waiting for the rate
+        :param max_wait: seconds after which a waiting login raises LoginThrottled
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        # lower case host -> HostLimit
+        self._limits = {}
+
+    def limit(self, host):
+        """
+        :return: HostLimit of the host
+        """
+        key = host.lower()
+        with self._lock:
+            limit = self._limits.get(key)
+            if limit is None:
+                limit = self._limits[key] = HostLimit(key, self.concurrency, self.rate, self.burst)
+            return limit
+
+    @contextlib.contextmanager
+    def login(self, host):
+        """
+        Hold a login slot of the host while connecting and logging in
+        usage: with HostLimiter.get_instance().login(server.host):
+        A wait is recorded as "throttle" span
+        """
+        limit = self.limit(host)
+        waited = limit.acquire(self.max_wait)
+        if waited:
+            add_span("throttle", waited)
+            log.debug("Login to {} waited {:.3f}s".format(host, waited))
+        try:
+            yield
+        finally:
+            limit.release()
+
+    def metrics(self):
+        from controller.metrics import escape_label, format_bound
+        with self._lock:
+            limits = sorted(self._limits.items())
+
+        lines = ["# TYPE mailround_host_logins_running gauge"]
+        for host, limit in limits:
+            lines.append('mailround_host_logins_running{{host="{}"}} {}'.format(escape_label(host), limit.running))
+        for name in ["logins", "waits", "throttled"]:
+            lines.append("# TYPE mailround_host_{}_total counter".format(name))
+            for host, limit in limits:
+                lines.append('mailround_host_{}_total{{host="{}"}} {}'.format(
+                    name, escape_label(host), getattr(limit, name)))
+
+        metric = "mailround_host_login_wait_seconds"
+        lines.append("# HELP {} Time a login waited for the limits of its host".format(metric))
+        lines.append("# TYPE {} histogram".format(metric))
+        for host, limit in limits:
+            labels = 'host="{}"'.format(escape_label(host))
+            with limit._changed:
+                cumulative = limit.wait_histogram.cumulative()
+                total, count = limit.wait_histogram.sum, limit.wait_histogram.count
+            for bound, value in cumulative:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, format_bound(bound), value))
+            lines.append("{}_sum{{{}}} {}".format(metric, labels, total))
+            lines.append("{}_count{{{}}} {}".format(metric, labels, count))
+        return lines
@@ -0,0 +1,201 @@
+import asyncio
+import concurrent.futures
+import logging
+import signal
+
+from config import settings
+from config.mail import ConnectionPool
+from config.reload import ConfigReloader
+from controller.health import ServerHealth
+from controller.mailbox import MailboxWatcher
+from controller.metrics import register_collector
+from controller.round_trip import RoundTrip
+from controller.scheduler import RoundScheduler
+
+log = logging.getLogger("mailround.controller.engine")
+
+
+class RoundEngine:
+
+    def __init__(self, shard=None):
+        """
+        Run all rounds as coroutines in one event loop
+        At most MAX_CONCURRENT_ROUNDS rounds are active at the same time and all blocking
+        SMTP/webhook calls share an executor with ROUND_EXECUTOR_WORKERS threads
+        :param shard: ShardCoordinator of a shard worker, only the rounds owned by this worker are started
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.ROUND_EXECUTOR_WORKERS,
+                                                              thread_name_prefix="round")
+        self._semaphore = None
+        # (outname, tuple of innames) -> asyncio.Task of the running round
+        self._running = {}
+        self._stop = False
+        self._wakeup = None
+        self._loop = None
+        self._reload = False
+        self.scheduler = None
+        self.reloader = None
+        self.shard = shard
+
+    def stop(self):
+        """
+        Stop scheduling new rounds (can be called from any thread)
+        """
+        self._stop = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def request_reload(self):
+        """
+        Reload the configuration before the next round is started (can be called from any thread)
+        """
+        self._reload = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def reload_config(self):
+        """
+        Apply a changed configuration without interrupting running rounds
+        Removed rounds are not scheduled again, removed servers lose their pooled connections and watchers
+        once their running rounds are finished. Added rounds are scheduled at once.
+        """
+        try:
+            diff = self.reloader.reload()
+        except Exception as e:
+            log.exception(e)
+            log.error("Could not reload the configuration. Keep the current one")
+            return
+
+        for key in diff.removed_rounds:
+            self.scheduler.remove(key)
+
+        pool = ConnectionPool.get_instance()
+        health = ServerHealth.get_instance()
+        for kind, servers in [("in", diff.removed_in), ("out", diff.removed_out)]:
+            for server_name, server in servers.items():
+                pool.close_server(server)
+                health.remove(kind, server_name)
+        for server_name in diff.removed_in:
+            MailboxWatcher.remove_instance(server_name)
+
+        self.scheduler.jitter = settings.SCHEDULE_JITTER.total_seconds()
+        for key, interval in diff.added_rounds.items():
+            self.scheduler.add(key, interval)
+
+    def create_round(self, outname, innames):
+        mailin = [settings.MAIL_IN_SERVER[inname] for inname in innames]
+        return RoundTrip(settings.MAIL_OUT_SERVER[outname], mailin, (outname, list(innames)))
+
+    def start_round(self, outname, innames, lag=0.0, regular=True):
+        """
+        Start one round unless the previous run of the same round is still running
+        Depending on SCHEDULE_OVERLAP such a round is skipped or retried every second
+        :param lag: delay between the scheduled and the real start in seconds
+        :param regular: started by a regular deadline, a retry does not count as another skip
+        :return: asyncio.Task or None if not started
+        """
+        if self.shard is not None and not self.shard.owns((outname, innames)):
+            return None
+
+        name = ",".join(innames)
+        task = self._running.get((outname, innames))
+        if task is not None and not task.done():
+            if settings.SCHEDULE_OVERLAP == "delay":
+                log.info("Previous round {} -> {} is still running. Delay".format(outname, name))
+                self.scheduler.delay((outname, innames), 1)
+            else:
+                log.warning("Previous round {} -> {} is still running. Skip".format(outname, name))
+            if regular:
+                self.scheduler.skipped += 1
+            return None
+
+        if lag > 1:
+            log.warning("Round {} -> {} starts {:.1f}s late".format(outname, name, lag))
+
+        round_trip = self.create_round(outname, innames)
+        round_trip.schedule_lag = lag
+        task = asyncio.ensure_future(self.run_round(round_trip))
+        self._running[(outname, innames)] = task
+        return task
+
+    def metrics(self):
+        """
+        Scheduler and engine metrics in the Prometheus text format
+        """
+        scheduler = self.scheduler
+        running = sum(1 for task in list(self._running.values()) if not task.done())
+        return [
+            "# TYPE mailround_rounds_running gauge",
+            "mailround_rounds_running {}".format(running),
+            "# TYPE mailround_rounds_dispatched_total counter",
+            "mailround_rounds_dispatched_total {}".format(scheduler.dispatched),
+            "# TYPE mailround_rounds_skipped_total counter",
+            "mailround_rounds_skipped_total {}".format(scheduler.skipped),
+            "# TYPE mailround_scheduler_lag_seconds gauge",
+            "mailround_scheduler_lag_seconds {}".format(scheduler.lag_last),
+            "# TYPE mailround_scheduler_lag_max_seconds gauge",
+            "mailround_scheduler_lag_max_seconds {}".format(scheduler.lag_max),
+        ]
+
+    async def run_round(self, round_trip):
+        async with self._semaphore:
+            try:
+                await round_trip.run_async(self.executor)
+            except Exception as e:
+                log.exception(e)
+
+    async def main(self):
+        self._semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_ROUNDS)
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_event_loop()
+        if self.scheduler is None:
+            self.scheduler = RoundScheduler.from_settings()
+        if self.reloader is None:
+            self.reloader = ConfigReloader(settings)
+        register_collector(self.metrics)
+
+        sighup = getattr(signal, "SIGHUP", None)
+        try:
+            self._loop.add_signal_handler(sighup, self.request_reload)
+        except (TypeError, ValueError, NotImplementedError, RuntimeError):
+            # No SIGHUP (Windows) or the engine does not run in the main thread
+            sighup = None
+
+        while not self._stop:
+            if self._reload or self.reloader.changed():
+                self._reload = False
+                self.reload_config()
+
+            if self.shard is not None and self.shard.time_until_refresh() <= 0:
+                busy = {key for key, task in self._running.items() if not task.done()}
+                self.shard.refresh(list(self.scheduler.intervals), busy)
+
+            for (outname, innames), lag, regular in self.scheduler.pop_due():
+                self.start_round(outname, innames, lag, regular)
+
+            # Sleep until the next deadline, the next check of the config file or until stop() is called
+            timeouts = [self.scheduler.time_until_next(), self.reloader.time_until_poll()]
+            if self.shard is not None:
+                timeouts.append(self.shard.time_until_refresh())
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(timeouts) if timeouts else None)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+        if sighup is not None:
+            self._loop.remove_signal_handler(sighup)
+
+        running = [task for task in self._running.values() if not task.done()]
+        if running:
+            await asyncio.wait(running)
+
+    def run_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            self.executor.shutdown(wait=True)
+            loop.close()
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+
+from config import settings
+from controller.metrics import escape_label, register_collector
+
+log = logging.getLogger("mailround.controller.health")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+# What a round should do with a server
+RUN = "run"
+PROBE = "probe"
+SKIP = "skip"
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, threshold, open_delay, max_delay):
+        """
+        Health state of one mail server
+        closed: rounds run normally, after threshold failed rounds in a row the circuit opens
+        open: rounds are skipped, after the backoff delay one round probes the server with a connect only
+        half_open: the probe succeeded, the next round is a full trial which closes or opens the circuit again
+        The backoff delay doubles after every failed probe or trial up to max_delay
+        :param name: Name of the server
+        :param threshold: failed rounds in a row which open the circuit (0 never opens it)
+        :param open_delay: first backoff delay in seconds
+        :param max_delay: maximal backoff delay in seconds
+        """
+        self.name = name
+        self.threshold = threshold
+        self.open_delay = open_delay
+        self.max_delay = max_delay
+
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = open_delay
+        self.next_probe = 0.0
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.opened = 0
+        self.probes = 0
+        self.skipped = 0
+
+    def decide(self, now=None):
+        """
+        :return: RUN, PROBE or SKIP
+                 Only one round gets PROBE when the backoff delay is over
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state != OPEN:
+                return RUN
+            if now < self.next_probe:
+                self.skipped += 1
+                return SKIP
+            # Other rounds wait for the result of this probe
+            self.next_probe = now + self.delay
+            self.probes += 1
+            return PROBE
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.info("Server {} is reachable again. Close circuit".format(self.name))
+            self.state = CLOSED
+            self.failures = 0
+            self.delay = self.open_delay
+
+    def failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self._open(now, self.delay * 2)
+            elif self.state == CLOSED and self.threshold and self.failures >= self.threshold:
+                self._open(now, self.open_delay)
+
+    def probe_result(self, reachable, now=None):
+        """
+        Result of the connect only probe of an open circuit
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state != OPEN:
+                return
+            if reachable:
+                log.info("Probe of {} succeeded. Next round is a trial".format(self.name))
+                self.state = HALF_OPEN
+            else:
+                self.failures += 1
+                self._open(now, self.delay * 2)
+
+    def _open(self, now, delay):
+        self.delay = min(delay, self.max_delay)
+        self.next_probe = now + self.delay
+        if self.state != OPEN:
+            self.opened += 1
+        self.state = OPEN
+        log.warning("Server {} failed {} times in a row. Open circuit, next probe in {:.0f}s".format(
+            self.name, self.failures, self.delay))
+
+
+class ServerHealth:
+    instance = False
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with ServerHealth._instance_lock:
+            if not ServerHealth.instance:
+                ServerHealth.instance = ServerHealth()
+                register_collector(ServerHealth.instance.metrics)
+            return ServerHealth.instance
+
+    def __init__(self):
+        """
+        Circuit breakers of all mail servers, inbox and outgoing servers are separate even with the same name
+        """
+        self._lock = threading.Lock()
+        # (kind, server name) -> CircuitBreaker
+        self.breakers = {}
+
+    def breaker(self, kind, server_name):
+        """
+        :param kind: "in" or "out"
+        :return: CircuitBreaker
+        """
+        key = (kind, server_name)
+        with self._lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = CircuitBreaker(
+                    server_name, settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_OPEN_DELAY.total_seconds(),
+                    settings.CIRCUIT_MAX_DELAY.total_seconds())
+            return breaker
+
+    def remove(self, kind, server_name):
+        """
+        Forget the state of a server which is removed from the configuration
+        """
+        with self._lock:
+            self.breakers.pop((kind, server_name), None)
+
+    def metrics(self):
+        """
+        Circuit breaker metrics in the Prometheus text format
+        """
+        with self._lock:
+            breakers = sorted(self.breakers.items())
+
+        lines = ["# TYPE mailround_circuit_state gauge"]
+        for (kind, server_name), breaker in breakers:
+            for state in STATES:
+                lines.append('mailround_circuit_state{{kind="{}",server="{}",state="{}"}} {}'.format(
+                    kind, escape_label(server_name), state, int(breaker.state == state)))
+        for name in ["opened", "probes", "skipped"]:
+            lines.append("# TYPE mailround_circuit_{}_total counter".format(name))
+            for (kind, server_name), breaker in breakers:
+                lines.append('mailround_circuit_{}_total{{kind="{}",server="{}"}} {}'.format(
+                    name, kind, escape_label(server_name), getattr(breaker, name)))
+        return lines
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+
+import msgpack
+from config import settings
+from controller.metrics import register_collector
+
+log = logging.getLogger("mailround.controller.latearrival")
+
+SNAPSHOT_VERSION = 1
+
+
+class SentMail:
+    __slots__ = ("sent", "outname", "innames", "ended")
+
+    def __init__(self, sent, outname, innames, ended=False):
+        """
+        Test mail which did not arrive in all of its inboxes yet
+        :param sent: time.time() when the test mail was handed to the SMTP server
+        :param outname: Name of the outgoing server
+        :param innames: set of the names of the inboxes which still expect the test mail
+        :param ended: the round stopped waiting for the test mail
+        """
+        self.sent = sent
+        self.outname = outname
+        self.innames = innames
+        self.ended = ended
+
+
+class SentMailIndex:
+    instance = False
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with SentMailIndex._instance_lock:
+            if not SentMailIndex.instance:
+                SentMailIndex.instance = SentMailIndex("{}.sent".format(settings.STATUS_LOG_PATH),
+                                                       settings.LATE_ARRIVAL_WINDOW.total_seconds(),
+                                                       settings.LATE_ARRIVAL_SNAPSHOT_INTERVAL.total_seconds())
+                register_collector(SentMailIndex.instance.metrics)
+            return SentMailIndex.instance
+
+    def __init__(self, path, window, snapshot_interval):
+        """
+        Remember the test mails of recent rounds, so a test mail which arrives after its round ended
+        is attributed to that round instead of being left in the inbox
+        The index is kept in memory and written to a snapshot file at most every snapshot_interval
+        :param path: snapshot file (None keeps the index in memory only)
+        :param window: seconds after sending in which a test mail is expected at all
+        :param snapshot_interval: seconds between two snapshots
+        """
+        self.path = path
+        self.window = window
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.Lock()
+        # uuid -> SentMail
+        self._sent = {}
+        self._dirty = False
+        self._next_snapshot = time.monotonic() + snapshot_interval
+        self.load()
+
+    def __len__(self):
+        return len(self._sent)
+
+    def add(self, uuid, outname, innames, sent):
+        """
+        Remember a test mail after it was sent
+        :param innames: names of the inboxes which should receive it
+        """
+        with self._lock:
+            self._sent[uuid] = SentMail(sent, outname, set(innames))
+            self._dirty = True
+        self.maybe_save()
+
+    def arrived(self, uuid, inname):
+        """
+        The round found its test mail in time, nothing more is expected from this inbox
+        """
+        with self._lock:
+            self._discard(uuid, inname)
+
+    def ended(self, uuid):
+        """
+        The round stopped waiting, from now on its test mail is a late arrival
+        """
+        with self._lock:
+            mail = self._sent.get(uuid)
+            if mail is not None:
+                mail.ended = True
+
+    def late_arrival(self, uuid, inname):
+        """
+        Check if a test mail of an ended round arrived
+        :return: SentMail or None if the test mail is unknown (eg. sent by another MailRound instance)
+                 or its round is still waiting (eg. at the watcher which replaced this one after a reload)
+        """
+        with self._lock:
+            mail = self._sent.get(uuid)
+            if mail is None or not mail.ended or inname not in mail.innames:
+                return None
+            self._discard(uuid, inname)
+        return mail
+
+    def _discard(self, uuid, inname):
+        mail = self._sent.get(uuid)
+        if mail is None:
+            return
+        mail.innames.discard(inname)
+        if not mail.innames:
+            del self._sent[uuid]
+        self._dirty = True
+
+    def expire(self, now=None):
+        """
+        Forget test mails which are older than the window
+        :return: number of forgotten test mails
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [uuid for uuid, mail in self._sent.items() if now - mail.sent > self.window]
+            for uuid in expired:
+                del self._sent[uuid]
+            if expired:
+                self._dirty = True
+        return len(expired)
+
+    def maybe_save(self):
+        if time.monotonic() >= self._next_snapshot:
+            self.save()
+
+    def save(self):
+        """
+        Write the snapshot if something changed since the last one
+        The file is replaced atomically, a crash leaves the previous snapshot
+        """
+        self._next_snapshot = time.monotonic() + self.snapshot_interval
+        if self.path is None or not self._dirty:
+            return
+        self.expire()
+
+        with self._lock:
+            data = msgpack.packb({
+                "version": SNAPSHOT_VERSION,
+                "sent": {uuid: [mail.sent, mail.outname, sorted(mail.innames)] for uuid, mail in self._sent.items()},
+            }, use_bin_type=True)
+            self._dirty = False
+
+        temporary = "{}.tmp".format(self.path)
+        try:
+            with open(temporary, "wb") as fobj:
+                fobj.write(data)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.replace(temporary, self.path)
+        except OSError as e:
+            log.error("Could not write the snapshot of sent test mails {}: {}".format(self.path, e))
+            self._dirty = True
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as fobj:
+                data = msgpack.unpackb(fobj.read(), raw=False)
+            if data.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("unknown version {}".format(data.get("version")))
+            # The rounds of a previous run have ended
+            sent = {uuid: SentMail(entry[0], entry[1], set(entry[2]), True) for uuid, entry in data["sent"].items()}
+        except Exception as e:
+            log.error("Ignore the snapshot of sent test mails {}: {}".format(self.path, e))
+            return
+
+        with self._lock:
+            self._sent.update(sent)
+        expired = self.expire()
+        log.debug("Loaded {} sent test mails ({} expired)".format(len(sent), expired))
+
+    def metrics(self):
+        return [
+            "# TYPE mailround_sent_index_size gauge",
+            "mailround_sent_index_size {}".format(len(self._sent)),
+        ]
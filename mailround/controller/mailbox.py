@@ -0,0 +1,646 @@
+import concurrent.futures
+import datetime
+import email.parser
+import logging
+import threading
+import time
+
+from config import settings
+from config.mail import MailPopServer
+from config.transport import LoginThrottled
+from controller.latearrival import SentMailIndex
+from controller.spans import SpanRecorder, recording
+from controller.statuslog import StatusLog
+
+log = logging.getLogger("mailround.controller.mailbox")
+
+MAIL_ROUND_HEADER = "X-Mail-Round"
+
+# Shard worker which sent the test mail
+MAIL_ROUND_WORKER_HEADER = "X-Mail-Round-Worker"
+
+FETCH_MAIL_ROUND_HEADER = "BODY.PEEK[HEADER.FIELDS ({} {})]".format(MAIL_ROUND_HEADER.upper(),
+                                                                    MAIL_ROUND_WORKER_HEADER.upper())
+
+# Number of messages per FETCH command when a whole folder is inspected
+FETCH_CHUNK_SIZE = 1000
+
+
+def search_candidates(conn):
+    """
+    Find the messages which could be MailRound test mails
+    The IMAP server searches for the header. If the server does not support header search
+    all messages since yesterday are candidates.
+    :param conn: ImapClient Connection with the folder selected
+    :return: list of message uids
+    """
+    try:
+        return conn.search(["HEADER", MAIL_ROUND_HEADER, ""])
+    except conn.Error as e:
+        log.debug("Header search not supported ({}). Fallback to date search".format(e))
+
+    since = datetime.date.today() - datetime.timedelta(days=1)
+    return conn.search(["SINCE", since])
+
+
+def parse_mailround_header(data, worker=None):
+    """
+    Extract the X-Mail-Round values of one fetch response
+    :param data: fetch response of one message
+    :param worker: see parse_header_values
+    :return: list of uuids (empty if the message is no MailRound test mail)
+    """
+    header = None
+    for key, value in data.items():
+        if key.startswith(b"BODY[HEADER.FIELDS") or key == b"RFC822":
+            header = value
+    if header is None:
+        return []
+    return parse_header_values(header, worker)
+
+
+def parse_header_values(header, worker=None):
+    """
+    Extract the X-Mail-Round values of a raw message header
+    :param header: header bytes
+    :param worker: name of this shard worker, test mails of other workers are skipped (None returns all)
+    :return: list of uuids (empty if the message is no MailRound test mail)
+    """
+    email_header = email.parser.BytesHeaderParser().parsebytes(header)
+    mail_round_uuid = email_header.get_all(MAIL_ROUND_HEADER)
+
+    if mail_round_uuid is None:
+        return []
+    sender = email_header.get(MAIL_ROUND_WORKER_HEADER)
+    if worker is not None and sender is not None and sender.strip() != worker:
+        return []
+    return [value.strip() for value in mail_round_uuid]
+
+
+def find_mailround_messages(conn, chunk_size=FETCH_CHUNK_SIZE, progress=None):
+    """
+    Find all MailRound test mails of the selected folder
+    The IMAP server searches for the header. If the server does not support header search
+    all messages are candidates. Only the X-Mail-Round header of the candidates is fetched
+    to make sure no other mail is matched.
+    :param conn: ImapClient Connection with the folder selected
+    :param chunk_size: number of messages per FETCH command
+    :param progress: optional callable(inspected, candidates) called after every chunk
+    :return: list of message uids
+    """
+    try:
+        candidates = conn.search(["HEADER", MAIL_ROUND_HEADER, ""])
+    except conn.Error as e:
+        log.debug("Header search not supported ({}). Inspect all messages".format(e))
+        candidates = conn.search(["ALL"])
+
+    messages = []
+    for start in range(0, len(candidates), chunk_size):
+        chunk = candidates[start:start + chunk_size]
+        for message_id, data in conn.fetch(chunk, [FETCH_MAIL_ROUND_HEADER]).items():
+            if parse_mailround_header(data):
+                messages.append(message_id)
+        if progress is not None:
+            progress(start + len(chunk), len(candidates))
+    return messages
+
+
+def delete_messages(conn, messages):
+    """
+    Delete messages with one STORE and one EXPUNGE command
+    With UIDPLUS only the given messages are expunged (UID EXPUNGE)
+    :param conn: ImapClient Connection with the folder selected
+    :param messages: list of message uids
+    """
+    if not messages:
+        return
+    conn.delete_messages(messages)
+    if conn.has_capability("UIDPLUS"):
+        conn.expunge(messages)
+    else:
+        conn.expunge()
+
+
+def pop_message_uids(conn):
+    """
+    List the unique ids of all messages in the maildrop (UIDL)
+    :param conn: poplib POP3 Connection
+    :return: dict of unique id -> message number
+    """
+    response, lines, octets = conn.uidl()
+    messages = {}
+    for line in lines:
+        number, uid = line.split(None, 1)
+        messages[uid.strip()] = int(number)
+    return messages
+
+
+def pop_mailround_header(conn, number, worker=None):
+    """
+    Transfer only the header of a message (TOP n 0) and extract its X-Mail-Round values
+    :param conn: poplib POP3 Connection
+    :param number: message number
+    :param worker: see parse_header_values
+    :return: list of uuids
+    """
+    response, lines, octets = conn.top(number, 0)
+    return parse_header_values(b"\r\n".join(lines) + b"\r\n", worker)
+
+
+def find_pop_mailround_messages(conn, chunk_size=FETCH_CHUNK_SIZE, progress=None):
+    """
+    Find all MailRound test mails of a POP3 maildrop
+    POP3 has no header search, the header of every message is inspected with TOP n 0
+    :param conn: poplib POP3 Connection
+    :param chunk_size: number of messages between two progress calls
+    :param progress: optional callable(inspected, candidates)
+    :return: list of message numbers
+    """
+    numbers = sorted(pop_message_uids(conn).values())
+    messages = []
+    for position, number in enumerate(numbers, 1):
+        if pop_mailround_header(conn, number):
+            messages.append(number)
+        if progress is not None and (position % chunk_size == 0 or position == len(numbers)):
+            progress(position, len(numbers))
+    return messages
+
+
+def delete_pop_messages(conn, messages):
+    """
+    Mark messages as deleted and end the session, the server removes them at QUIT
+    :param conn: poplib POP3 Connection
+    :param messages: list of message numbers
+    """
+    for number in messages:
+        conn.dele(number)
+    conn.quit()
+
+
+class MailboxCursor:
+
+    def __init__(self, folder="INBOX"):
+        """
+        Remember which messages of an IMAP folder were already inspected
+        The position is only valid as long as the UIDVALIDITY of the folder does not change
+        :param folder: IMAP folder name
+        """
+        self.folder = folder
+        self.uidvalidity = None
+        # Highest UID which was already inspected
+        self.last_uid = 0
+        # Highest MODSEQ seen (only used if the server supports CONDSTORE)
+        self.modseq = None
+        self.condstore = False
+
+    def select(self, conn):
+        """
+        Select the folder and start at the current end of the folder
+        :param conn: ImapClient Connection
+        :return: select_folder response
+        """
+        response = conn.select_folder(self.folder)
+        uidvalidity = response.get(b"UIDVALIDITY")
+
+        if uidvalidity != self.uidvalidity:
+            if self.uidvalidity is not None:
+                log.info("UIDVALIDITY of {} changed. Start from the beginning".format(self.folder))
+            self.uidvalidity = uidvalidity
+            self.last_uid = 0
+            self.modseq = None
+
+        self.condstore = conn.has_capability("CONDSTORE")
+        if self.condstore and b"HIGHESTMODSEQ" in response:
+            self.modseq = response[b"HIGHESTMODSEQ"]
+
+        if b"UIDNEXT" in response:
+            self.last_uid = max(self.last_uid, response[b"UIDNEXT"] - 1)
+        else:
+            uids = conn.search(["ALL"])
+            if uids:
+                self.last_uid = max(self.last_uid, max(uids))
+        return response
+
+    def new_messages(self, conn):
+        """
+        Search for messages which arrived after the last call
+        :param conn: ImapClient Connection with the folder selected
+        :return: list of new message uids
+        """
+        criteria = ["UID", "{}:*".format(self.last_uid + 1)]
+        if self.condstore and self.modseq is not None:
+            criteria = criteria + ["MODSEQ", self.modseq + 1]
+
+        # "n:*" always contains the newest message, even if its uid is lower than n
+        uids = [uid for uid in conn.search(criteria) if uid > self.last_uid]
+
+        if uids:
+            self.last_uid = max(uids)
+        return uids
+
+    def fetch_items(self, items):
+        """
+        Add MODSEQ to the fetch items when the server supports CONDSTORE
+        """
+        if self.condstore:
+            return items + ["MODSEQ"]
+        return items
+
+    def update(self, response):
+        """
+        Remember the highest MODSEQ of a fetch response
+        :param response: ImapClient fetch response
+        """
+        for data in response.values():
+            if b"MODSEQ" in data:
+                self.modseq = max(self.modseq or 0, data[b"MODSEQ"][0])
+
+
+class PopMailboxCursor:
+
+    def __init__(self):
+        """
+        Remember which messages of a POP3 maildrop were already inspected
+        POP3 message numbers change between sessions, so the unique ids of UIDL are remembered
+        """
+        self.seen = set()
+
+    def new_messages(self, conn):
+        """
+        :param conn: poplib POP3 Connection
+        :return: list of (message number, unique id) of the messages which were not inspected yet
+        """
+        messages = pop_message_uids(conn)
+        # Messages which are gone are forgotten, so the set only holds what is in the maildrop
+        self.seen.intersection_update(messages)
+        return sorted((number, uid) for uid, number in messages.items() if uid not in self.seen)
+
+    def update(self, messages):
+        """
+        Remember inspected messages
+        :param messages: list of (message number, unique id)
+        """
+        self.seen.update(uid for number, uid in messages)
+
+
+class WatchRequest:
+
+    def __init__(self, uuid):
+        """
+        A round waiting for its test mail
+        :param uuid: X-Mail-Round value of the test mail
+        """
+        self.uuid = uuid
+        # Resolves with the uid of the test mail
+        self.future = concurrent.futures.Future()
+        # this variable becomes true when other MailRound mails arrive while waiting (greylisting suspicion)
+        self.graylisting = False
+        # Time (time.time()) at which the watcher woke up and found the test mail
+        self.woken = None
+        # Number of IDLE cycles while waiting
+        self.idle_cycles = 0
+        # Durations of the watcher phases (select, idle, search, fetch, delete) of the cycle which found the test mail
+        self.spans = {}
+
+
+class MailboxWatcher(threading.Thread):
+    instances = {}
+    _instances_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(server_name, server_config):
+        """
+        Shared watcher of one inbox server
+        :param server_name: Name of the inbox server
+        :param server_config: MailImapServer object
+        """
+        with MailboxWatcher._instances_lock:
+            watcher = MailboxWatcher.instances.get(server_name)
+            if watcher is None or not watcher.is_alive():
+                if isinstance(server_config, MailPopServer):
+                    watcher = PopMailboxWatcher(server_name, server_config)
+                else:
+                    watcher = MailboxWatcher(server_name, server_config)
+                MailboxWatcher.instances[server_name] = watcher
+                watcher.start()
+            return watcher
+
+    @staticmethod
+    def stop_all():
+        with MailboxWatcher._instances_lock:
+            for watcher in MailboxWatcher.instances.values():
+                watcher.stop()
+            MailboxWatcher.instances = {}
+
+    @staticmethod
+    def remove_instance(server_name):
+        """
+        Retire the watcher of an inbox server which is removed from the configuration
+        """
+        with MailboxWatcher._instances_lock:
+            watcher = MailboxWatcher.instances.pop(server_name, None)
+        if watcher is not None:
+            watcher.retire()
+
+    def __init__(self, server_name, server_config, *args, **kwargs):
+        """
+        Keep one IDLE session per inbox server and dispatch arriving test mails to the waiting rounds
+        :param server_name: Name of the inbox server
+        :param server_config: MailImapServer or MailPopServer object
+        """
+        super(MailboxWatcher, self).__init__(*args, name="watch-{}".format(server_name), daemon=True, **kwargs)
+        self.server_name = server_name
+        self._mail_in = server_config
+        self._cursor = MailboxCursor("INBOX")
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._retired = False
+        self._last_search = 0
+        self._woken = None
+
+    def register(self, uuid):
+        """
+        Announce a test mail before it is sent
+        :param uuid: X-Mail-Round value of the test mail
+        :return: WatchRequest
+        """
+        request = WatchRequest(uuid)
+        with self._lock:
+            self._waiting[uuid] = request
+        return request
+
+    def unregister(self, uuid):
+        with self._lock:
+            self._waiting.pop(uuid, None)
+
+    def stop(self):
+        self._stopping = True
+
+    def retire(self):
+        """
+        Stop as soon as no round waits for a test mail anymore
+        """
+        self._retired = True
+
+    def _finished(self):
+        if self._stopping:
+            return True
+        if self._retired:
+            with self._lock:
+                return not self._waiting
+        return False
+
+    def run(self):
+        while not self._finished():
+            conn = None
+            try:
+                conn = self._mail_in.get_connection()
+                cycle = SpanRecorder()
+                with cycle.span("select"):
+                    self._cursor.select(conn)
+                self._woken = time.time()
+                with cycle.span("search"):
+                    messages = search_candidates(conn)
+                self._dispatch(conn, messages, cycle)
+
+                while not self._finished():
+                    cycle = SpanRecorder()
+                    with cycle.span("idle"):
+                        self._wait(conn)
+                    self._woken = time.time()
+                    with self._lock:
+                        for request in self._waiting.values():
+                            request.idle_cycles += 1
+                    with cycle.span("search"):
+                        messages = self._cursor.new_messages(conn)
+                    self._dispatch(conn, messages, cycle)
+            except LoginThrottled as e:
+                self._throttled(e)
+            except Exception as e:
+                log.exception(e)
+                log.error("Mailbox watcher {} lost the connection".format(self.server_name))
+                self._fail_waiting(e)
+                time.sleep(settings.WATCHER_RECONNECT_DELAY.total_seconds())
+            finally:
+                if conn is not None:
+                    try:
+                        conn.logout()
+                    except Exception:
+                        pass
+
+    def _throttled(self, error):
+        """
+        The host did not let the watcher log in in time, it is not down
+        The waiting rounds keep waiting, a test mail which arrives is found after the next login
+        """
+        log.warning("Mailbox watcher {} is throttled: {}".format(self.server_name, error))
+        time.sleep(settings.WATCHER_RECONNECT_DELAY.total_seconds())
+
+    def _fail_waiting(self, error):
+        with self._lock:
+            waiting = list(self._waiting.values())
+        for request in waiting:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _wait(self, conn):
+        """
+        Wait until the server reports new messages
+        While rounds are waiting the folder is searched at least every WATCHER_POLL_INTERVAL,
+        so a notification which got lost between search and IDLE does not delay a round
+        """
+        self._last_search = time.monotonic()
+        poll_interval = settings.WATCHER_POLL_INTERVAL.total_seconds()
+        refresh_at = self._last_search + settings.WATCHER_IDLE_REFRESH.total_seconds()
+
+        if not conn.has_capability("IDLE"):
+            while not self._finished() and time.monotonic() < self._last_search + poll_interval:
+                time.sleep(0.2)
+            conn.noop()
+            return
+
+        conn.idle()
+        try:
+            while not self._finished():
+                responses = conn.idle_check(timeout=1)
+                for response in responses:
+                    # Not every server reports RECENT, a grown EXISTS also means new mail
+                    if len(response) > 1 and response[1] in [b"RECENT", b"EXISTS"] and response[0] > 0:
+                        return
+
+                now = time.monotonic()
+                if now >= refresh_at:
+                    return
+                with self._lock:
+                    waiting = bool(self._waiting)
+                if waiting and now >= self._last_search + poll_interval:
+                    return
+        finally:
+            conn.idle_done()
+
+    def _dispatch(self, conn, messages, cycle):
+        """
+        Fetch the X-Mail-Round header of the given messages and wake the matching rounds
+        :param messages: list of message uids
+        :param cycle: SpanRecorder of the current watcher cycle
+        """
+        if not messages:
+            return
+
+        # Only the X-Mail-Round header of the candidates is transferred
+        with cycle.span("fetch"):
+            response = conn.fetch(messages, self._cursor.fetch_items([FETCH_MAIL_ROUND_HEADER]))
+        self._cursor.update(response)
+
+        # In a shared inbox the test mails of other shard workers are neither matched nor deleted
+        found, late = self._match({message_id: parse_mailround_header(data, settings.SHARD_WORKER)
+                                   for message_id, data in response.items()})
+
+        if (found or late) and settings.CLEANUP:
+            with cycle.span("delete"):
+                delete_messages(conn, [message_id for message_id, request in found] +
+                                [message_id for message_id, uuid, mail in late])
+
+        self._resolve(found, cycle)
+        self._record_late(late)
+
+    def _match(self, headers):
+        """
+        Find the waiting rounds of inspected messages
+        Other MailRound mails mark all waiting rounds as greylisting suspects,
+        late test mails of ended rounds of this instance are returned to be deleted and recorded
+        :param headers: dict of message id -> list of X-Mail-Round values
+        :return: (list of (message id, WatchRequest), list of (message id, uuid, SentMail))
+        """
+        found = []
+        unknown = []
+        with self._lock:
+            for message_id, uuids in headers.items():
+                for mail_round_uuid in uuids:
+                    request = self._waiting.get(mail_round_uuid)
+                    if request is None:
+                        unknown.append((message_id, mail_round_uuid))
+                    elif not request.future.done():
+                        found.append((message_id, request))
+
+            if unknown:
+                for request in self._waiting.values():
+                    request.graylisting = True
+
+        # The index has its own lock, the rounds can register and unregister meanwhile
+        late = []
+        for message_id, mail_round_uuid in unknown:
+            mail = SentMailIndex.get_instance().late_arrival(mail_round_uuid, self.server_name)
+            if mail is not None:
+                late.append((message_id, mail_round_uuid, mail))
+        return found, late
+
+    def _resolve(self, found, cycle):
+        """
+        Wake the rounds whose test mail was found
+        :param found: list of (message id, WatchRequest)
+        :param cycle: SpanRecorder of the current watcher cycle
+        """
+        for message_id, request in found:
+            log.debug("Found Mail with UUID {} at {}".format(request.uuid, self.server_name))
+            request.woken = self._woken
+            request.spans = dict(cycle.as_dict(), idle_cycles=request.idle_cycles)
+            request.future.set_result(message_id)
+
+    def _record_late(self, late):
+        """
+        Record the exact delay of late test mails with the group of their round
+        :param late: list of (message id, uuid, SentMail)
+        """
+        for message_id, mail_round_uuid, mail in late:
+            delay = self._woken - mail.sent
+            log.info("Late test mail {} from {} arrived at {} after {:.1f}s".format(
+                mail_round_uuid, mail.outname, self.server_name, delay))
+            StatusLog.get_instance().add_status(mail_round_uuid, mail.outname, self.server_name, "late_arrival",
+                                                delay=round(delay, 6), sent=mail.sent)
+
+
+class PopMailboxWatcher(MailboxWatcher):
+
+    def __init__(self, server_name, server_config, *args, **kwargs):
+        """
+        Poll a POP3 inbox for the waiting rounds
+        POP3 has no IDLE and a session does not see mails which arrive after login, so every poll is a new
+        session: UIDL lists the messages, only the header of unseen messages is transferred (TOP n 0)
+        and the found test mails are deleted together before QUIT
+        :param server_name: Name of the inbox server
+        :param server_config: MailPopServer object
+        """
+        super(PopMailboxWatcher, self).__init__(server_name, server_config, *args, **kwargs)
+        self._cursor = PopMailboxCursor()
+
+    def run(self):
+        while not self._finished():
+            try:
+                cycle = SpanRecorder()
+                with cycle.span("idle"):
+                    self._wait_poll()
+                if self._finished():
+                    break
+                self._woken = time.time()
+                with self._lock:
+                    for request in self._waiting.values():
+                        request.idle_cycles += 1
+                self._poll(cycle)
+            except LoginThrottled as e:
+                self._throttled(e)
+            except Exception as e:
+                log.exception(e)
+                log.error("Mailbox watcher {} lost the connection".format(self.server_name))
+                self._fail_waiting(e)
+                time.sleep(settings.WATCHER_RECONNECT_DELAY.total_seconds())
+
+    def _wait_poll(self):
+        """
+        Wait until the next poll: every WATCHER_POLL_INTERVAL while rounds are waiting,
+        otherwise every WATCHER_IDLE_REFRESH to keep the seen messages up to date
+        """
+        while not self._finished():
+            with self._lock:
+                waiting = bool(self._waiting)
+            if waiting:
+                interval = settings.WATCHER_POLL_INTERVAL.total_seconds()
+            else:
+                interval = settings.WATCHER_IDLE_REFRESH.total_seconds()
+            if not self._last_search or time.monotonic() >= self._last_search + interval:
+                return
+            time.sleep(0.2)
+
+    def _poll(self, cycle):
+        """
+        One POP3 session: find the new test mails, delete them and wake their rounds
+        :param cycle: SpanRecorder of the current watcher cycle
+        """
+        self._last_search = time.monotonic()
+        # Connection setup is attributed to this cycle
+        with recording(cycle):
+            conn = self._mail_in.get_connection()
+        try:
+            with cycle.span("search"):
+                messages = self._cursor.new_messages(conn)
+            with cycle.span("fetch"):
+                headers = {(number, uid): pop_mailround_header(conn, number, settings.SHARD_WORKER)
+                           for number, uid in messages}
+            found, late = self._match(headers)
+
+            if (found or late) and settings.CLEANUP:
+                with cycle.span("delete"):
+                    delete_pop_messages(conn, [number for (number, uid), request in found] +
+                                        [number for (number, uid), mail_round_uuid, mail in late])
+            else:
+                conn.quit()
+            conn = None
+        finally:
+            if conn is not None:
+                # Without QUIT the server does not remove messages which were marked as deleted
+                conn.close()
+
+        self._cursor.update(messages)
+        self._resolve(found, cycle)
+        self._record_late(late)
@@ -0,0 +1,260 @@
+import bisect
+import http.server
+import logging
+import threading
+
+from config import settings
+
+log = logging.getLogger("mailround.controller.metrics")
+
+# Spans of end_sendmail which belong to the setup of a new SMTP connection (resolve and tls are part of connect)
+SETUP_SPANS = ("connect", "auth")
+
+# Wait of a new SMTP connection for the login limits of its host
+THROTTLE_SPAN = "throttle"
+
+# Upper bounds in seconds, every bucket is twice as wide as the one before (10ms up to about 11 minutes)
+LATENCY_BUCKETS = tuple(0.01 * 2 ** exponent for exponent in range(17))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Latency histogram with fixed buckets
+        :param buckets: sorted upper bounds of the buckets, values above the last bound are counted in +Inf
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation inside its bucket
+        :param q: quantile between 0 and 1 eg. 0.95
+        :return: seconds or None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index >= len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, number of values <= bound) including +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RoundMetrics:
+    instance = False
+    _instance_lock = threading.Lock()
+
+    # Latencies derived from the status messages of a round
+    HISTOGRAMS = {
+        "send": "Time to hand the test mail to the SMTP server",
+        "delivery": "Time from sending the test mail until it was found in the inbox",
+        "transit": "Delivery time without the setup of the SMTP connection and the wait for its host",
+        "connection_setup": "DNS, connect, TLS handshake and login of a new SMTP connection",
+        "receive_wait": "Time a round waited for its test mail after sending",
+        "wake": "Time from the wakeup of the mailbox watcher until the round noticed the test mail",
+        "schedule_lag": "Delay between the scheduled and the real start of a round",
+        "late_delivery": "Delivery time of test mails which arrived after their round ended",
+    }
+
+    @staticmethod
+    def get_instance():
+        with RoundMetrics._instance_lock:
+            if not RoundMetrics.instance:
+                RoundMetrics.instance = RoundMetrics()
+            return RoundMetrics.instance
+
+    def __init__(self):
+        """
+        In-process latency histograms and result counters per (out, in) pair
+        Everything is computed from the status messages which are written to the Status Log
+        """
+        self._lock = threading.Lock()
+        # (name, out, in) -> Histogram
+        self.histograms = {}
+        # (out, in, result) -> count
+        self.results = {}
+        # (group, out, in) -> {status: timestamp} of running rounds
+        self._pending = {}
+
+    def _observe(self, name, pair, value):
+        key = (name,) + pair
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(max(0.0, value))
+
+    def observe_status(self, record):
+        """
+        Update the metrics with one status message
+        :param record: StatusRecord
+        """
+        pair = (record.out, record.inname)
+        status = record.status
+        timestamp = record.timestamp
+        key = (record.group,) + pair
+
+        with self._lock:
+            if status == "start":
+                self._pending[key] = {}
+                if record.get("schedule_lag") is not None:
+                    self._observe("schedule_lag", pair, record.get("schedule_lag"))
+                return
+
+            if status in ["success", "error", "greylisting"]:
+                self.results[pair + (status,)] = self.results.get(pair + (status,), 0) + 1
+                self._pending.pop(key, None)
+                return
+
+            if status == "late_arrival":
+                # The round is already finished, it is only counted in the histogram
+                self._observe("late_delivery", pair, record.get("delay"))
+                return
+
+            phases = self._pending.get(key)
+            if phases is None:
+                phases = self._pending[key] = {}
+
+            phases[status] = timestamp
+            if status == "end_sendmail":
+                if "start_sendmail" in phases:
+                    self._observe("send", pair, timestamp - phases["start_sendmail"])
+                spans = record.get("spans") or {}
+                setup = sum(spans.get(name, 0.0) for name in SETUP_SPANS)
+                if setup:
+                    self._observe("connection_setup", pair, setup)
+                # The transit time neither contains the setup nor the wait for the host
+                setup += spans.get(THROTTLE_SPAN, 0.0)
+                if setup:
+                    phases["setup"] = setup
+            elif status == "end_receive":
+                if "start_sendmail" in phases:
+                    self._observe("delivery", pair, timestamp - phases["start_sendmail"])
+                    self._observe("transit", pair, timestamp - phases["start_sendmail"] - phases.get("setup", 0.0))
+                if "start_receive" in phases:
+                    self._observe("receive_wait", pair, timestamp - phases["start_receive"])
+                if record.get("woken") is not None:
+                    self._observe("wake", pair, timestamp - record.get("woken"))
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            for name, description in self.HISTOGRAMS.items():
+                metric = "mailround_{}_seconds".format(name)
+                lines.append("# HELP {} {}".format(metric, description))
+                lines.append("# TYPE {} histogram".format(metric))
+                for (histogram_name, outname, inname), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    labels = 'out="{}",in="{}"'.format(escape_label(outname), escape_label(inname))
+                    for bound, count in histogram.cumulative():
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, format_bound(bound), count))
+                    lines.append("{}_sum{{{}}} {}".format(metric, labels, histogram.sum))
+                    lines.append("{}_count{{{}}} {}".format(metric, labels, histogram.count))
+
+            lines.append("# HELP mailround_rounds_total Finished rounds by result")
+            lines.append("# TYPE mailround_rounds_total counter")
+            for (outname, inname, result), count in sorted(self.results.items()):
+                lines.append('mailround_rounds_total{{out="{}",in="{}",result="{}"}} {}'.format(
+                    escape_label(outname), escape_label(inname), result, count))
+
+        for collector in list(_collectors):
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                log.exception(e)
+        return "\n".join(lines) + "\n"
+
+
+# Callables which return additional lines for the metrics endpoint
+_collectors = []
+
+
+def register_collector(collector):
+    """
+    Add metrics of other components (eg. scheduler or notifier) to the metrics endpoint
+    :param collector: callable without arguments returning a list of lines in the Prometheus text format
+    """
+    _collectors.append(collector)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return "{:g}".format(bound)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = RoundMetrics.get_instance().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class MetricsServer(threading.Thread):
+
+    def __init__(self, host=None, port=None, *args, **kwargs):
+        """
+        Serve the metrics on http://<METRICS_HOST>:<METRICS_PORT>/metrics
+        """
+        super(MetricsServer, self).__init__(*args, name="metrics", daemon=True, **kwargs)
+        host = settings.METRICS_HOST if host is None else host
+        port = settings.METRICS_PORT if port is None else port
+        self.httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def run(self):
+        log.info("Serve metrics on port {}".format(self.port))
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
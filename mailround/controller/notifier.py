@@ -0,0 +1,212 @@
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+from config import settings
+from controller.metrics import register_collector
+
+log = logging.getLogger("mailround.controller.notifier")
+
+
+class NotifyError(Exception):
+    pass
+
+
+class Notifier(threading.Thread):
+    instance = False
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with Notifier._instance_lock:
+            if not Notifier.instance:
+                Notifier.instance = Notifier()
+                Notifier.instance.start()
+                register_collector(Notifier.instance.metrics)
+            return Notifier.instance
+
+    def __init__(self, *args, **kwargs):
+        """
+        Send the error notifications of all rounds to WEBHOOK_URL
+        Rounds only put their message into a bounded queue, so a slow or unreachable webhook target
+        never blocks a round. Failures which happen within NOTIFY_COALESCE_WINDOW are sent as one digest.
+        """
+        super(Notifier, self).__init__(*args, name="notifier", daemon=True, **kwargs)
+        self.queue = queue.Queue(maxsize=settings.NOTIFY_QUEUE_SIZE)
+        self._stopping = False
+        self._connection = None
+
+        # Statistics
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+
+    def notify(self, name, text):
+        """
+        Queue the notification of one failed round
+        :param name: Name of the round eg. "vps2->vps1"
+        :param text: Log of the round
+        :return: False if the queue is full and the notification was dropped
+        """
+        try:
+            self.queue.put_nowait((name, text))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            log.warning("Notification queue is full. Drop notification of {}".format(name))
+            return False
+
+    def metrics(self):
+        """
+        Notifier metrics in the Prometheus text format
+        """
+        lines = ["# TYPE mailround_notify_queue_length gauge",
+                 "mailround_notify_queue_length {}".format(self.queue.qsize())]
+        for name in ["sent", "dropped", "failed", "retries"]:
+            lines.append("# TYPE mailround_notify_{}_total counter".format(name))
+            lines.append("mailround_notify_{}_total {}".format(name, getattr(self, name)))
+        return lines
+
+    def stop(self, timeout=5):
+        """
+        Send the queued notifications and stop the thread
+        """
+        self._stopping = True
+        self.join(timeout)
+
+    def run(self):
+        while not self._stopping or not self.queue.empty():
+            try:
+                first = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            messages = [first] + self._collect(time.monotonic() + settings.NOTIFY_COALESCE_WINDOW.total_seconds())
+            try:
+                self._send(self.build_body(messages))
+                self.sent += 1
+            except Exception as e:
+                self.failed += len(messages)
+                log.exception(e)
+                log.error("Could not notify about {} failed rounds".format(len(messages)))
+
+        self._close()
+
+    def _collect(self, until):
+        """
+        Wait for more notifications until the coalesce window ends
+        :param until: end of the window (time.monotonic())
+        :return: list of (name, text)
+        """
+        messages = []
+        while True:
+            remaining = until - time.monotonic()
+            if self._stopping or remaining <= 0:
+                # Take what is already queued, but do not wait any longer
+                remaining = 0
+            try:
+                if remaining > 0:
+                    messages.append(self.queue.get(timeout=remaining))
+                else:
+                    messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def build_body(self, messages):
+        """
+        Build the webhook payload
+        :param messages: list of (name, text)
+        """
+        if len(messages) == 1:
+            name, text = messages[0]
+            return {
+                "text": """*Mailround*
+Error between {}
+```{}```""".format(name, text),
+            }
+
+        names = []
+        for name, text in messages:
+            if name not in names:
+                names.append(name)
+
+        return {
+            "text": """*Mailround*
+{} Errors between {}
+```{}```""".format(len(messages), ", ".join(names),
+                    "\n".join("{}\n{}".format(name, text) for name, text in messages)),
+        }
+
+    def _send(self, body):
+        """
+        Post the payload, retry with exponential backoff on connection errors and server errors
+        """
+        data = json.dumps(body).encode("utf-8")
+        delay = settings.NOTIFY_RETRY_DELAY.total_seconds()
+
+        for attempt in range(settings.NOTIFY_RETRIES + 1):
+            if attempt > 0:
+                self.retries += 1
+                self._sleep(delay)
+                delay = min(delay * 2, settings.NOTIFY_RETRY_MAX_DELAY.total_seconds())
+            try:
+                status = self._post(data)
+            except (OSError, http.client.HTTPException) as e:
+                log.warning("Webhook request failed ({}). Attempt {}".format(e, attempt + 1))
+                self._close()
+                continue
+
+            if status < 300:
+                return
+            if status != 429 and status < 500:
+                raise NotifyError("Webhook responded with {}".format(status))
+            log.warning("Webhook responded with {}. Attempt {}".format(status, attempt + 1))
+
+        raise NotifyError("Webhook not reachable after {} attempts".format(settings.NOTIFY_RETRIES + 1))
+
+    def _sleep(self, seconds):
+        # Do not wait for the full backoff when the application stops
+        end = time.monotonic() + seconds
+        while not self._stopping and time.monotonic() < end:
+            time.sleep(min(0.2, end - time.monotonic()))
+
+    def _post(self, data):
+        """
+        Post data over the persistent connection
+        :return: HTTP status code
+        """
+        url = urllib.parse.urlsplit(settings.WEBHOOK_URL)
+        if self._connection is None:
+            if url.scheme == "https":
+                connection_class = http.client.HTTPSConnection
+            else:
+                connection_class = http.client.HTTPConnection
+            self._connection = connection_class(url.hostname, url.port,
+                                                timeout=settings.NOTIFY_TIMEOUT.total_seconds())
+
+        path = url.path or "/"
+        if url.query:
+            path = "{}?{}".format(path, url.query)
+
+        self._connection.request("POST", path, body=data, headers={
+            "Content-Type": "application/json; charset=utf-8",
+        })
+        response = self._connection.getresponse()
+        # The response must be read completely before the connection can be reused
+        response.read()
+        if response.will_close:
+            self._close()
+        return response.status
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
@@ -0,0 +1,55 @@
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+
+from config import settings
+
+log = logging.getLogger("mailround.controller.profiling")
+
+
+class RoundProfiler:
+
+    @staticmethod
+    def sample():
+        """
+        Decide if the next round should be profiled
+        :return: RoundProfiler for a PROFILE_SAMPLE_RATE fraction of rounds, otherwise None
+        """
+        if settings.PROFILE_SAMPLE_RATE <= 0 or random.random() >= settings.PROFILE_SAMPLE_RATE:
+            return None
+        return RoundProfiler()
+
+    def __init__(self):
+        """
+        cProfile of the blocking parts of one round
+        The profiler is enabled in the thread which runs the current part of the round
+        """
+        self.profile = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def profiling(self):
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+
+    def dump(self, name):
+        """
+        Write the profile to PROFILE_PATH or log the most expensive functions
+        :param name: file name without extension
+        """
+        if settings.PROFILE_PATH:
+            os.makedirs(settings.PROFILE_PATH, exist_ok=True)
+            path = os.path.join(settings.PROFILE_PATH, "{}.prof".format(name))
+            self.profile.dump_stats(path)
+            log.info("Profile of round {} written to {}".format(name, path))
+            return
+
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats("cumulative").print_stats(20)
+        log.info("Profile of round {}\n{}".format(name, output.getvalue()))
@@ -0,0 +1,358 @@
+import array
+import csv
+import json
+import logging
+import math
+
+from controller.statusindex import CODE_SUMMARY, STATUS_CODES, StatusQuery
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger("mailround.controller.report")
+
+# Status messages which are needed for the report
+REPORT_CODES = {STATUS_CODES["start"], STATUS_CODES["start_sendmail"], STATUS_CODES["end_receive"],
+                STATUS_CODES["success"], STATUS_CODES["error"], STATUS_CODES["greylisting"], CODE_SUMMARY}
+
+QUANTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+
+CSV_FIELDS = ["out", "in", "rounds", "success", "error", "greylisting", "success_ratio", "greylisting_ratio",
+              "delivered", "delivery_mean", "delivery_p50", "delivery_p95", "delivery_p99", "delivery_max",
+              "outages", "outage_seconds", "availability"]
+
+
+class RoundColumns:
+
+    def __init__(self):
+        """
+        Status messages of the status log as columns
+        Every status message is one event of a round, a round is one group and server pair
+        """
+        # pair id -> (out, in)
+        self.pairs = []
+        self._pair_ids = {}
+        # (group, pair id) -> round id
+        self._round_ids = {}
+        # round id -> pair id
+        self.round_pair = array.array("q")
+        # Events
+        self.event_round = array.array("q")
+        self.event_code = array.array("B")
+        self.event_time = array.array("d")
+        # pair id -> merged summary records of compacted rounds
+        self.summaries = {}
+
+    @classmethod
+    def load(cls, query, since=None, until=None):
+        """
+        Read the status messages of the time range
+        :param query: StatusQuery
+        """
+        columns = cls()
+        for reader, timestamp, offset, pair, code in query.entries(since, until, codes=REPORT_CODES):
+            columns.add(reader.read(offset), code, timestamp)
+        return columns
+
+    def pair_id(self, outname, inname):
+        key = (outname, inname)
+        pair = self._pair_ids.get(key)
+        if pair is None:
+            pair = self._pair_ids[key] = len(self.pairs)
+            self.pairs.append(key)
+        return pair
+
+    def add(self, record, code, timestamp):
+        pair = self.pair_id(record["out"], record["in"])
+
+        if code == CODE_SUMMARY:
+            summary = self.summaries.setdefault(pair, {"rounds": 0, "success": 0, "error": 0, "greylisting": 0,
+                                                       "delivered": 0, "delivery_sum": 0.0})
+            for name in summary:
+                summary[name] += record.get(name, 0)
+            return
+
+        key = (record.get("group"), pair)
+        round_id = self._round_ids.get(key)
+        if round_id is None:
+            round_id = self._round_ids[key] = len(self.round_pair)
+            self.round_pair.append(pair)
+
+        self.event_round.append(round_id)
+        self.event_code.append(code)
+        self.event_time.append(timestamp)
+
+    def __len__(self):
+        return len(self.event_round)
+
+
+class SlaReport:
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024, since=None, until=None):
+        """
+        Success ratio, greylisting frequency, delivery time and outage windows of every server pair
+        The status messages are read into columns and evaluated in whole array passes with numpy.
+        Without numpy the same report is computed in plain python.
+        :param path: Base path of the status log
+        :param since: start timestamp (inclusive)
+        :param until: end timestamp (exclusive)
+        """
+        self.query = StatusQuery(path, segment_size)
+        self.since = since
+        self.until = until
+
+    def build(self):
+        """
+        :return: dict with "pairs" (one dict per server pair) and "outages"
+                 An outage is a sequence of failed rounds of a server pair, it lasts from the start of its first
+                 failed round until the start of the next successful round (or the end of its last round)
+        """
+        columns = RoundColumns.load(self.query, self.since, self.until)
+        log.debug("Loaded {} status messages of {} rounds".format(len(columns), len(columns.round_pair)))
+
+        if numpy is not None:
+            pairs, outages = numpy_report(columns)
+        else:
+            pairs, outages = python_report(columns)
+
+        # Rounds of compacted segments only have their counters
+        for pair, summary in columns.summaries.items():
+            result = pairs[pair]
+            delivery_sum = (result["delivery_mean"] or 0.0) * result["delivered"] + summary["delivery_sum"]
+            for name in ["rounds", "success", "error", "greylisting", "delivered"]:
+                result[name] += summary[name]
+            result["delivery_mean"] = delivery_sum / result["delivered"] if result["delivered"] else None
+
+        period = self.period(columns)
+        for result in pairs:
+            result["success_ratio"] = result["success"] / result["rounds"] if result["rounds"] else None
+            result["greylisting_ratio"] = result["greylisting"] / result["rounds"] if result["rounds"] else None
+            result["availability"] = max(0.0, 1 - result["outage_seconds"] / period) if period else None
+
+        return {
+            "since": self.since,
+            "until": self.until,
+            "pairs": sorted(pairs, key=lambda result: (result["out"], result["in"])),
+            "outages": sorted(outages, key=lambda outage: (outage["start"], outage["out"], outage["in"])),
+        }
+
+    def period(self, columns):
+        """
+        Length of the report time range in seconds
+        """
+        since = self.since
+        until = self.until
+        if columns.event_time and since is None:
+            since = min(columns.event_time)
+        if columns.event_time and until is None:
+            until = max(columns.event_time)
+        if since is None or until is None:
+            return None
+        return until - since
+
+
+def empty_result(outname, inname):
+    result = {"out": outname, "in": inname, "rounds": 0, "success": 0, "error": 0, "greylisting": 0,
+              "delivered": 0, "delivery_mean": None, "delivery_max": None, "outages": 0, "outage_seconds": 0.0}
+    for name, q in QUANTILES:
+        result["delivery_{}".format(name)] = None
+    return result
+
+
+def numpy_report(columns):
+    """
+    Evaluate all rounds in vectorized passes
+    :param columns: RoundColumns
+    :return: (list of pair results indexed by pair id, list of outages)
+    """
+    results = [empty_result(*pair) for pair in columns.pairs]
+    rounds = len(columns.round_pair)
+    if rounds == 0:
+        return results, []
+
+    event_round = numpy.frombuffer(columns.event_round, dtype=numpy.int64)
+    event_code = numpy.frombuffer(columns.event_code, dtype=numpy.uint8)
+    event_time = numpy.frombuffer(columns.event_time, dtype=numpy.float64)
+
+    def phase(status):
+        # Timestamp of one status message per round (NaN if the round has none)
+        values = numpy.full(rounds, numpy.nan)
+        selected = event_code == STATUS_CODES[status]
+        values[event_round[selected]] = event_time[selected]
+        return values
+
+    start = phase("start")
+    sent = phase("start_sendmail")
+    received = phase("end_receive")
+    success = phase("success")
+    error = phase("error")
+    greylisting = numpy.zeros(rounds, dtype=bool)
+    greylisting[event_round[event_code == STATUS_CODES["greylisting"]]] = True
+
+    # Running rounds and rounds which started before the time range without a result are not counted
+    failed = ~numpy.isnan(error)
+    done = failed | ~numpy.isnan(success)
+    finished = numpy.where(failed, error, success)[done]
+    begin = numpy.where(numpy.isnan(start), numpy.where(numpy.isnan(sent), finished, sent), start)[done]
+    pair = numpy.frombuffer(columns.round_pair, dtype=numpy.int64)[done]
+    failed = failed[done]
+    delivery = (received - sent)[done]
+    greylisting = greylisting[done]
+
+    count = len(columns.pairs)
+    totals = numpy.bincount(pair, minlength=count)
+    errors = numpy.bincount(pair[failed], minlength=count)
+    greylists = numpy.bincount(pair[greylisting], minlength=count)
+
+    # Delivery time: sort by pair and duration, the quantiles are positions in the slice of each pair
+    delivered = ~numpy.isnan(delivery)
+    delivery_pair = pair[delivered]
+    delivery = delivery[delivered]
+    order = numpy.lexsort((delivery, delivery_pair))
+    delivery = delivery[order]
+    delivery_pair = delivery_pair[order]
+    delivered = numpy.bincount(delivery_pair, minlength=count)
+    delivery_sum = numpy.bincount(delivery_pair, weights=delivery, minlength=count)
+    offsets = numpy.concatenate(([0], numpy.cumsum(delivered)[:-1]))
+    has_delivery = delivered > 0
+
+    quantiles = {}
+    for name, q in QUANTILES:
+        position = offsets + numpy.clip(numpy.ceil(q * delivered).astype(numpy.int64) - 1, 0, None)
+        quantiles[name] = numpy.where(has_delivery, delivery[numpy.minimum(position, len(delivery) - 1)]
+                                      if len(delivery) else 0.0, numpy.nan)
+    maximum = numpy.where(has_delivery, delivery[numpy.maximum(offsets + delivered - 1, 0)]
+                          if len(delivery) else 0.0, numpy.nan)
+
+    # Outages: runs of failed rounds of the same pair in the order of their start
+    order = numpy.lexsort((begin, pair))
+    pair = pair[order]
+    begin = begin[order]
+    finished = finished[order]
+    failed = failed[order]
+
+    same_as_previous = numpy.concatenate(([False], pair[1:] == pair[:-1]))
+    same_as_next = numpy.concatenate((pair[:-1] == pair[1:], [False]))
+    previous_failed = numpy.concatenate(([False], failed[:-1])) & same_as_previous
+    next_failed = numpy.concatenate((failed[1:], [False])) & same_as_next
+    first = numpy.flatnonzero(failed & ~previous_failed)
+    last = numpy.flatnonzero(failed & ~next_failed)
+
+    recovered = same_as_next[last]
+    outage_end = numpy.where(recovered, begin[numpy.minimum(last + 1, len(begin) - 1)], finished[last])
+    outage_start = begin[first]
+    outage_pair = pair[first]
+    outage_seconds = numpy.bincount(outage_pair, weights=outage_end - outage_start, minlength=count)
+    outage_count = numpy.bincount(outage_pair, minlength=count)
+
+    for index, result in enumerate(results):
+        result["rounds"] = int(totals[index])
+        result["error"] = int(errors[index])
+        result["success"] = result["rounds"] - result["error"]
+        result["greylisting"] = int(greylists[index])
+        result["delivered"] = int(delivered[index])
+        if has_delivery[index]:
+            result["delivery_mean"] = float(delivery_sum[index] / delivered[index])
+            result["delivery_max"] = float(maximum[index])
+            for name, q in QUANTILES:
+                result["delivery_{}".format(name)] = float(quantiles[name][index])
+        result["outages"] = int(outage_count[index])
+        result["outage_seconds"] = float(outage_seconds[index])
+
+    outages = [{
+        "out": columns.pairs[outage_pair[index]][0],
+        "in": columns.pairs[outage_pair[index]][1],
+        "start": float(outage_start[index]),
+        "end": float(outage_end[index]),
+        "rounds": int(last[index] - first[index] + 1),
+        "recovered": bool(recovered[index]),
+    } for index in range(len(first))]
+    return results, outages
+
+
+def python_report(columns):
+    """
+    Same evaluation as numpy_report without numpy
+    :param columns: RoundColumns
+    :return: (list of pair results indexed by pair id, list of outages)
+    """
+    results = [empty_result(*pair) for pair in columns.pairs]
+    phases = [{} for _ in range(len(columns.round_pair))]
+    greylisting = set()
+    codes = {code: status for status, code in STATUS_CODES.items()}
+
+    for round_id, code, timestamp in zip(columns.event_round, columns.event_code, columns.event_time):
+        if code == STATUS_CODES["greylisting"]:
+            greylisting.add(round_id)
+        else:
+            phases[round_id][codes[code]] = timestamp
+
+    # pair id -> list of (begin, finished, failed)
+    rounds = {}
+    deliveries = {}
+    for round_id, round_phases in enumerate(phases):
+        failed = "error" in round_phases
+        if not failed and "success" not in round_phases:
+            continue
+
+        pair = columns.round_pair[round_id]
+        result = results[pair]
+        finished = round_phases["error" if failed else "success"]
+        begin = round_phases.get("start", round_phases.get("start_sendmail", finished))
+        rounds.setdefault(pair, []).append((begin, finished, failed))
+
+        result["rounds"] += 1
+        result["error" if failed else "success"] += 1
+        if round_id in greylisting:
+            result["greylisting"] += 1
+        if "start_sendmail" in round_phases and "end_receive" in round_phases:
+            deliveries.setdefault(pair, []).append(round_phases["end_receive"] - round_phases["start_sendmail"])
+
+    for pair, delivery in deliveries.items():
+        delivery.sort()
+        result = results[pair]
+        result["delivered"] = len(delivery)
+        result["delivery_mean"] = math.fsum(delivery) / len(delivery)
+        result["delivery_max"] = delivery[-1]
+        for name, q in QUANTILES:
+            result["delivery_{}".format(name)] = delivery[max(0, math.ceil(q * len(delivery)) - 1)]
+
+    outages = []
+    for pair, pair_rounds in rounds.items():
+        pair_rounds.sort()
+        outage = None
+        for begin, finished, failed in pair_rounds:
+            if failed:
+                if outage is None:
+                    outage = {"out": columns.pairs[pair][0], "in": columns.pairs[pair][1], "start": begin,
+                              "end": finished, "rounds": 0, "recovered": False}
+                    outages.append(outage)
+                outage["rounds"] += 1
+                outage["end"] = finished
+            elif outage is not None:
+                outage["end"] = begin
+                outage["recovered"] = True
+                outage = None
+
+    for outage in outages:
+        result = results[columns.pair_id(outage["out"], outage["in"])]
+        result["outages"] += 1
+        result["outage_seconds"] += outage["end"] - outage["start"]
+    return results, outages
+
+
+def write_json(report, fobj):
+    json.dump(report, fobj, indent=2)
+    fobj.write("\n")
+
+
+def write_csv(report, fobj):
+    """
+    One row per server pair, the outage windows are only part of the JSON report
+    """
+    writer = csv.DictWriter(fobj, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for result in report["pairs"]:
+        writer.writerow({name: "" if value is None else value for name, value in result.items()})
@@ -1,15 +1,23 @@
-import datetime
+import asyncio
+import concurrent.futures
+import contextlib
 import email.message
 import email.utils
 import io
-import json
 import logging
-import threading
-import urllib.parse
-import urllib.request
+import smtplib
+import time
 import uuid
 
 from config import settings
+from config.mail import ConnectionPoolTimeout
+from config.transport import LoginThrottled
+from controller.health import PROBE, SKIP, ServerHealth
+from controller.latearrival import SentMailIndex
+from controller.mailbox import MailboxWatcher, MAIL_ROUND_HEADER, MAIL_ROUND_WORKER_HEADER
+from controller.notifier import Notifier
+from controller.profiling import RoundProfiler
+from controller.spans import SpanRecorder, call_round_hooks, recording, span
 from controller.statuslog import StatusLog
 
 
@@ -22,32 +30,68 @@ class ContextFilter(logging.Filter):
         return True
 
 
-class RoundTrip(threading.Thread):
+class RoundTarget:
 
-    def __init__(self, mailout, mailin, servernames, **kwargs):
+    def __init__(self, name, server):
+        """
+        One inbox which should receive the test mail of a round
+        :param name: Name of the inbox server
+        :param server: MailImapServer object
+        """
+        self.name = name
+        self.server = server
+        # Shared IDLE session of the inbox server
+        self.watcher = MailboxWatcher.get_instance(name, server)
+        self.watch = None
+        self.error = False
+        self.graylisting = False
+        # The watcher could not reach the inbox server
+        self.unreachable = False
+
+
+class RoundTrip:
+
+    def __init__(self, mailout, mailin, servernames):
         """
             This class manage the monitoring for a mailserver check
             :param mailin: Mail inbox Server must be a MailImapServer object or MailPopServerObject
-            :type mailin: MailImapServer or MailPopServer
+                           For a fan-out round a list of inbox servers which all receive the same test mail
+            :type mailin: MailImapServer or MailPopServer or list
             :param mailout: Mail outgoing Server must be a MailSmtpServer object
-            :param name: Tuple with the names of mailin and mailout
+            :param name: Tuple with the names of mailin and mailout (list of mailin names for a fan-out round)
             :type name: tuple
         """
-        super(RoundTrip, self).__init__(**kwargs)
+        innames = servernames[1]
+        if not isinstance(innames, (list, tuple)):
+            innames = [innames]
+            mailin = [mailin]
 
-        # E-Mail Inbox Server
-        self._mail_in = mailin
         # E-Mail Out Server
         self._mail_out = mailout
 
         # Tupel with servernames
-        self._name = servernames
+        self._name = (servernames[0], ",".join(innames))
         # UUID for Mail Tracking
         self.uuid = uuid.uuid4()
+        # Status group of all records of this round
+        self._group = self.uuid.hex
         # this variable becomes true when there is a suspicion that mails arrive late due to greylisting.
         self._graylisting = False
         # if this variable is true a notification will be triggerd after the full process
         self._error = False
+        # The test mail could not be handed to the outgoing server
+        self._send_failed = False
+        # The outgoing server was not reached because of a local limit (login limits of its host or full pool)
+        self._send_throttled = False
+        # All inboxes of this round, the test mail is sent once to all of them
+        self._targets = [RoundTarget(name, server) for name, server in zip(innames, mailin)]
+        # Delay between the scheduled and the real start of this round in seconds
+        self.schedule_lag = None
+        # Durations of the round phases
+        self.spans = SpanRecorder()
+        self._started = None
+        # Only a sample of the rounds is profiled (PROFILE_SAMPLE_RATE)
+        self._profiler = RoundProfiler.sample()
 
         self._log_data = io.StringIO()
         self._log_handler = logging.StreamHandler(self._log_data)
@@ -55,7 +99,7 @@ class RoundTrip(threading.Thread):
         # error logging setup (Send in notifaction)
         self.log = self.setup_log()
 
-        self.log.info("Test Connection between {} and {} ".format(*servernames))
+        self.log.info("Test Connection between {} and {} ".format(*self._name))
 
         # Debug Output
         self.log.debug("")
@@ -65,13 +109,14 @@ class RoundTrip(threading.Thread):
         self.log.debug("Port: {}".format(self._mail_out.port))
         self.log.debug("SSL: {}".format(self._mail_out.use_ssl))
         self.log.debug("User: {}".format(self._mail_out.credentials.username))
-        self.log.debug("")
-        self.log.debug("InServer")
-        self.log.debug("-" * 20)
-        self.log.debug("Host: {}".format(self._mail_in.host))
-        self.log.debug("Port: {}".format(self._mail_in.port))
-        self.log.debug("SSL: {}".format(self._mail_in.use_ssl))
-        self.log.debug("User: {}".format(self._mail_in.credentials.username))
+        for target in self._targets:
+            self.log.debug("")
+            self.log.debug("InServer {}".format(target.name))
+            self.log.debug("-" * 20)
+            self.log.debug("Host: {}".format(target.server.host))
+            self.log.debug("Port: {}".format(target.server.port))
+            self.log.debug("SSL: {}".format(target.server.use_ssl))
+            self.log.debug("User: {}".format(target.server.credentials.username))
 
     def setup_log(self):
 
@@ -89,50 +134,221 @@ class RoundTrip(threading.Thread):
         log.addHandler(self._log_handler)
         return log
 
+    def add_status(self, status, targets=None, **kwargs):
+        """
+        Add a status message for every server pair of this round
+        :param targets: only for these RoundTarget objects (default: all)
+        """
+        for target in targets or self._targets:
+            StatusLog.get_instance().add_status(self._group, self._name[0], target.name, status, **kwargs)
+
     def run(self):
+        """
+        Run the full round in the calling thread
+        """
+        run, probes = self.check_circuits()
+        if probes:
+            run = self.probe_phase(probes)
+        if not run:
+            return
 
-        StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "start")
-        try:
-            # Trigger Mail Sen
-            StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "start_sendmail")
-            self.sendmail()
-            StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "end_sendmail")
-        except Exception as e:
-            self.log.exception(e)
-            self._error = True
-            self.log.error("Error by send E-Mail from {}".format(self._name[1]))
+        self.start_round()
+        self.send_phase()
 
         if not self._error:
             try:
-                StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "start_receive")
+                self.add_status("start_receive")
                 self.receive()
-                StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "end_receive")
             except Exception as e:
-                self._error = True
-                self.log.exception(e)
-                self.log.error("Error by Recive E-Mail at Mailbox {} ".format(self._name[0]))
-
-        if self._error:
-            StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "error")
-            if self._graylisting:
-                StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "greylisting")
-            self.notify()
+                self._receive_failed(e)
+
+        self.finish_round()
+
+    async def run_async(self, executor):
+        """
+        Run the full round as coroutine
+        Blocking SMTP and webhook calls are done in the given executor, waiting for the test mail needs no thread
+        :param executor: concurrent.futures.Executor for blocking calls
+        """
+        loop = asyncio.get_event_loop()
+
+        run, probes = self.check_circuits()
+        if probes:
+            run = await loop.run_in_executor(executor, self.probe_phase, probes)
+        if not run:
+            return
+
+        self.start_round()
+        await loop.run_in_executor(executor, self.send_phase)
+
+        if not self._error:
+            try:
+                self.add_status("start_receive")
+                await self.receive_async()
+            except Exception as e:
+                self._receive_failed(e)
+
+        await loop.run_in_executor(executor, self.finish_round)
+
+    def _profiling(self):
+        if self._profiler is None:
+            return contextlib.nullcontext()
+        return self._profiler.profiling()
+
+    def check_circuits(self):
+        """
+        Ask the circuit breakers of all servers of this round
+        :return: (run, probes) run is False if the round is skipped because a server has an open circuit,
+                 probes is a list of (CircuitBreaker, server) which must be reachable before the round runs
+        """
+        health = ServerHealth.get_instance()
+        breakers = [(health.breaker("out", self._name[0]), self._mail_out)] + \
+                   [(health.breaker("in", target.name), target.server) for target in self._targets]
+
+        probes = []
+        for breaker, server in breakers:
+            decision = breaker.decide()
+            if decision == SKIP:
+                self.log.debug("Circuit of {} is open. Skip round".format(breaker.name))
+                self.discard()
+                return False, []
+            if decision == PROBE:
+                probes.append((breaker, server))
+        return True, probes
+
+    def probe_phase(self, probes):
+        """
+        Only connect to the servers with an open circuit instead of running the full round
+        :param probes: list of (CircuitBreaker, server)
+        :return: True if all servers are reachable, the round then runs as trial of the half open circuits
+        """
+        timeout = settings.CIRCUIT_PROBE_TIMEOUT.total_seconds()
+        reachable = True
+        for breaker, server in probes:
+            try:
+                ready = server.probe(timeout)
+            except Exception as e:
+                self.log.debug("Probe of {} failed: {}".format(breaker.name, e))
+                ready = False
+            breaker.probe_result(ready)
+            reachable = reachable and ready
+
+        if not reachable:
+            self.add_status("error", probe=True)
+            self.discard()
+        return reachable
+
+    def discard(self):
+        """
+        Release the round log of a round which did not run
+        """
+        self.log.removeHandler(self._log_handler)
+        self._log_data.close()
+
+    def start_round(self):
+        self._started = time.monotonic()
+        if self.schedule_lag is None:
+            self.add_status("start")
         else:
-            StatusLog.get_instance().add_status(self.uuid.hex, self.name[0], self.name[1], "success")
-            self.log.info("SUCCESS between {} to {}".format(self.name[0], self.name[1]))
-            self.log.removeHandler(self._log_handler)
-            # log_contents = self._log_data.getvalue()
-            self._log_data.close()
+            self.add_status("start", schedule_lag=self.schedule_lag)
+        # The watchers must know the test mail before it can arrive
+        for target in self._targets:
+            target.watch = target.watcher.register(self.uuid.hex)
+
+    def send_phase(self):
+        # connect and auth of a new pooled connection are recorded in this thread
+        send_spans = SpanRecorder()
+        try:
+            with recording(send_spans), self._profiling(), self.spans.span("send_phase"):
+                # Trigger Mail Sen
+                self.add_status("start_sendmail")
+                sent = time.time()
+                self.sendmail()
+            self.add_status("end_sendmail", spans=send_spans.as_dict())
+            # A test mail which arrives after the round ended is still attributed to it
+            SentMailIndex.get_instance().add(self.uuid.hex, self._name[0],
+                                             [target.name for target in self._targets], sent)
+        except Exception as e:
+            self.log.exception(e)
+            self._error = True
+            self._send_failed = True
+            self._send_throttled = isinstance(e, (LoginThrottled, ConnectionPoolTimeout))
+            for target in self._targets:
+                target.error = True
+            self.log.error("Error by send E-Mail from {}".format(self._name[0]))
+
+    def _receive_failed(self, e):
+        self._error = True
+        for target in self._targets:
+            if not target.watch.future.done() or target.watch.future.exception() is not None:
+                target.error = True
+            if target.watch.future.done() and target.watch.future.exception() is not None:
+                target.unreachable = True
+        self.log.exception(e)
+        self.log.error("Error by Recive E-Mail at Mailbox {} ".format(self._name[1]))
+
+    def finish_round(self):
+        with self._profiling():
+            if self._error:
+                with self.spans.span("notify"):
+                    self.notify()
+            else:
+                self.log.info("SUCCESS between {} to {}".format(self._name[0], self._name[1]))
+                self.log.removeHandler(self._log_handler)
+                # log_contents = self._log_data.getvalue()
+                self._log_data.close()
+
+        self.spans.add("total", time.monotonic() - self._started)
+        spans = self.spans.as_dict()
+
+        for target in self._targets:
+            target.watcher.unregister(self.uuid.hex)
+            if target.error:
+                self.add_status("error", [target], spans=spans)
+                if target.graylisting:
+                    self.add_status("greylisting", [target])
+            else:
+                self.add_status("success", [target], spans=spans)
+
+        self.update_circuits()
+        call_round_hooks(self, spans)
+        if self._profiler is not None:
+            self._profiler.dump("{}_{}_{}".format(self._name[0], self._name[1], self.uuid.hex))
+
+    def update_circuits(self):
+        """
+        Report which servers were reachable to their circuit breakers
+        A test mail which did not arrive in time does not count, the servers were reachable
+        A throttled login or a full connection pool does not count either, the server was not asked
+        """
+        health = ServerHealth.get_instance()
+        if self._send_throttled:
+            return
+        if self._send_failed:
+            # Nothing is known about the inbox servers
+            health.breaker("out", self._name[0]).failure()
+            return
+
+        health.breaker("out", self._name[0]).success()
+        for target in self._targets:
+            if target.unreachable:
+                health.breaker("in", target.name).failure()
+            else:
+                health.breaker("in", target.name).success()
 
     def _gen_mail(self):
         self.log.debug("Generate E-Mail Message")
         msg = email.message.EmailMessage()
 
         msg["From"] = self._mail_out.email
-        msg["To"] = self._mail_in.email
+        # A fan-out round sends one message with one RCPT TO per inbox
+        msg["To"] = ", ".join(target.server.email for target in self._targets)
         msg['Subject'] = "[MailRound]"
 
-        msg.add_header('X-Mail-Round', str(self.uuid.hex))
+        msg.add_header(MAIL_ROUND_HEADER, str(self.uuid.hex))
+        if settings.SHARD_WORKER:
+            # Watchers of other workers on the same inbox leave this test mail alone
+            msg.add_header(MAIL_ROUND_WORKER_HEADER, settings.SHARD_WORKER)
         msg.set_content("""This is a TestMail from MailRound.
 Please do not delete this E-Mail Message. 
 If MailRound works it will be deleted""")
@@ -140,123 +356,73 @@ If MailRound works it will be deleted""")
 
     def sendmail(self):
         self.log.debug("Try to send mail via {}".format(self._mail_out.host))
-        conn = self._mail_out.get_connection()
 
+        # Errors are raised to send_phase, so the round does not wait for a mail which was never sent
         try:
-            conn.send_message(self._gen_mail())
-            self.log.info("E-Mail sucessfully send via {}".format(self._name[0]))
-        except Exception as e:
-            self.log.exception(e)
-            pass
-        finally:
-            conn.quit()
-
-    def _receive_idle(self, conn):
-        ENDIDLE = False
-
-        start_timestamp = datetime.datetime.now()
-        conn.idle()
-        self.log.debug("Set Mailbox to IDLE mode")
-        while not ENDIDLE:
-            try:
-                # Wait for up to 30 seconds for an IDLE response
-                responses = conn.idle_check(timeout=30)
-                for response in responses:
-                    # log.debug("Server sent:", response if response else "nothing")
-                    if response[1].decode() == 'RECENT' and response[0] > 0:
-                        ENDIDLE = True
-
-                    if datetime.datetime.now() > start_timestamp + settings.MAX_MAIL_RECEIVE_TIME:
-                        self.log.warn("Maximal Mailbox watchtime Reached. Terminate")
-                        ENDIDLE = True
-                        break
-
-            except KeyboardInterrupt:
-                break
-        conn.idle_done()
-
-    def _verify_mailround_mail(self, msg_id, data):
-        if b"RFC822" not in data:
-            return False
-        bin_body = data[b"RFC822"]
-
-        email_body = email.message_from_bytes(bin_body)
-        mail_round_uuid = email_body.get_all("X-Mail-Round")
-
-        if mail_round_uuid is None:
-            return False
-
-        if self.uuid.hex in mail_round_uuid:
-            self.log.debug("Found Mail with same UUID")
-            return True
-        else:
-            if len(mail_round_uuid) >= 1:
-                self._graylisting = True
-
-        return False
-
-    def _delete_msg(self, conn, msg_id):
-        conn.delete_messages(msg_id)
-        conn.expunge(msg_id)
-
-    def _seach_in_mailbox(self, conn):
-        FOUND_MAIL_ROUND_TEST = False
-        messages = conn.search()
-        for message_id, data in conn.fetch(messages, ['RFC822']).items():
-
-            if self._verify_mailround_mail(message_id, data):
-                FOUND_MAIL_ROUND_TEST = True
-
-                if hasattr(settings, "CLEANUP"):
-                    self._delete_msg(conn, message_id)
-                break
-        return FOUND_MAIL_ROUND_TEST
+            with self._mail_out.connection() as conn, span("send"):
+                conn.send_message(self._gen_mail())
+        except smtplib.SMTPServerDisconnected:
+            # The pooled session was closed by the server, retry once with a new one
+            self.log.debug("SMTP session to {} was closed. Reconnect".format(self._mail_out.host))
+            with self._mail_out.connection() as conn, span("send"):
+                conn.send_message(self._gen_mail())
+        self.log.info("E-Mail sucessfully send via {}".format(self._name[0]))
 
     def receive(self):
         self.log.debug("Wait for E-Mail")
 
-        start_timestamp = datetime.datetime.now()
+        futures = {target.watch.future: target for target in self._targets}
+        with self.spans.span("receive"):
+            done, pending = concurrent.futures.wait(futures, timeout=settings.MAX_MAIL_RECEIVE_TIME.total_seconds())
+        self._received([futures[future] for future in pending])
 
-        conn = self._mail_in.get_connection()
-        conn.select_folder('INBOX')
+        for future in done:
+            future.result()
 
-        FOUND_MAIL_ROUND_TEST = self._seach_in_mailbox(conn)
+    async def receive_async(self):
+        self.log.debug("Wait for E-Mail")
 
-        while not FOUND_MAIL_ROUND_TEST:
-            self._receive_idle(conn)
-            FOUND_MAIL_ROUND_TEST = self._seach_in_mailbox(conn)
+        # asyncio.wait does not cancel the watcher futures on timeout
+        futures = {asyncio.wrap_future(target.watch.future): target for target in self._targets}
+        with self.spans.span("receive"):
+            done, pending = await asyncio.wait(list(futures), timeout=settings.MAX_MAIL_RECEIVE_TIME.total_seconds())
+        self._received([futures[future] for future in pending])
 
-            if datetime.datetime.now() > start_timestamp + settings.MAX_MAIL_RECEIVE_TIME:
-                self.log.warn("Maximal Mailbox watchtime Reached. Terminate")
-                self._error = True
-                break
+        for future in done:
+            future.result()
 
-        if self._graylisting:
-            self.log.warn("Found other E-Mails with Mail-Round Header. this is a note for active greylog")
-
-        if self._error is False:
-            self.log.info("E-Mail successfuly recived at {} from {}".format(self._name[1], self._name[0]))
+    def _received(self, missing):
+        """
+        Evaluate the inboxes after waiting
+        :param missing: RoundTarget objects which did not receive the test mail in time
+        """
+        SentMailIndex.get_instance().ended(self.uuid.hex)
+        for target in self._targets:
+            target.watcher.unregister(self.uuid.hex)
+            target.graylisting = target.watch.graylisting
+
+            if target in missing:
+                self.log.warn("Maximal Mailbox watchtime Reached at {}. Terminate".format(target.name))
+                target.error = True
+                self._error = True
+            elif target.watch.future.exception() is None:
+                SentMailIndex.get_instance().arrived(self.uuid.hex, target.name)
+                self.add_status("end_receive", [target], woken=target.watch.woken, spans=target.watch.spans)
+                self.log.info("E-Mail successfuly recived at {} from {}".format(target.name, self._name[0]))
 
-        conn.logout()
+            if target.graylisting:
+                self._graylisting = True
+                self.log.warn("Found other E-Mails with Mail-Round Header at {}. "
+                              "this is a note for active greylog".format(target.name))
 
     def notify(self):
         self.log.removeHandler(self._log_handler)
         log_contents = self._log_data.getvalue()
         self._log_data.close()
 
-        body = {
-            "text": """*Mailround*
-Error between {}
-```{}```""".format("->".join(self._name), log_contents),
-        }
-
-        req = urllib.request.Request(settings.WEBHOOK_URL)
-        req.add_header('Content-Type', 'application/json; charset=utf-8')
-        jsondata = json.dumps(body)
-
-        jsondataasbytes = jsondata.encode('utf-8')
-        req.add_header('Content-Length', len(jsondataasbytes))
-
-        response = urllib.request.urlopen(req, jsondataasbytes)
+        if not settings.WEBHOOK_URL:
+            self.log.debug("No WEBHOOK_URL configured. Skip notification")
+            return
 
-        # print("NOTIFY!!!!")
+        # The notifier sends in its own thread, the round does not wait for the webhook
+        Notifier.get_instance().notify("->".join(self._name), log_contents)
@@ -0,0 +1,142 @@
+import heapq
+import logging
+import random
+import time
+
+from config import settings
+
+log = logging.getLogger("mailround.controller.scheduler")
+
+
+class RoundScheduler:
+
+    @staticmethod
+    def from_settings():
+        """
+        Build the schedule of all MAIL_ROUND rounds
+        A pair uses its ROUND_INTERVAL entry or CHECK_INTERVAL,
+        a fan-out round runs with the shortest interval of its pairs
+        """
+        return RoundScheduler(settings.get_round_intervals(), settings.SCHEDULE_JITTER.total_seconds(),
+                              settings.SCHEDULE_SPREAD)
+
+    def __init__(self, intervals, jitter=0.0, spread=True, now=None):
+        """
+        Heap of round deadlines
+        :param intervals: dict of round key -> interval in seconds
+        :param jitter: maximal random delay in seconds added to every deadline
+        :param spread: spread the first deadlines of rounds with the same interval over the interval
+        :param now: start time (time.monotonic())
+        """
+        self.intervals = intervals
+        self.jitter = jitter
+        self._heap = []
+        self._sequence = 0
+        # round key -> deadline of its next regular run without jitter, the jitter does not add up over the runs
+        self._base = {}
+        # round keys with a pending extra run (delay)
+        self._delayed = set()
+
+        # Statistics of the delay between deadline and dispatch
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self.dispatched = 0
+        self.skipped = 0
+
+        now = time.monotonic() if now is None else now
+
+        # Rounds with the same interval get evenly distributed phases
+        by_interval = {}
+        for key, interval in sorted(intervals.items()):
+            by_interval.setdefault(interval, []).append(key)
+
+        for interval, keys in by_interval.items():
+            for position, key in enumerate(keys):
+                phase = interval * position / len(keys) if spread else 0.0
+                self._base[key] = now + phase
+                self._push(self._base[key] + self._jitter(), key)
+
+    def _jitter(self):
+        if self.jitter <= 0:
+            return 0.0
+        return random.uniform(0, self.jitter)
+
+    def _push(self, deadline, key, repeat=True):
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, key, repeat))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def time_until_next(self, now=None):
+        """
+        Seconds until the next deadline (0 if a round is due, None if nothing is scheduled)
+        """
+        if not self._heap:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._heap[0][0] - now)
+
+    def pop_due(self, now=None):
+        """
+        Remove all due rounds and schedule their next run
+        Missed runs (eg. after a suspend) are not caught up, the next deadline is always in the future
+        Only regular deadlines count as dispatched, an extra run of delay() does not
+        :return: list of (round key, lag in seconds, True for a regular deadline)
+        """
+        now = time.monotonic() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, sequence, key, repeat = heapq.heappop(self._heap)
+            lag = now - deadline
+            due.append((key, lag, repeat))
+
+            if not repeat:
+                self._delayed.discard(key)
+                continue
+
+            interval = self.intervals[key]
+            base = self._base.get(key, deadline)
+            next_base = base + interval
+            if next_base <= now:
+                next_base = now + interval - (now - base) % interval
+            self._base[key] = next_base
+            self._push(next_base + self._jitter(), key)
+
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_sum += lag
+            self.dispatched += 1
+        return due
+
+    def delay(self, key, seconds, now=None):
+        """
+        Run a round once after the given time in addition to its regular deadlines
+        A round has at most one pending extra run
+        """
+        if key in self._delayed:
+            return
+        now = time.monotonic() if now is None else now
+        self._delayed.add(key)
+        self._push(now + seconds, key, repeat=False)
+
+    def add(self, key, interval, now=None):
+        """
+        Schedule a new round, its first run is due at once
+        :param interval: interval in seconds
+        """
+        now = time.monotonic() if now is None else now
+        self.intervals[key] = interval
+        self._base[key] = now
+        self._push(now + self._jitter(), key)
+
+    def remove(self, key):
+        """
+        Remove all deadlines of a round
+        """
+        self._heap = [entry for entry in self._heap if entry[2] != key]
+        heapq.heapify(self._heap)
+        self.intervals.pop(key, None)
+        self._base.pop(key, None)
+        self._delayed.discard(key)
@@ -0,0 +1,148 @@
+import logging
+import os
+import re
+import struct
+
+import msgpack
+
+log = logging.getLogger("mailround.controller.segment")
+
+# Every record is stored as <4 byte big endian length><msgpack payload>
+RECORD_HEADER = struct.Struct(">I")
+
+
+def pack_record(record):
+    """
+    Serialize one record with its length prefix
+    :param record: dict which should be stored
+    :return: bytes
+    """
+    payload = msgpack.packb(record, use_bin_type=True)
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+
+def iter_raw_records(fobj):
+    """
+    Read all length prefixed records from a file object without unpacking them
+    A truncated record at the end of the file (eg. after a crash) ends the iteration
+    :param fobj: binary file object
+    :return: generator of (offset, raw record bytes including the length prefix)
+    """
+    offset = fobj.tell()
+    while True:
+        header = fobj.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            if header:
+                log.warning("Truncated record header at offset {}".format(offset))
+            return
+        length, = RECORD_HEADER.unpack(header)
+        payload = fobj.read(length)
+        if len(payload) < length:
+            log.warning("Truncated record at offset {}".format(offset))
+            return
+        yield offset, header + payload
+        offset += RECORD_HEADER.size + length
+
+
+def iter_records(fobj):
+    """
+    Read all length prefixed records from a file object
+    :param fobj: binary file object
+    :return: generator of (offset, record)
+    """
+    for offset, raw in iter_raw_records(fobj):
+        yield offset, msgpack.unpackb(raw[RECORD_HEADER.size:], raw=False)
+
+
+class SegmentStore:
+
+    def __init__(self, path, max_size):
+        """
+        Rotating list of append-only record files
+        The segments are stored next to the given path as <path>.000001, <path>.000002, ...
+        :param path: Base path of the status log
+        :param max_size: Size in bytes after which a new segment is started
+        """
+        self.path = path
+        self.max_size = max_size
+        self._pattern = re.compile(r"^{}\.(?P<number>\d{{6}})$".format(re.escape(os.path.basename(path))))
+
+    def segment_path(self, number):
+        return "{}.{:06d}".format(self.path, number)
+
+    def segments(self):
+        """
+        List all existing segments
+        :return: sorted list of (number, path)
+        """
+        directory = os.path.dirname(self.path) or "."
+        if not os.path.isdir(directory):
+            return []
+
+        result = []
+        for filename in os.listdir(directory):
+            match = self._pattern.match(filename)
+            if match:
+                result.append((int(match["number"]), os.path.join(directory, filename)))
+        return sorted(result)
+
+    def current_segment(self):
+        """
+        Number of the segment new records are appended to
+        :return: int
+        """
+        segments = self.segments()
+        if not segments:
+            return 1
+        return segments[-1][0]
+
+    def size(self, number):
+        try:
+            return os.path.getsize(self.segment_path(number))
+        except FileNotFoundError:
+            return 0
+
+    def append(self, number, data):
+        """
+        Append a batch of packed records with a single write call
+        :param number: segment number
+        :param data: bytes of one or more records created by pack_record
+        :return: offset of the first written record
+        """
+        with open(self.segment_path(number), "ab") as fobj:
+            offset = fobj.tell()
+            fobj.write(data)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        return offset
+
+    def replace(self, number, data):
+        """
+        Atomically replace the content of a closed segment
+        :param number: segment number
+        :param data: bytes of the new records
+        """
+        path = self.segment_path(number)
+        with open("{}.tmp".format(path), "wb") as fobj:
+            fobj.write(data)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.replace("{}.tmp".format(path), path)
+
+    def read(self, number):
+        """
+        Read all records of one segment
+        :param number: segment number
+        :return: generator of (offset, record)
+        """
+        with open(self.segment_path(number), "rb") as fobj:
+            yield from iter_records(fobj)
+
+    def read_raw(self, number):
+        """
+        Read all records of one segment without unpacking them
+        :param number: segment number
+        :return: generator of (offset, raw record bytes)
+        """
+        with open(self.segment_path(number), "rb") as fobj:
+            yield from iter_raw_records(fobj)
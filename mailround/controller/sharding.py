@@ -0,0 +1,239 @@
+import bisect
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import socket
+import time
+
+from controller.metrics import register_collector
+
+log = logging.getLogger("mailround.controller.sharding")
+
+
+def hash_key(value):
+    """
+    Position on the hash ring, stable across processes and hosts (unlike hash())
+    """
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def round_name(key):
+    """
+    :param key: (outname, tuple of innames)
+    """
+    outname, innames = key
+    return "{}:{}".format(outname, ",".join(innames))
+
+
+def worker_name(index, host=None):
+    """
+    Name of a worker, it is stable across restarts so its rounds do not move
+    :param index: number of the worker on this host
+    """
+    host = host or socket.gethostname()
+    return re.sub(r"[^A-Za-z0-9_-]", "-", "{}-{}".format(host, index))
+
+
+def worker_statuslog_path(path, worker):
+    """
+    Every worker writes its own status log next to the main status log
+    """
+    return "{}.{}".format(path, worker)
+
+
+class HashRing:
+
+    def __init__(self, members, replicas=64):
+        """
+        Consistent hashing: when a member joins or leaves only the rounds of that member move
+        :param members: names of the members
+        :param replicas: points of every member on the ring
+        """
+        self.members = sorted(members)
+        points = sorted((hash_key("{}#{}".format(member, replica)), member)
+                        for member in self.members for replica in range(replicas))
+        self._hashes = [point for point, member in points]
+        self._members = [member for point, member in points]
+
+    def owner(self, name):
+        """
+        :return: member which owns the given name or None if the ring is empty
+        """
+        if not self._hashes:
+            return None
+        position = bisect.bisect(self._hashes, hash_key(name)) % len(self._hashes)
+        return self._members[position]
+
+
+class FileLease:
+
+    def __init__(self, path):
+        """
+        Exclusive lease on a file with a POSIX record lock (works on local disks and NFS)
+        The operating system releases the lease when the process dies
+        :param path: lock file
+        """
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self, content=None):
+        """
+        Try to take the lease without waiting
+        :param content: optional text written into the lock file (eg. owner for debugging)
+        :return: True if this process holds the lease
+        """
+        if self._fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        if content is not None:
+            os.ftruncate(fd, 0)
+            os.write(fd, content.encode("utf-8"))
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def is_held(path):
+        """
+        Check if another process holds the lease of a file
+        Never use this for a lease of the own process: closing the test descriptor would drop the own lock
+        """
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        else:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            return False
+        finally:
+            os.close(fd)
+
+
+class ShardCoordinator:
+
+    def __init__(self, directory, worker, refresh_interval):
+        """
+        Decide which rounds this worker runs
+        Every worker holds a lease on <directory>/<worker>.member while it lives. The rounds are split over all
+        living workers with consistent hashing, and a worker only runs a round while it holds the lease
+        <directory>/round-<hash>.lock, so a round never runs in two workers even while they disagree about
+        the members (eg. right after a worker joined)
+        :param directory: directory shared by all workers (also on several hosts)
+        :param worker: name of this worker
+        :param refresh_interval: seconds between two checks of the members
+        """
+        self.directory = directory
+        self.worker = worker
+        self.refresh_interval = refresh_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.member = FileLease(self.member_path(worker))
+        if not self.member.acquire("{} {}\n".format(socket.gethostname(), os.getpid())):
+            raise RuntimeError("Worker {} is already running".format(worker))
+
+        # round key -> FileLease
+        self._leases = {}
+        self._owned = set()
+        self._next_refresh = 0
+        self.members = [worker]
+        register_collector(self.metrics)
+
+    def member_path(self, worker):
+        return os.path.join(self.directory, "{}.member".format(worker))
+
+    def lease_path(self, key):
+        return os.path.join(self.directory, "round-{:016x}.lock".format(hash_key(round_name(key))))
+
+    def living_members(self):
+        """
+        :return: sorted list of the names of all workers which hold their member lease
+        """
+        members = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".member"):
+                continue
+            worker = filename[:-len(".member")]
+            if worker == self.worker or FileLease.is_held(os.path.join(self.directory, filename)):
+                members.append(worker)
+        return sorted(members)
+
+    def time_until_refresh(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._next_refresh - now)
+
+    def refresh(self, keys, busy=(), now=None):
+        """
+        Update the members and the leases of the rounds
+        :param keys: all configured round keys
+        :param busy: keys of rounds which are running in this worker, their lease is kept until they are finished
+        """
+        now = time.monotonic() if now is None else now
+        self._next_refresh = now + self.refresh_interval
+
+        members = self.living_members()
+        if members != self.members:
+            log.info("Shard members: {}".format(", ".join(members)))
+            self.members = members
+        ring = HashRing(members)
+
+        owned = set()
+        for key in keys:
+            lease = self._leases.get(key)
+            if ring.owner(round_name(key)) == self.worker:
+                if lease is None:
+                    lease = self._leases[key] = FileLease(self.lease_path(key))
+                if lease.acquire(round_name(key)):
+                    owned.add(key)
+            elif lease is not None and key not in busy:
+                lease.release()
+                del self._leases[key]
+
+        for key in [key for key in self._leases if key not in keys and key not in busy]:
+            self._leases.pop(key).release()
+
+        if owned != self._owned:
+            log.info("Worker {} runs {} of {} rounds".format(self.worker, len(owned), len(keys)))
+        self._owned = owned
+
+    def owns(self, key):
+        return key in self._owned
+
+    def close(self):
+        for lease in self._leases.values():
+            lease.release()
+        self._leases = {}
+        self._owned = set()
+        self.member.release()
+
+    def metrics(self):
+        return [
+            "# TYPE mailround_shard_members gauge",
+            "mailround_shard_members {}".format(len(self.members)),
+            "# TYPE mailround_shard_rounds_owned gauge",
+            'mailround_shard_rounds_owned{{worker="{}"}} {}'.format(self.worker, len(self._owned)),
+        ]
@@ -0,0 +1,103 @@
+import contextlib
+import logging
+import threading
+import time
+
+log = logging.getLogger("mailround.controller.spans")
+
+_local = threading.local()
+
+# Callables which are called with (round_trip, spans) after every round
+_round_hooks = []
+
+
+class SpanRecorder:
+
+    def __init__(self):
+        """
+        Collect the monotonic durations of the phases of a round
+        Phases which occur several times (eg. IDLE cycles) are summed up and counted
+        """
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def as_dict(self):
+        """
+        :return: dict of phase name -> seconds, repeated phases also get a <name>_count entry
+        """
+        result = {}
+        for name, seconds in self.durations.items():
+            result[name] = round(seconds, 6)
+            if self.counts[name] > 1:
+                result["{}_count".format(name)] = self.counts[name]
+        return result
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """
+    Make the recorder the target of span() in the current thread
+    So connection setup in the pool is attributed to the round which leased the connection
+    :param recorder: SpanRecorder
+    """
+    previous = getattr(_local, "recorder", None)
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Measure a phase for the recorder of the current thread (does nothing without recorder)
+    """
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        yield
+        return
+    with recorder.span(name):
+        yield
+
+
+def add_span(name, seconds):
+    """
+    Add a duration which was measured elsewhere to the recorder of the current thread (eg. a wait)
+    """
+    recorder = getattr(_local, "recorder", None)
+    if recorder is not None:
+        recorder.add(name, seconds)
+
+
+def add_round_hook(hook):
+    """
+    Register a callback which gets the spans of every finished round
+    :param hook: callable(round_trip, spans) spans is a dict of phase name -> seconds
+    """
+    _round_hooks.append(hook)
+
+
+def remove_round_hook(hook):
+    if hook in _round_hooks:
+        _round_hooks.remove(hook)
+
+
+def call_round_hooks(round_trip, spans):
+    for hook in list(_round_hooks):
+        try:
+            hook(round_trip, spans)
+        except Exception as e:
+            log.exception(e)
@@ -0,0 +1,382 @@
+import array
+import bisect
+import io
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import msgpack
+from controller.segment import RECORD_HEADER, SegmentStore, iter_raw_records
+
+log = logging.getLogger("mailround.controller.statusindex")
+
+# Status names of a round, records and index entries keep the index instead of the name
+STATUS_NAMES = ("start", "start_sendmail", "end_sendmail", "start_receive", "end_receive", "success", "error",
+                "greylisting", "late_arrival")
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+# Index codes of records which are no round status
+CODE_OTHER_STATUS = 250
+CODE_SUMMARY = 251
+
+# Every index entry is <timestamp><offset in the segment><hash of the server pair><record code>
+INDEX_ENTRY = struct.Struct(">dQIB3x")
+
+
+def pair_hash(outname, inname):
+    """
+    Short identity of a server pair for the index (collisions are resolved by reading the record)
+    """
+    return zlib.crc32("{}\0{}".format(outname, inname).encode())
+
+
+def index_entry(record, offset):
+    """
+    Build the index entry of one record
+    :param record: record dict
+    :param offset: offset of the record in its segment
+    :return: packed entry or None if the record is not indexed (version, config, signature, seal)
+    """
+    kind = record.get("record")
+    if kind == "status":
+        code = STATUS_CODES.get(record["status"], CODE_OTHER_STATUS)
+        timestamp = record["timestamp"]
+    elif kind == "summary":
+        code = CODE_SUMMARY
+        timestamp = record["start"]
+    else:
+        return None
+    return INDEX_ENTRY.pack(timestamp, offset, pair_hash(record["out"], record["in"]), code)
+
+
+def index_column(data, typecode, position):
+    """
+    One field of all packed entries without unpacking every entry
+    :param data: bytes of packed entries
+    :param typecode: array typecode of the field ("d" for the timestamp, "Q" for the offset)
+    :param position: position of the field in units of its size
+    :return: array of the field values
+    """
+    column = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "little":
+        column.byteswap()
+    return column[position::INDEX_ENTRY.size // column.itemsize]
+
+
+def sort_entries(data):
+    """
+    Sort packed entries by timestamp
+    Timestamps are positive, so the big endian entries sort by timestamp and offset as raw bytes
+    :param data: bytes of packed entries
+    :return: bytes of the sorted entries
+    """
+    return b"".join(sorted(data[start:start + INDEX_ENTRY.size] for start in range(0, len(data), INDEX_ENTRY.size)))
+
+
+class SegmentIndex:
+
+    def __init__(self, store, number):
+        """
+        Sidecar index <segment>.idx of one segment
+        The writer appends the entries of every batch after the batch itself was written,
+        so the index may only miss records at the end of a segment (eg. after a crash)
+        The index of a closed segment is sorted by timestamp
+        :param store: SegmentStore
+        :param number: segment number
+        """
+        self.store = store
+        self.number = number
+        self.path = "{}.idx".format(store.segment_path(number))
+
+    def append(self, entries):
+        """
+        :param entries: bytes of one or more packed entries
+        """
+        with open(self.path, "ab") as fobj:
+            fobj.write(entries)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def write(self, data):
+        """
+        Atomically replace the index file
+        :param data: bytes of all entries
+        """
+        with open("{}.tmp".format(self.path), "wb") as fobj:
+            fobj.write(data)
+        os.replace("{}.tmp".format(self.path), self.path)
+
+    def build(self, persist=True, segment=None):
+        """
+        Create the index by reading the whole segment
+        :param persist: write the index file (only for segments the writer does not append to anymore)
+        :param segment: bytes of the segment content (eg. before they replace the segment), default is the segment file
+        :return: bytes of all entries
+        """
+        entries = []
+        with open(self.store.segment_path(self.number), "rb") if segment is None else io.BytesIO(segment) as fobj:
+            for offset, raw in iter_raw_records(fobj):
+                entry = index_entry(msgpack.unpackb(raw[RECORD_HEADER.size:], raw=False), offset)
+                if entry is not None:
+                    entries.append(entry)
+        data = b"".join(entries)
+
+        if persist:
+            data = sort_entries(data)
+            self.write(data)
+        return data
+
+    def sort(self, data=None):
+        """
+        Sort the index of a closed segment, so queries can bisect it
+        :param data: bytes of the loaded entries
+        :return: bytes of the sorted entries
+        """
+        data = sort_entries(self.load() if data is None else data)
+        self.write(data)
+        return data
+
+    def matches(self, data):
+        """
+        Check the entry with the highest offset against the record of the segment,
+        an index which belongs to another content of the segment (eg. an interrupted compaction) does not match
+        :param data: bytes of all entries
+        """
+        offsets = index_column(data, "Q", 1)
+        start = offsets.index(max(offsets)) * INDEX_ENTRY.size
+        offset = offsets[start // INDEX_ENTRY.size]
+        try:
+            with SegmentReader(self.store, self.number) as reader:
+                if reader.record_end(offset) > len(reader):
+                    return False
+                return index_entry(reader.read(offset), offset) == data[start:start + INDEX_ENTRY.size]
+        except (ValueError, TypeError, KeyError, AttributeError, struct.error):
+            return False
+
+    def load(self, persist=True):
+        """
+        Read the index, a missing or outdated index is rebuilt
+        :return: bytes of all entries
+        """
+        try:
+            with open(self.path, "rb") as fobj:
+                data = fobj.read()
+        except FileNotFoundError:
+            log.debug("Build missing index of segment {}".format(self.number))
+            return self.build(persist)
+
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+        if data and not self.matches(data):
+            log.debug("Index of segment {} is outdated. Rebuild".format(self.number))
+            return self.build(persist)
+        return data
+
+
+class SegmentReader:
+
+    def __init__(self, store, number):
+        """
+        Memory mapped access to single records of a segment
+        :param store: SegmentStore
+        :param number: segment number
+        """
+        self._fobj = open(store.segment_path(number), "rb")
+        size = os.fstat(self._fobj.fileno()).st_size
+        self._map = mmap.mmap(self._fobj.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._fobj.close()
+
+    def __len__(self):
+        return len(self._map)
+
+    def record_end(self, offset):
+        length, = RECORD_HEADER.unpack_from(self._map, offset)
+        return offset + RECORD_HEADER.size + length
+
+    def read(self, offset):
+        """
+        Unpack the record at the given offset
+        """
+        start = offset + RECORD_HEADER.size
+        return msgpack.unpackb(self._map[start:self.record_end(offset)], raw=False)
+
+    def iter_from(self, offset):
+        """
+        Unpack all complete records from offset to the end of the segment
+        :return: generator of (offset, record)
+        """
+        while offset + RECORD_HEADER.size <= len(self._map):
+            end = self.record_end(offset)
+            if end > len(self._map):
+                return
+            yield offset, self.read(offset)
+            offset = end
+
+
+def quantile(values, q):
+    """
+    Exact quantile of sorted values (nearest rank)
+    """
+    if not values:
+        return None
+    position = max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))
+    return values[position]
+
+
+class StatusQuery:
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024):
+        """
+        Answer questions about the status log with the segment indexes
+        Only the records selected by the index are unpacked
+        :param path: Base path of the status log
+        """
+        self.store = SegmentStore(path, segment_size)
+
+    def entries(self, since=None, until=None, pair=None, codes=None):
+        """
+        Select records by time, server pair and record code
+        :param since: start timestamp (inclusive)
+        :param until: end timestamp (exclusive)
+        :param pair: (outname, inname)
+        :param codes: set of index codes
+        :return: generator of (SegmentReader, timestamp, offset, pair hash, code)
+        """
+        wanted = pair_hash(*pair) if pair is not None else None
+        segments = self.store.segments()
+        last = segments[-1][0] if segments else None
+
+        for number, path in segments:
+            # The last segment may still be written, its index is not persisted by a reader
+            segment_index = SegmentIndex(self.store, number)
+            index = segment_index.load(persist=number != last)
+            timestamps = index_column(index, "d", 0)
+            ordered = timestamps == array.array("d", sorted(timestamps))
+            if not ordered and number != last:
+                # Index of a segment closed before the indexes were sorted
+                index = segment_index.sort(index)
+                timestamps = index_column(index, "d", 0)
+                ordered = True
+
+            first, end = 0, len(timestamps)
+            if ordered:
+                if since is not None:
+                    first = bisect.bisect_left(timestamps, since)
+                if until is not None:
+                    end = bisect.bisect_left(timestamps, until, first)
+            elif timestamps and ((since is not None and max(timestamps) < since) or
+                                 (until is not None and min(timestamps) >= until)):
+                end = 0
+
+            with SegmentReader(self.store, number) as reader:
+                selected = index[first * INDEX_ENTRY.size:end * INDEX_ENTRY.size]
+                for timestamp, offset, entry_pair, code in INDEX_ENTRY.iter_unpack(selected):
+                    if since is not None and timestamp < since:
+                        continue
+                    if until is not None and timestamp >= until:
+                        continue
+                    if wanted is not None and entry_pair != wanted:
+                        continue
+                    if codes is not None and code not in codes:
+                        continue
+                    yield reader, timestamp, offset, entry_pair, code
+
+                # Records after the last indexed one are read directly (index entries are written after the batch)
+                tail = reader.record_end(max(index_column(index, "Q", 1))) if index else 0
+                for offset, record in reader.iter_from(tail):
+                    entry = index_entry(record, offset)
+                    if entry is None:
+                        continue
+                    timestamp, offset, entry_pair, code = INDEX_ENTRY.unpack(entry)
+                    if (since is None or timestamp >= since) and (until is None or timestamp < until) and \
+                            (wanted is None or entry_pair == wanted) and (codes is None or code in codes):
+                        yield reader, timestamp, offset, entry_pair, code
+
+    def pairs(self, since=None, until=None):
+        """
+        All server pairs with records in the time range
+        :return: sorted list of (outname, inname)
+        """
+        names = {}
+        for reader, timestamp, offset, pair, code in self.entries(since, until):
+            # Only the first record of every pair is unpacked
+            if pair not in names:
+                record = reader.read(offset)
+                names[pair] = (record["out"], record["in"])
+        return sorted(names.values())
+
+    def pair_stats(self, outname, inname, since=None, until=None):
+        """
+        Success rate and delivery time of one server pair
+        :param since: start timestamp (inclusive)
+        :param until: end timestamp (exclusive)
+        :return: dict
+        """
+        pair = (outname, inname)
+        codes = {STATUS_CODES["start_sendmail"], STATUS_CODES["end_receive"], STATUS_CODES["success"],
+                 STATUS_CODES["error"], STATUS_CODES["greylisting"], CODE_SUMMARY}
+
+        result = {"out": outname, "in": inname, "rounds": 0, "success": 0, "error": 0, "greylisting": 0}
+        sent = {}
+        received = {}
+        summary_delivered = 0
+        summary_delivery_sum = 0.0
+
+        for reader, timestamp, offset, entry_pair, code in self.entries(since, until, pair, codes):
+            record = reader.read(offset)
+            # The index only knows the hash of the pair
+            if (record["out"], record["in"]) != pair:
+                continue
+
+            if code == CODE_SUMMARY:
+                for name in ["rounds", "success", "error", "greylisting"]:
+                    result[name] += record.get(name, 0)
+                summary_delivered += record.get("delivered", 0)
+                summary_delivery_sum += record.get("delivery_sum", 0.0)
+            elif code == STATUS_CODES["start_sendmail"]:
+                sent[record.get("group")] = timestamp
+            elif code == STATUS_CODES["end_receive"]:
+                received[record.get("group")] = timestamp
+            else:
+                status = STATUS_NAMES[code]
+                result[status] += 1
+                if status != "greylisting":
+                    result["rounds"] += 1
+
+        delivery = sorted(received[group] - sent[group] for group in received if group in sent)
+        delivered = len(delivery) + summary_delivered
+
+        result["success_rate"] = result["success"] / result["rounds"] if result["rounds"] else None
+        result["delivered"] = delivered
+        result["delivery_mean"] = (sum(delivery) + summary_delivery_sum) / delivered if delivered else None
+        # Quantiles are only known for rounds which are not summarized yet
+        result["delivery_p50"] = quantile(delivery, 0.5)
+        result["delivery_p95"] = quantile(delivery, 0.95)
+        result["delivery_p99"] = quantile(delivery, 0.99)
+        result["delivery_max"] = delivery[-1] if delivery else None
+        return result
+
+    def stats(self, since=None, until=None):
+        """
+        pair_stats of all server pairs with records in the time range
+        :return: list of dicts
+        """
+        return [self.pair_stats(outname, inname, since, until) for outname, inname in self.pairs(since, until)]
@@ -2,17 +2,124 @@ import hashlib
 import json
 import logging
 import os
+import sys
 import threading
 import time
-from queue import Queue
+from queue import Empty, Full, Queue
 
 import msgpack
 from config import settings
 from config.mail import MailSmtpServer, MailPopServer, MailImapServer
-from jsonschema import validate
+from controller.metrics import RoundMetrics, register_collector
+from controller.segment import SegmentStore, pack_record, RECORD_HEADER
+from controller.statusindex import STATUS_CODES, STATUS_NAMES, SegmentIndex, index_entry
+from jsonschema import Draft7Validator
 
 log = logging.getLogger("controller.statuslog")
 
+STATUS_LOG_VERSION = "2.0.0"
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "statuslog.schema")
+
+_validator = None
+
+
+def get_validator():
+    """
+    Load the record schema once and keep the compiled validator
+    :return: Draft7Validator
+    """
+    global _validator
+    if _validator is None:
+        with open(SCHEMA_PATH, "r") as fobj:
+            schema = json.load(fobj)
+        Draft7Validator.check_schema(schema)
+        _validator = Draft7Validator(schema)
+    return _validator
+
+
+def server_entry_key(entry):
+    """
+    Identity of a server config entry, two entries with the same key describe the same server
+    """
+    return entry["server_type"], entry["host"], int(entry["port"]), entry["server_name"], bool(entry["use_ssl"])
+
+
+def chain_signature(previous, data):
+    """
+    Signature of a batch of records chained to the signature of the batch before
+    :param previous: hexdigest of the previous batch ("" for the first batch of a segment)
+    :param data: raw bytes of all records of this batch
+    :return: hexdigest
+    """
+    m = hashlib.sha256()
+    m.update(previous.encode())
+    m.update(data)
+    return m.hexdigest()
+
+
+def segment_link(store, number):
+    """
+    Value the next segment is chained to: the seal of a compacted segment or the last signature
+    :param store: SegmentStore
+    :param number: segment number
+    :return: hexdigest ("" if the segment has no signature)
+    """
+    link = ""
+    sealed = False
+    for offset, raw in store.read_raw(number):
+        record = msgpack.unpackb(raw[RECORD_HEADER.size:], raw=False)
+        if record.get("record") == "seal":
+            link = record.get("seal", "")
+            sealed = True
+        elif record.get("record") == "signature" and not sealed:
+            link = record.get("signature", "")
+    return link
+
+
+class StatusRecord:
+    __slots__ = ("group", "out", "inname", "code", "timestamp", "extra")
+
+    def __init__(self, group, outname, inname, status, timestamp, extra=None):
+        """
+        Status message of a round while it waits in the queue of the status log
+        :param status: status name, known names are stored as numeric code
+        :param extra: dict with additional values (eg. spans) or None
+        """
+        self.group = group
+        self.out = outname
+        self.inname = inname
+        self.code = STATUS_CODES.get(status, status)
+        self.timestamp = timestamp
+        self.extra = extra
+
+    @property
+    def status(self):
+        if isinstance(self.code, int):
+            return STATUS_NAMES[self.code]
+        return self.code
+
+    def get(self, key, default=None):
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def to_dict(self):
+        """
+        :return: status record as it is written to the status log
+        """
+        record = {
+            "record": "status",
+            "group": self.group,
+            "out": self.out,
+            "in": self.inname,
+            "status": self.status,
+            "timestamp": self.timestamp,
+        }
+        if self.extra:
+            record.update(self.extra)
+        return record
+
 
 class StatusLog:
     instance = False
@@ -24,139 +131,281 @@ class StatusLog:
         return StatusLog.instance
 
     def __init__(self):
-        self.queue = Queue()
+        self.queue = Queue(maxsize=settings.STATUS_LOG_QUEUE_SIZE)
         self._stop = False
+        # Server names are interned, every record of a pair refers to the same string objects
+        self._names = {}
+
+        # Statistics
+        self.dropped = 0
+        self.blocked = 0
         self._writer_thread = StatusWriter(self, name="statuswriter")
         self._writer_thread.start()
+        self._compactor_thread = StatusCompactor(self, name="statuscompactor", daemon=True)
+        self._compactor_thread.start()
+        register_collector(self.metrics)
 
     def __del__(self):
         self._writer_thread.join(12)
 
-    def stop(self):
+    def stop(self, timeout=1):
+        """
+        Stop the writer, it writes the queued status messages before it ends
+        :param timeout: seconds to wait for the writer (None waits until everything is written)
+        """
         self._stop = True
-        self._writer_thread.join(1)
+        self._writer_thread.join(timeout)
+
+    def _intern(self, name):
+        interned = self._names.get(name)
+        if interned is None:
+            interned = self._names[name] = sys.intern(name)
+        return interned
 
     def add_status(self, group, outname, inname, status, **kwargs):
-        options = {
-            "group": group,
-            "out": outname,
-            "in": inname,
-            "status": status,
-            "timestamp": time.time(),
-        }
-        options.update(kwargs)
-        self.queue.put(options)
+        record = StatusRecord(group, self._intern(outname), self._intern(inname), status, time.time(),
+                              kwargs or None)
+        RoundMetrics.get_instance().observe_status(record)
+        self._put(record)
+
+    def _put(self, record):
+        """
+        Queue a record, when the queue is full the STATUS_LOG_QUEUE_POLICY decides:
+        "block" waits up to STATUS_LOG_QUEUE_TIMEOUT for the writer, "drop" discards the record at once
+        """
+        try:
+            self.queue.put_nowait(record)
+            return
+        except Full:
+            pass
+
+        if settings.STATUS_LOG_QUEUE_POLICY == "block":
+            self.blocked += 1
+            try:
+                self.queue.put(record, timeout=settings.STATUS_LOG_QUEUE_TIMEOUT.total_seconds())
+                return
+            except Full:
+                pass
+
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            log.warning("Statuslog queue is full. {} status messages dropped".format(self.dropped))
+
+    def metrics(self):
+        """
+        Status log metrics in the Prometheus text format
+        """
+        writer = self._writer_thread
+        return [
+            "# TYPE mailround_statuslog_queue_length gauge",
+            "mailround_statuslog_queue_length {}".format(self.queue.qsize()),
+            "# TYPE mailround_statuslog_dropped_total counter",
+            "mailround_statuslog_dropped_total {}".format(self.dropped),
+            "# TYPE mailround_statuslog_blocked_total counter",
+            "mailround_statuslog_blocked_total {}".format(self.blocked),
+            "# TYPE mailround_statuslog_batches_total counter",
+            "mailround_statuslog_batches_total {}".format(writer.batches),
+            "# TYPE mailround_statuslog_records_total counter",
+            "mailround_statuslog_records_total {}".format(writer.records),
+            "# TYPE mailround_statuslog_written_bytes_total counter",
+            "mailround_statuslog_written_bytes_total {}".format(writer.written),
+        ]
 
     def get_queue(self):
         return self.queue
 
+    def active_segment(self):
+        """
+        Number of the segment the writer currently appends to
+        All segments with a lower number are closed and can be compacted
+        """
+        return self._writer_thread._segment
+
 
 class StatusWriter(threading.Thread):
 
     def __init__(self, statuslog, *args, **kwargs):
         super(StatusWriter, self).__init__(*args, **kwargs)
         self.statuslog = statuslog
+        self.store = SegmentStore(settings.STATUS_LOG_PATH, settings.STATUS_LOG_SEGMENT_SIZE)
+        # Segment which receives new records
+        # An existing segment is never continued, so the signature chain always starts inside this process
+        self._segment = self.store.current_segment()
+        if self.store.size(self._segment) > 0:
+            self._segment += 1
+        # time.monotonic() of the first batch in the current segment
+        self._segment_started = None
+        # Last config record written to the current segment
+        self._last_config = None
+        # Signature of the last batch in the current segment
+        self._signature = ""
+        # The first signature of a segment is chained to the last signature of the previous segment
+        previous = [number for number, path in self.store.segments() if number < self._segment]
+        self._link = segment_link(self.store, previous[-1]) if previous else ""
+
+        # Statistics
+        self.batches = 0
+        self.records = 0
+        self.written = 0
 
     def get_queue(self):
         return self.statuslog.get_queue()
 
     def run(self):
-
         while not self.statuslog._stop:
+            batch = self.collect_batch()
+            if batch:
+                self.flush(batch)
+            elif self._segment_started is not None:
+                self.rotate_aged()
 
-            if not self.get_queue().empty():
-                with open(settings.STATUS_LOG_PATH, "ab+") as fobj:
-                    fobj.seek(0)
-
-                    if len(fobj.read()) > 0:
-                        data = self.read_statuslog(fobj)
-                    else:
-                        data = {}
-
-                    if self.integrity_check(data):
-                        if data == {}:
-                            data["version"] = "1.0.0"
-
-                        data = self.cleanup_statuslog(data)
-                        data = self.update_settings_at_statuslog(data)
-                        data = self.add_status_to_statuslog(data)
-                        self.write_statuslog(fobj, data)
-                    else:
-                        log.error("Corrupt File")
-            time.sleep(1)
-
-    def integrity_check(self, data):
-        log.debug("Check Integrity")
+        # Write everything which is still queued
+        while not self.get_queue().empty():
+            self.flush(self.collect_batch(wait=False))
+
+    def collect_batch(self, wait=True):
+        """
+        Group commit: wait for the first status message, then take more until STATUS_LOG_BATCH_SIZE
+        messages are collected or STATUS_LOG_BATCH_DELAY is over
+        :param wait: False takes only what is already queued
+        :return: list of StatusRecord
+        """
+        queue = self.get_queue()
+        batch = []
         try:
-            if not bool(data):
-                log.warn("New File detected")
-                return True
+            if wait:
+                batch.append(queue.get(timeout=0.5))
             else:
-                if not data["version"] == "1.0.0":
-                    log.error("Wrong File Version {}".format(data["version"]))
-                    return False
-                m = hashlib.sha256()
-                m.update(msgpack.packb({"status": data["status"], "config": data["config"]}))
-                if not data["signature"] == m.hexdigest():
-                    log.error("Wrong Signature")
-                    return False
-
-                path = os.getcwd()
-
-                with open("{}/controller/statuslog.schema".format(path), "r") as fobj:
-                    schema = json.load(fobj)
-                if validate(instance=data, schema=schema):
-                    log.error("Wrong Schema")
-                    return False
-                log.debug("Integrity looks fine")
-                return True
-
-        except Exception as e:
-            log.exception(e)
-            log.error("Invalid Statuslog file")
-        return False
-
-    def read_statuslog(self, fobj):
-        fobj.seek(0)
-        return msgpack.unpack(fobj, raw=False)
-
-    def write_statuslog(self, fobj, data):
-        m = hashlib.sha256()
-        m.update(msgpack.packb({"status": data["status"], "config": data["config"]}))
-        data["signature"] = m.hexdigest()
-
-        fobj.truncate(0)
-        fobj.seek(0)
-
-        msgpack.pack(data, fobj, use_bin_type=True)
-
-    def cleanup_statuslog(self, data):
-        # ToDo cleanup Old Configs, Old Rounds and old Status Messages
-        return data
-
-    def update_settings_at_statuslog(self, data):
-        if "config" not in data:
-            data["config"] = {}
-
-        if "server" not in data:
-            data["config"]["server"] = []
-
-        if "status" not in data:
-            data["config"]["round"] = []
+                batch.append(queue.get_nowait())
+        except Empty:
+            return batch
+
+        deadline = time.monotonic() + settings.STATUS_LOG_BATCH_DELAY.total_seconds()
+        while len(batch) < settings.STATUS_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                if wait and remaining > 0 and not self.statuslog._stop:
+                    batch.append(queue.get(timeout=remaining))
+                else:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        """
+        Append a batch of status messages to the current segment
+        Only new records are written, the existing history is never read or rewritten
+        :param batch: list of StatusRecord
+        """
+        records = []
+
+        if self.store.size(self._segment) == 0:
+            # Every segment starts with version and config so it can be read on its own
+            records.append({"record": "version", "version": STATUS_LOG_VERSION, "chain": self._link})
+            self._last_config = None
+            self._signature = self._link
+            self._segment_started = time.monotonic()
+
+        config = self.update_settings_at_statuslog()
+        if self._config_key(config) != self._config_key(self._last_config):
+            records.append(config)
+            self._last_config = config
+
+        records = records + [record.to_dict() for record in batch]
+
+        packed = self.pack_valid(records)
+        data = b"".join(raw for record, raw in packed)
+        self._signature = chain_signature(self._signature, data)
+        data = data + pack_record({"record": "signature", "signature": self._signature})
+
+        offset = self.store.append(self._segment, data)
+
+        # The index entries are written after the batch, an index never points behind the end of the segment
+        entries = []
+        for record, raw in packed:
+            entry = index_entry(record, offset)
+            if entry is not None:
+                entries.append(entry)
+            offset += len(raw)
+        if entries:
+            SegmentIndex(self.store, self._segment).append(b"".join(entries))
+
+        self.batches += 1
+        self.records += len(batch)
+        self.written += len(data)
+
+        if self.store.size(self._segment) >= self.store.max_size:
+            self.rotate()
+        else:
+            self.rotate_aged()
+
+    def rotate(self):
+        log.debug("Rotate statuslog segment {}".format(self._segment))
+        if os.path.exists(self.store.segment_path(self._segment)):
+            SegmentIndex(self.store, self._segment).sort()
+        self._segment += 1
+        self._link = self._signature
+        self._segment_started = None
+
+    def rotate_aged(self):
+        """
+        Close the current segment after STATUS_LOG_SEGMENT_MAX_AGE, so it can be merged or compacted
+        """
+        max_age = settings.STATUS_LOG_SEGMENT_MAX_AGE
+        if max_age and self._segment_started is not None and \
+                time.monotonic() - self._segment_started >= max_age.total_seconds():
+            self.rotate()
+
+    def pack_valid(self, records):
+        """
+        Validate and pack the records of one batch
+        :param records: list of records
+        :return: list of (record, packed bytes) of all valid records
+        """
+        validator = get_validator()
+        packed = []
+        for record in records:
+            error = next(validator.iter_errors(record), None)
+            if error is not None:
+                log.error("Wrong Schema {}: {}".format(record, error.message))
+                continue
+            packed.append((record, pack_record(record)))
+        return packed
+
+    def _config_key(self, config):
+        if config is None:
+            return None
+        return (
+            sorted(server_entry_key(server) for server in config["server"]),
+            [(entry["out"], entry["in"]) for entry in config["round"]]
+        )
+
+    def update_settings_at_statuslog(self):
+        config = {
+            "record": "config",
+            "server": [],
+            "round": []
+        }
 
         for server_name, server_config in settings.MAIL_IN_SERVER.items():
-            data["config"]["server"] = data["config"]["server"] + self._add_server_to_config(server_name, server_config)
+            config["server"] = config["server"] + self._add_server_to_config(server_name, server_config,
+                                                                             config["server"])
 
         for server_name, server_config in settings.MAIL_OUT_SERVER.items():
-            data["config"]["server"] = data["config"]["server"] + self._add_server_to_config(server_name, server_config)
-
-        data["config"]["round"] = [{"in": inname, "out": outname, "timestamp": time.time()} for outname, inname in
-                                   settings.MAIL_ROUND.items()]
-        return data
-
-    def _add_server_to_config(self, server_name, server_config):
-        result = []
-        FOUND_SAME_ENTRY = False
+            config["server"] = config["server"] + self._add_server_to_config(server_name, server_config,
+                                                                             config["server"])
+
+        config["round"] = [{"in": inname, "out": outname, "timestamp": time.time()} for outname, inname in
+                           settings.get_round_pairs()]
+        return config
+
+    def _add_server_to_config(self, server_name, server_config, existing):
+        """
+        Build the config entry of one server
+        :param existing: already collected server entries
+        :return: list with the new entry or an empty list if the same server is already in existing
+        """
         SERVER_TYPE = "UNKNOWN"
 
         if isinstance(server_config, MailImapServer):
@@ -168,45 +417,483 @@ class StatusWriter(threading.Thread):
         if isinstance(server_config, MailSmtpServer):
             SERVER_TYPE = "SMTP"
 
-        for config in result:
-            if config["host"] == server_config.host and \
-                    config["port"] == server_config.port and \
-                    config["server_name"] == server_name and \
-                    config["use_ssl"] == server_config.use_ssl:
-
-                if isinstance(server_config, MailImapServer) and \
-                        config["server_type"] == "IMAP":
-                    FOUND_SAME_ENTRY = True
-
-                if isinstance(server_config, MailPopServer) and \
-                        config["server_type"] == "POP":
-                    FOUND_SAME_ENTRY = True
-
-                if isinstance(server_config, MailSmtpServer) and \
-                        config["server_type"] == "SMTP":
-                    FOUND_SAME_ENTRY = True
-
-        if not FOUND_SAME_ENTRY:
-            result.append({
-                "server_type": SERVER_TYPE,
-                "host": server_config.host,
-                "port": int(server_config.port),
-                "use_ssl": bool(server_config.use_ssl),
-                "server_name": server_name,
-                "valid_at": time.time()
-            })
-        return result
+        entry = {
+            "server_type": SERVER_TYPE,
+            "host": server_config.host,
+            "port": int(server_config.port),
+            "use_ssl": bool(server_config.use_ssl),
+            "server_name": server_name,
+            "valid_at": time.time()
+        }
 
-    def add_status_to_statuslog(self, data):
+        for config in existing:
+            if server_entry_key(config) == server_entry_key(entry):
+                return []
+        return [entry]
 
-        if "status" not in data:
-            data["status"] = []
 
-        while not self.get_queue().empty():
+class StatusCompactor(threading.Thread):
+
+    def __init__(self, statuslog, *args, **kwargs):
+        """
+        Background retention of the status log
+        Only closed segments are rewritten, so the writer is never blocked
+        The rounds of closed segments are kept in memory, every pass only reads the segments which were
+        closed since the last one and the active segment
+        """
+        super(StatusCompactor, self).__init__(*args, **kwargs)
+        self.statuslog = statuslog
+        self.store = SegmentStore(settings.STATUS_LOG_PATH, settings.STATUS_LOG_SEGMENT_SIZE)
+        # group -> round of the closed segments (out, in, segments, status)
+        self._groups = {}
+        # Closed segments whose rounds are in _groups
+        self._scanned = set()
+        # (out, in, bucket start) -> set of closed segments with a summary of that bucket
+        self._summaries = {}
+        # Closed segments without status and summary records
+        self._empty = set()
+
+    def run(self):
+        next_run = time.time() + settings.STATUS_LOG_CLEANUP_INTERVAL.total_seconds()
 
-            item = self.get_queue().get(True, 10)
-            if item is not None:
-                data["status"].append(item)
+        while not self.statuslog._stop:
+            if time.time() >= next_run:
+                try:
+                    self.cleanup_statuslog()
+                except Exception as e:
+                    log.exception(e)
+                    log.error("Statuslog cleanup failed")
+                next_run = time.time() + settings.STATUS_LOG_CLEANUP_INTERVAL.total_seconds()
+            time.sleep(1)
+
+    def cleanup_statuslog(self):
+        """
+        Replace old status records with per round summaries
+        A round (status group) is compacted when it is older than STATUS_LOG_MAX_AGE or
+        when there are more than STATUS_LOG_MAX_ROUNDS newer rounds of the same server pair.
+        Summaries older than STATUS_LOG_SUMMARY_MAX_AGE are removed.
+        """
+        if not settings.STATUS_LOG_MAX_AGE and not settings.STATUS_LOG_MAX_ROUNDS and \
+                not settings.STATUS_LOG_SUMMARY_MAX_AGE:
+            return
+
+        active = self.statuslog.active_segment()
+        closed = [number for number, path in self.store.segments() if number < active]
+        if not closed:
+            return
+
+        groups = self._collect_groups(closed, active)
+        self._trim_empty(closed)
+        expired = self._expired_groups(groups, closed)
+        outdated = self._outdated_summaries()
+        if not expired and not outdated:
+            return
+
+        log.info("Compact {} rounds and remove {} summaries of the Statuslog".format(len(expired), len(outdated)))
+
+        # Every bucket has one summary in the first segment which has one, a new bucket is stored in the segment
+        # which contains the start of its first round
+        interval = settings.STATUS_LOG_SUMMARY_INTERVAL.total_seconds()
+        targets = {key: min(numbers) for key, numbers in self._summaries.items()}
+        summaries = {}
+        for group_name in sorted(expired, key=lambda name: groups[name]["start"]):
+            group = groups[group_name]
+            number = targets.setdefault(summary_key(group, interval), group["segments"][0])
+            summaries.setdefault(number, []).append(group)
+
+        touched = set(summaries)
+        for key, numbers in self._summaries.items():
+            # Summaries of one bucket in several segments are merged
+            if key in outdated or len(numbers) > 1:
+                touched.update(numbers)
+        for group_name in expired:
+            touched.update(groups[group_name]["segments"])
+
+        # The target of a bucket is its first segment, the summaries of later segments are carried to it
+        carry = {}
+        for number in sorted(touched, reverse=True):
+            self._rewrite_segment(number, expired, summaries.get(number, []), targets, carry)
+        for group_name in expired:
+            self._groups.pop(group_name, None)
+        self._trim_empty([number for number, path in self.store.segments() if number < active])
+
+    def _scan(self, number, groups, summaries=None):
+        """
+        Add the rounds of one segment to groups
+        :param summaries: dict which gets the buckets of the summary records of the segment (None ignores them)
+        :return: True if the segment has status or summary records
+        """
+        content = False
+        for offset, record in self.store.read(number):
+            kind = record.get("record")
+            if kind == "summary":
+                content = True
+                if summaries is not None:
+                    summaries.setdefault((record["out"], record["in"], record["start"]), set()).add(number)
+            if kind != "status":
+                continue
+            content = True
+
+            group = groups.setdefault(record.get("group", ""), {
+                "out": record["out"],
+                "in": record["in"],
+                "segments": [],
+                "status": {}
+            })
+            if number not in group["segments"]:
+                group["segments"].append(number)
+            group["status"].setdefault(record["status"], record["timestamp"])
+        return content
+
+    def _collect_groups(self, closed, active):
+        """
+        Update the rounds of the closed segments and add the rounds of the active segment
+        :return: dict of group -> round
+        """
+        # Segments which are gone (eg. merged worker segments) are forgotten
+        existing = set(closed)
+        gone = self._scanned - existing
+        if gone:
+            self._scanned -= gone
+            self._empty -= gone
+            for group_name, group in list(self._groups.items()):
+                group["segments"] = [number for number in group["segments"] if number not in gone]
+                if not group["segments"]:
+                    del self._groups[group_name]
+            for key in list(self._summaries):
+                self._summaries[key] -= gone
+                if not self._summaries[key]:
+                    del self._summaries[key]
+
+        for number in closed:
+            if number not in self._scanned:
+                if not self._scan(number, self._groups, self._summaries):
+                    self._empty.add(number)
+                self._scanned.add(number)
+
+        # The active segment is read again every time, its rounds are not cached
+        groups = dict(self._groups)
+        running = {}
+        if os.path.exists(self.store.segment_path(active)):
+            self._scan(active, running)
+        for group_name, group in running.items():
+            cached = groups.get(group_name)
+            if cached is not None:
+                group = dict(cached, segments=cached["segments"] + group["segments"],
+                             status=dict(group["status"], **cached["status"]))
+            groups[group_name] = group
+        return groups
+
+    def _expired_groups(self, groups, closed):
+        expired = set()
+        closed = set(closed)
+
+        rounds = {}
+        for group_name, group in groups.items():
+            group["start"] = min(group["status"].values())
+            rounds.setdefault((group["out"], group["in"]), []).append(group_name)
+
+        oldest = 0
+        if settings.STATUS_LOG_MAX_AGE:
+            oldest = time.time() - settings.STATUS_LOG_MAX_AGE.total_seconds()
+
+        for pair, group_names in rounds.items():
+            group_names.sort(key=lambda name: groups[name]["start"], reverse=True)
+            for position, group_name in enumerate(group_names):
+                group = groups[group_name]
+
+                # Rounds with records in the active segment are not finished for the compactor
+                if not set(group["segments"]) <= closed:
+                    continue
+
+                if group["start"] < oldest:
+                    expired.add(group_name)
+
+                if settings.STATUS_LOG_MAX_ROUNDS and position >= settings.STATUS_LOG_MAX_ROUNDS:
+                    expired.add(group_name)
+        return expired
+
+    def _outdated_summaries(self):
+        """
+        :return: list of summary buckets older than STATUS_LOG_SUMMARY_MAX_AGE
+        """
+        if not settings.STATUS_LOG_SUMMARY_MAX_AGE:
+            return []
+        oldest = time.time() - settings.STATUS_LOG_SUMMARY_MAX_AGE.total_seconds()
+        interval = settings.STATUS_LOG_SUMMARY_INTERVAL.total_seconds()
+        return [key for key in self._summaries if key[2] + interval < oldest]
+
+    def _summarize(self, groups):
+        """
+        Downsample rounds into one summary record per server pair and STATUS_LOG_SUMMARY_INTERVAL
+        """
+        interval = settings.STATUS_LOG_SUMMARY_INTERVAL.total_seconds()
+        buckets = {}
+
+        for group in groups:
+            key = summary_key(group, interval)
+            summary = buckets.setdefault(key, {
+                "record": "summary",
+                "out": group["out"],
+                "in": group["in"],
+                "start": key[2],
+                "end": key[2] + interval,
+                "rounds": 0,
+                "success": 0,
+                "error": 0,
+                "greylisting": 0,
+                "delivered": 0,
+                "delivery_min": None,
+                "delivery_max": None,
+                "delivery_sum": 0.0
+            })
+            summary["rounds"] += 1
+            for status in ["success", "error", "greylisting"]:
+                if status in group["status"]:
+                    summary[status] += 1
+
+            if "start_sendmail" in group["status"] and "end_receive" in group["status"]:
+                delivery = group["status"]["end_receive"] - group["status"]["start_sendmail"]
+                summary["delivered"] += 1
+                summary["delivery_sum"] += delivery
+                if summary["delivery_min"] is None or delivery < summary["delivery_min"]:
+                    summary["delivery_min"] = delivery
+                if summary["delivery_max"] is None or delivery > summary["delivery_max"]:
+                    summary["delivery_max"] = delivery
+
+        return buckets
+
+    def _rewrite_segment(self, number, expired, groups, targets, carry):
+        """
+        Write a closed segment again without the expired rounds
+        The summaries of the expired rounds are merged with the summaries of the same bucket in the segment
+        :param groups: expired rounds whose summary is stored in this segment
+        :param targets: dict of summary bucket -> segment which keeps the summary of the bucket
+        :param carry: dict of summary bucket -> summary taken out of a later segment for its target segment
+        """
+        records = []
+        summaries = self._summarize(groups)
+        outdated = set(self._outdated_summaries())
+        # The chain of the segment starts with the link of its version record, the next segment is chained
+        # to the last signature before the first compaction (seal)
+        link = ""
+        seal = None
+        signature = ""
+
+        for offset, record in self.store.read(number):
+            kind = record.get("record")
+            if kind == "version":
+                link = record.get("chain", "")
+            if kind == "signature":
+                signature = record.get("signature", "")
+                continue
+            if kind == "seal":
+                seal = record.get("seal", "")
+                continue
+            if kind == "status" and record.get("group", "") in expired:
+                continue
+            if kind == "summary":
+                key = (record["out"], record["in"], record["start"])
+                if key in outdated:
+                    continue
+                if targets.get(key, number) != number:
+                    carry[key] = merge_summaries(record, carry[key]) if key in carry else record
+                    continue
+                summaries[key] = merge_summaries(record, summaries[key]) if key in summaries else record
+                continue
+            records.append(record)
+
+        for key in [key for key in carry if targets.get(key) == number]:
+            summaries[key] = merge_summaries(summaries[key], carry.pop(key)) if key in summaries else carry.pop(key)
+
+        for key in list(self._summaries):
+            self._summaries[key].discard(number)
+            if not self._summaries[key]:
+                del self._summaries[key]
+        for key in summaries:
+            self._summaries.setdefault(key, set()).add(number)
+
+        has_content = bool(summaries) or any(record.get("record") == "status" for record in records)
+        if not has_content:
+            self._empty.add(number)
+            if self.store.segments()[0][0] == number:
+                self._remove_segment(number)
+                return
+            # An empty segment in the middle keeps the chain until the segments before it are gone
+            log.debug("Statuslog segment {} is empty".format(number))
+
+        records = records + list(summaries.values()) + [{"record": "seal", "seal": signature if seal is None else seal}]
+        data = b"".join(pack_record(record) for record in records)
+        data = data + pack_record({"record": "signature", "signature": chain_signature(link, data)})
+        # The index is written first, a reader which sees it before the new segment rebuilds it from the old one
+        SegmentIndex(self.store, number).build(segment=data)
+        self.store.replace(number, data)
+
+    def _remove_segment(self, number):
+        log.debug("Remove empty statuslog segment {}".format(number))
+        os.remove(self.store.segment_path(number))
+        SegmentIndex(self.store, number).remove()
+        self._scanned.discard(number)
+        self._empty.discard(number)
+
+    def _trim_empty(self, closed):
+        """
+        Remove the empty segments at the start of the status log, the chain starts with the first segment left
+        """
+        for number in closed:
+            if number not in self._empty:
+                return
+            self._remove_segment(number)
+
+
+def summary_key(group, interval):
+    """
+    :return: (out, in, start of the summary bucket) of a round
+    """
+    return group["out"], group["in"], group["start"] - group["start"] % interval
+
+
+def merge_summaries(summary, other):
+    """
+    Combine two summary records of the same server pair and bucket
+    :return: new summary record
+    """
+    merged = dict(summary)
+    for name in ["rounds", "success", "error", "greylisting", "delivered", "delivery_sum"]:
+        merged[name] = summary.get(name, 0) + other.get(name, 0)
+    for name, choose in [("delivery_min", min), ("delivery_max", max)]:
+        values = [value for value in (summary.get(name), other.get(name)) if value is not None]
+        merged[name] = choose(values) if values else None
+    return merged
+
+
+class StatusReader:
+
+    def __init__(self, path=None):
+        """
+        Rebuild the status log view from the stored segments
+        :param path: Base path of the status log (default: STATUS_LOG_PATH)
+        """
+        self.path = path or settings.STATUS_LOG_PATH
+        self.store = SegmentStore(self.path, settings.STATUS_LOG_SEGMENT_SIZE)
+
+    def iter_records(self):
+        """
+        Iterate over all records of all segments in write order
+        :return: generator of (segment number, offset, record)
+        """
+        for number, path in self.store.segments():
+            for offset, record in self.store.read(number):
+                yield number, offset, record
+
+    def read(self):
+        """
+        Build the version/config/status view of the whole status log
+        Files written by the old single file format (version 1.0.0) are used as base
+        :return: dict
+        """
+        data = {
+            "version": STATUS_LOG_VERSION,
+            "config": {"server": [], "round": []},
+            "status": [],
+            "summary": []
+        }
+
+        if os.path.isfile(self.path):
+            with open(self.path, "rb") as fobj:
+                legacy = msgpack.unpack(fobj, raw=False)
+            data["config"] = legacy.get("config", data["config"])
+            data["status"] = legacy.get("status", [])
+
+        for number, offset, record in self.iter_records():
+            kind = record.pop("record", None)
+
+            if kind == "version":
+                data["version"] = record["version"]
+            elif kind == "config":
+                data["config"] = record
+            elif kind == "status":
+                data["status"].append(record)
+            elif kind == "summary":
+                data["summary"].append(record)
+            elif kind in ["signature", "seal", "merged"]:
+                continue
             else:
-                break
+                log.warning("Unknown record type {} in segment {} at {}".format(kind, number, offset))
         return data
+
+
+class StatusVerifier:
+
+    def __init__(self, path=None):
+        """
+        Offline check of the signature chain and the schema of all segments
+        :param path: Base path of the status log (default: STATUS_LOG_PATH)
+        """
+        self.path = path or settings.STATUS_LOG_PATH
+        self.store = SegmentStore(self.path, settings.STATUS_LOG_SEGMENT_SIZE)
+
+    def verify(self):
+        """
+        Verify all segments
+        Every segment must continue the chain of the segment before it, so a removed or swapped segment is found.
+        The first segment may start with any link (older segments are removed by the retention)
+        :return: list of error messages (empty if the status log is valid)
+        """
+        errors = []
+        previous = None
+        for number, path in self.store.segments():
+            segment_errors, link = self._verify_segment(number, previous)
+            errors = errors + segment_errors
+            previous = (number, link)
+        return errors
+
+    def verify_segment(self, number):
+        """
+        Verify the signature chain of one segment
+        Every signature record must match the chained hash of all records since the previous signature
+        :param number: segment number
+        :return: list of error messages
+        """
+        return self._verify_segment(number)[0]
+
+    def _verify_segment(self, number, previous=None):
+        """
+        :param previous: (number, link) of the segment before or None
+        :return: (list of error messages, link of the next segment)
+        """
+        validator = get_validator()
+        errors = []
+        batch = hashlib.sha256()
+        unsigned = False
+        link = ""
+        seal = None
+        for offset, raw in self.store.read_raw(number):
+            record = msgpack.unpackb(raw[RECORD_HEADER.size:], raw=False)
+
+            for error in validator.iter_errors(record):
+                errors.append("Segment {} offset {}: Wrong Schema {}".format(number, offset, error.message))
+
+            if offset == 0 and record.get("record") == "version" and "chain" in record:
+                # Segments written before the chain was continued across segments have no link
+                batch.update(record["chain"].encode())
+                if previous is not None and record["chain"] != previous[1]:
+                    errors.append("Segment {} does not continue segment {}".format(number, previous[0]))
+
+            if record.get("record") == "signature":
+                if record.get("signature") != batch.hexdigest():
+                    errors.append("Segment {} offset {}: Wrong Signature".format(number, offset))
+                link = record.get("signature", "")
+                # Same as chain_signature(previous, data) but without keeping the batch in memory
+                batch = hashlib.sha256()
+                batch.update(record.get("signature", "").encode())
+                unsigned = False
+            else:
+                if record.get("record") == "seal":
+                    seal = record.get("seal", "")
+                batch.update(raw)
+                unsigned = True
+
+        if unsigned:
+            errors.append("Segment {}: unsigned records at the end".format(number))
+        return errors, link if seal is None else seal
@@ -0,0 +1,162 @@
+import heapq
+import logging
+import os
+import re
+
+from config import settings
+from controller.segment import SegmentStore
+from controller.sharding import FileLease
+from controller.statusindex import SegmentIndex
+from controller.statuslog import StatusWriter
+
+log = logging.getLogger("mailround.controller.statusmerge")
+
+
+class MergedRecord:
+    __slots__ = ("record",)
+
+    def __init__(self, record):
+        """
+        Record of a worker status log in the queue of the StatusWriter
+        """
+        self.record = record
+
+    def to_dict(self):
+        return self.record
+
+
+def record_time(record):
+    if record.get("record") == "summary":
+        return record["start"]
+    return record["timestamp"]
+
+
+class StatusMerger:
+
+    def __init__(self, shard_directory):
+        """
+        Merge the status logs of the shard workers into the main status log at STATUS_LOG_PATH
+        Only closed segments of living workers are merged, a worker which is not running anymore
+        is merged completely. Merged worker segments are removed.
+        Every batch ends with a merged record of the positions in the worker logs, a merge which was interrupted
+        before the worker segments were removed continues behind them instead of merging the records again
+        :param shard_directory: directory with the member leases of the workers
+        """
+        self.shard_directory = shard_directory
+        self.path = settings.STATUS_LOG_PATH
+        self._pattern = re.compile(r"^{}\.(?P<worker>[A-Za-z0-9_-]+)\.(?P<number>\d{{6}})$".format(
+            re.escape(os.path.basename(self.path))))
+        self.writer = StatusWriter(None, name="statusmerge")
+        # The StatusCompactor of the main status log stops with this flag
+        self._stop = False
+        # worker -> [segment number, offset of the last merged record], None until read from the main log
+        self._positions = None
+
+        # Statistics
+        self.merged = 0
+
+    def active_segment(self):
+        """
+        Segment of the main status log which receives the merged records
+        """
+        return self.writer._segment
+
+    def workers(self):
+        """
+        :return: sorted list of the names of all workers with a status log
+        """
+        directory = os.path.dirname(self.path) or "."
+        workers = set()
+        for filename in os.listdir(directory):
+            match = self._pattern.match(filename)
+            if match:
+                workers.add(match["worker"])
+        return sorted(workers)
+
+    def closed_segments(self, worker):
+        """
+        :return: (SegmentStore of the worker, list of segment numbers which are not written anymore)
+        """
+        store = SegmentStore("{}.{}".format(self.path, worker), settings.STATUS_LOG_SEGMENT_SIZE)
+        numbers = [number for number, path in store.segments()]
+        if numbers and FileLease.is_held(os.path.join(self.shard_directory, "{}.member".format(worker))):
+            # The last segment of a running worker may still be written
+            numbers = numbers[:-1]
+        return store, numbers
+
+    def load_positions(self):
+        """
+        Read the positions of the last merged record from the newest segment of the main log which has one
+        :return: dict of worker -> [segment number, offset]
+        """
+        store = self.writer.store
+        for number, path in reversed(store.segments()):
+            positions = None
+            for offset, record in store.read(number):
+                if record.get("record") == "merged":
+                    positions = record["positions"]
+            if positions is not None:
+                return positions
+        return {}
+
+    def _records(self, worker, store, numbers):
+        """
+        :return: generator of (record, worker, segment number, offset) of the records which are not merged yet
+        """
+        merged_number, merged_offset = self._positions.get(worker, (0, -1))
+        for number in numbers:
+            if number < merged_number:
+                continue
+            for offset, record in store.read(number):
+                if number == merged_number and offset <= merged_offset:
+                    continue
+                if record.get("record") in ["status", "summary"]:
+                    yield record, worker, number, offset
+
+    def _flush(self, batch, positions):
+        """
+        Append the records together with the merged positions in one write
+        """
+        self.writer.flush(batch + [MergedRecord({"record": "merged", "positions": dict(positions)})])
+
+    def merge(self):
+        """
+        :return: number of merged records
+        """
+        sources = [(worker,) + self.closed_segments(worker) for worker in self.workers()]
+        sources = [(worker, store, numbers) for worker, store, numbers in sources if numbers]
+        if not sources:
+            return 0
+        if self._positions is None:
+            self._positions = self.load_positions()
+            if self._positions:
+                log.info("Continue an interrupted merge behind {}".format(self._positions))
+
+        # Every worker log is ordered by time, the merged log is ordered by time as well
+        streams = [self._records(worker, store, numbers) for worker, store, numbers in sources]
+        positions = dict(self._positions)
+        count = 0
+        batch = []
+        for record, worker, number, offset in heapq.merge(*streams, key=lambda item: record_time(item[0])):
+            batch.append(MergedRecord(record))
+            positions[worker] = [number, offset]
+            if len(batch) >= settings.STATUS_LOG_BATCH_SIZE:
+                self._flush(batch, positions)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._flush(batch, positions)
+            count += len(batch)
+
+        # The merged records are on disk (SegmentStore.append syncs), the worker segments can go
+        for worker, store, numbers in sources:
+            for number in numbers:
+                os.remove(store.segment_path(number))
+                SegmentIndex(store, number).remove()
+        # A worker which starts again may reuse the segment numbers
+        self._positions = {}
+        self._flush([], self._positions)
+
+        self.merged += count
+        log.info("Merged {} records of {} workers into the Statuslog".format(count, len(sources)))
+        return count
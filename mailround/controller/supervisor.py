@@ -0,0 +1,169 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from config import settings
+from config.reload import ConfigReloader
+from controller.sharding import FileLease, worker_name
+from controller.statuslog import StatusCompactor
+from controller.statusmerge import StatusMerger
+
+log = logging.getLogger("mailround.controller.supervisor")
+
+
+def shard_directory():
+    """
+    Directory with the leases of the workers (SHARD_DIRECTORY or next to the status log)
+    """
+    return settings.SHARD_DIRECTORY or "{}.shards".format(settings.STATUS_LOG_PATH)
+
+
+class WorkerProcess:
+
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        self.process = None
+        self.restarts = 0
+        self.start_after = 0.0
+
+
+class ShardSupervisor:
+
+    def __init__(self, workers, arguments=()):
+        """
+        Run the rounds in several worker processes
+        Every worker runs "app.py --worker <name>" and takes its share of the rounds by consistent hashing.
+        Supervisors on several hosts can share one directory, one of them merges the status logs of all workers
+        into the main status log (the one which holds the merge lease).
+        :param workers: number of worker processes on this host
+        :param arguments: additional command line arguments for the workers (eg. --no-cleanup)
+        """
+        self.directory = shard_directory()
+        os.makedirs(self.directory, exist_ok=True)
+        self.workers = [WorkerProcess(index, worker_name(index, settings.SHARD_NAME)) for index in range(workers)]
+        self.arguments = list(arguments)
+        self._stopping = False
+        self._reload = False
+        self.reloader = ConfigReloader(settings)
+
+        self.merge_lease = FileLease(os.path.join(self.directory, "merge.lock"))
+        self.merger = None
+        self.compactor = None
+        self._next_merge = 0.0
+
+    def worker_command(self, worker):
+        return [sys.executable, os.path.abspath(sys.argv[0]), "--worker", worker.name] + self.arguments
+
+    def start_worker(self, worker):
+        env = dict(os.environ)
+        if settings.METRICS_PORT is not None:
+            # Every worker serves its own metrics
+            env["MAILROUND_METRICS_PORT"] = str(settings.METRICS_PORT + 1 + worker.index)
+        worker.process = subprocess.Popen(self.worker_command(worker), env=env)
+        log.info("Started worker {} (pid {})".format(worker.name, worker.process.pid))
+
+    def check_workers(self, now):
+        """
+        Restart workers which ended, the delay doubles with every restart up to one minute
+        """
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                continue
+            if worker.process is not None:
+                log.error("Worker {} ended with {}".format(worker.name, worker.process.returncode))
+                worker.process = None
+                worker.restarts += 1
+                worker.start_after = now + min(60, 2 ** min(worker.restarts, 6))
+            if now >= worker.start_after:
+                self.start_worker(worker)
+
+    def merge(self, now):
+        """
+        Merge the worker status logs if this supervisor holds the merge lease
+        """
+        if now < self._next_merge:
+            return
+        self._next_merge = now + settings.SHARD_MERGE_INTERVAL.total_seconds()
+
+        if not self.merge_lease.acquire("{} {}\n".format(settings.SHARD_NAME or "", os.getpid())):
+            return
+        if self.merger is None:
+            log.info("Merge the worker status logs")
+            self.merger = StatusMerger(self.directory)
+            # The main status log is only written by the merge, it is compacted here
+            self.compactor = StatusCompactor(self.merger, name="statuscompactor", daemon=True)
+            self.compactor.start()
+        try:
+            self.merger.merge()
+        except Exception as e:
+            log.exception(e)
+            log.error("Merge of the worker status logs failed")
+
+    def request_stop(self, *args):
+        self._stopping = True
+
+    def request_reload(self, *args):
+        self._reload = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+        log.info("Start {} workers".format(len(self.workers)))
+        try:
+            while not self._stopping:
+                now = time.monotonic()
+                self.check_workers(now)
+
+                if self._reload or self.reloader.changed(now):
+                    self._reload = False
+                    self.reload()
+
+                self.merge(now)
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def reload(self):
+        """
+        Reload the own configuration (for the config records of the merged log) and the one of all workers
+        """
+        try:
+            self.reloader.reload()
+        except Exception as e:
+            log.exception(e)
+            log.error("Could not reload the configuration")
+        for worker in self.workers:
+            if worker.process is not None and hasattr(signal, "SIGHUP"):
+                worker.process.send_signal(signal.SIGHUP)
+
+    def stop(self):
+        """
+        Let the workers finish their running rounds, then merge everything
+        """
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                worker.process.terminate()
+
+        timeout = time.monotonic() + settings.MAX_MAIL_RECEIVE_TIME.total_seconds() + 30
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(0.0, timeout - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log.error("Worker {} does not stop. Kill".format(worker.name))
+                worker.process.kill()
+                worker.process.wait()
+
+        self._next_merge = 0.0
+        self.merge(time.monotonic())
+        if self.merger is not None:
+            self.merger._stop = True
+        self.merge_lease.release()
@@ -30,6 +30,9 @@ setuptools.setup(
         "python3-dotenv>=0.15.0"
         "msgpack>=1.0.2"
         "jsonschema>=3.2.0"
-    ]
+    ],
+    extras_require={
+        "report": ["numpy>=1.16"]
+    }
 )
 